@@ -0,0 +1,135 @@
+import math
+import time
+import threading
+from collections import OrderedDict
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+ADMISSION CONTROL
+
+Keeps a fleet reconnecting at once from swamping the server. Every request has to get past two checks before
+it is handled:
+* a token bucket per vehicle. A vehicle that sends more than its share is answered 429, with a Retry-After
+  of when its bucket will have a token again.
+* a limit on the requests handled at the same time across all vehicles. Past it requests are answered 503
+  straight away, with a Retry-After worked out from how long requests are taking, rather than piling up
+  in the server and making everyone slow.
+
+Rejections are cheap, so the requests that are admitted keep their usual latency however many are turned away.
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+class TokenBucket():
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+
+    def take(self):
+        '''
+        0 if a token was taken, otherwise the seconds until there is one
+        '''
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+    def give_back(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+
+
+class AdmissionController():
+
+    def __init__(self, max_concurrent, vehicle_rate, vehicle_burst, max_vehicles=100000):
+        self.max_concurrent = max_concurrent
+        self.vehicle_rate = vehicle_rate
+        self.vehicle_burst = vehicle_burst
+        self.max_vehicles = max_vehicles
+        self.lock = threading.Lock()
+        # vin -> bucket, least recently seen first so the oldest can be dropped
+        self.buckets = OrderedDict()
+        self.in_flight = 0
+        # moving average of how long an admitted request takes, in seconds
+        self.service_seconds = 0.05
+        self.metrics = {
+            'admitted': 0,
+            'throttled': 0,
+            'shed': 0,
+        }
+
+
+    def _bucket(self, vin):
+        # caller holds the lock
+        bucket = self.buckets.get(vin)
+        if bucket is None:
+            bucket = self.buckets[vin] = TokenBucket(self.vehicle_rate, self.vehicle_burst)
+            if len(self.buckets) > self.max_vehicles:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(vin)
+        return bucket
+
+
+    def admit(self, vin):
+        '''
+        None if the request is admitted, in which case release() has to be
+        called once it is handled. Otherwise the status to reject it with and
+        the seconds the client should wait before retrying. Requests without
+        a vin are only held to the concurrency limit
+        '''
+        with self.lock:
+            bucket = self._bucket(vin) if vin else None
+
+            wait = bucket.take() if bucket else 0
+            if wait:
+                self.metrics['throttled'] += 1
+                return 429, wait
+
+            if self.in_flight >= self.max_concurrent:
+                # the vehicle was not served, it should not be charged for it
+                if bucket:
+                    bucket.give_back()
+                self.metrics['shed'] += 1
+                return 503, self.service_seconds * (self.in_flight / self.max_concurrent)
+
+            self.in_flight += 1
+            self.metrics['admitted'] += 1
+            return None
+
+
+    def release(self, seconds):
+        with self.lock:
+            self.in_flight -= 1
+            self.service_seconds = 0.1 * seconds + 0.9 * self.service_seconds
+
+
+    def get_metrics(self):
+        with self.lock:
+            return {
+                **self.metrics,
+                'in_flight': self.in_flight,
+                'max_concurrent': self.max_concurrent,
+                'vehicles': len(self.buckets),
+                'service_ms': round(self.service_seconds * 1000, 3),
+            }
+
+
+
+def retry_after_header(seconds):
+    # Retry-After is whole seconds, round up so clients never come back early
+    return str(max(1, math.ceil(seconds)))
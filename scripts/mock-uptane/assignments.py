@@ -0,0 +1,262 @@
+import os
+import time
+import uuid
+import json
+import threading
+from collections import deque
+from admission import TokenBucket
+from metadata_writer import MetadataTransaction, committer
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+BULK IMAGE ASSIGNMENT
+
+Assigns an image to a list of vehicles at once. Rather than every vehicle getting its director metadata signed
+when it next checks in, which turns a rollout to a whole fleet into a storm of signing as the fleet checks in,
+a pool of workers signs each vehicle's metadata ahead of time, at no more than a set rate, and only then points
+the vehicle at the image. Check-ins then serve what is already signed.
+
+Each assignment is a directory under the assignments dir:
+* assignment.json   the image, the vins and when it was created
+* done              one line per vehicle that has been handled, "<vin> ok", "<vin> error <reason>" or
+                    "<vin> superseded" when a newer assignment took the vehicle over before it was reached
+
+Progress is worked out from those two files, so any process can report it, and an assignment interrupted by a
+restart carries on with the vehicles not in `done`. Only one process runs the workers, it picks up assignments
+created by other processes with rescan().
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+class AssignmentRunner():
+
+    def __init__(self, root, handler, workers, vehicles_per_second, burst):
+        '''
+        handler is called with a vin and an image name, signs the vehicle's
+        metadata for the image and assigns it, and raises if it could not
+        '''
+        self.root = root
+        self.handler = handler
+        self.workers = workers
+        self.bucket = TokenBucket(vehicles_per_second, burst)
+        self.bucket_lock = threading.Lock()
+        self.log_lock = threading.Lock()
+        self.condition = threading.Condition()
+        # (assignment id, vin, image) waiting for a worker, oldest first
+        self.ready = deque()
+        # vin -> the assignment it is waiting in, the newest if it is in several
+        self.pending = {}
+        # vins a worker is handling, and items for them that came up meanwhile
+        self.active = set()
+        self.deferred = {}
+        # assignments this process has picked up -> when they were created
+        self.known = {}
+        self.started = False
+        self.metrics = {
+            'signed': 0,
+            'errors': 0,
+            'superseded': 0,
+        }
+
+
+    def _dir(self, assignment_id):
+        return os.path.join(self.root, assignment_id)
+
+
+    def create(self, image, vins):
+        '''
+        Durably record an assignment, returns its id. The vehicles are signed
+        for in the background
+        '''
+        assignment_id = uuid.uuid4().hex
+        os.makedirs(self._dir(assignment_id))
+
+        txn = MetadataTransaction()
+        txn.stage(os.path.join(self._dir(assignment_id), 'assignment.json'), json.dumps({
+            'image': image,
+            'vins': list(dict.fromkeys(vins)),
+            'created_at': time.time(),
+        }).encode('utf-8'))
+        committer.commit(txn)
+
+        if self.started:
+            self._pick_up(assignment_id)
+        return assignment_id
+
+
+    def _load(self, assignment_id):
+        '''
+        An assignment and vin -> outcome of the vehicles handled so far
+        '''
+        path = os.path.join(self._dir(assignment_id), 'assignment.json')
+        if len(assignment_id) != 32 or not os.path.isfile(path):
+            raise KeyError(assignment_id)
+        with open(path, 'r') as f:
+            assignment = json.loads(f.read())
+
+        done = {}
+        if os.path.isfile(os.path.join(self._dir(assignment_id), 'done')):
+            with open(os.path.join(self._dir(assignment_id), 'done'), 'r') as f:
+                for line in f:
+                    # a torn last line is a vehicle that is signed for again
+                    if line.endswith('\n'):
+                        vin, _, outcome = line.rstrip('\n').partition(' ')
+                        done[vin] = outcome
+        return assignment, done
+
+
+    def _pick_up(self, assignment_id):
+        assignment, done = self._load(assignment_id)
+        with self.condition:
+            if assignment_id in self.known:
+                return
+            self.known[assignment_id] = assignment['created_at']
+            for vin in assignment['vins']:
+                if vin not in done:
+                    # assignments left from before a restart are picked up in no particular order
+                    current = self.pending.get(vin)
+                    if current is None or self.known[current] <= assignment['created_at']:
+                        self.pending[vin] = assignment_id
+                    self.ready.append((assignment_id, vin, assignment['image']))
+            self.condition.notify_all()
+
+
+    def ids(self):
+        os.makedirs(self.root, exist_ok=True)
+        return sorted(os.listdir(self.root))
+
+
+    def rescan(self):
+        '''
+        Pick up assignments left from before a restart or created by another
+        process
+        '''
+        for assignment_id in self.ids():
+            if assignment_id not in self.known:
+                try:
+                    self._pick_up(assignment_id)
+                except KeyError:
+                    # still being created
+                    continue
+
+
+    def start(self):
+        self.started = True
+        self.rescan()
+        for _ in range(self.workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+
+    def is_pending(self, vin):
+        with self.condition:
+            return vin in self.pending
+
+
+    def _throttle(self):
+        while True:
+            with self.bucket_lock:
+                wait = self.bucket.take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+    def _next(self):
+        '''
+        The next item whose vehicle no other worker is handling, caller holds
+        the condition
+        '''
+        while True:
+            while not self.ready:
+                self.condition.wait()
+            item = self.ready.popleft()
+            vin = item[1]
+            if vin not in self.active:
+                return item
+            # taken up again once the other worker is done with the vehicle
+            self.deferred.setdefault(vin, deque()).append(item)
+
+
+    def _work(self):
+        while True:
+            with self.condition:
+                assignment_id, vin, image = self._next()
+                # only the newest assignment a vehicle is in is signed for
+                superseded = self.pending.get(vin) != assignment_id
+                self.active.add(vin)
+
+            try:
+                if superseded:
+                    outcome = 'superseded'
+                else:
+                    self._throttle()
+                    self.handler(vin, image)
+                    outcome = 'ok'
+            # whatever goes wrong with one vehicle, the worker carries on with the next
+            except Exception as e:
+                reason = ' '.join(str(e).split()) or type(e).__name__
+                print(f'unable to assign {image} to {vin}: {reason}')
+                outcome = f'error {reason}'
+
+            try:
+                with self.log_lock:
+                    with open(os.path.join(self._dir(assignment_id), 'done'), 'a') as f:
+                        f.write(f'{vin} {outcome}\n')
+            except OSError as e:
+                print(f'unable to record {vin} as handled in assignment {assignment_id}: {e}')
+            finally:
+                # or its check-ins would keep leaving it to the assignment
+                with self.condition:
+                    if self.pending.get(vin) == assignment_id:
+                        del self.pending[vin]
+                    self.active.discard(vin)
+                    waiting = self.deferred.get(vin)
+                    if waiting:
+                        self.ready.appendleft(waiting.popleft())
+                        if not waiting:
+                            del self.deferred[vin]
+                        self.condition.notify()
+                    self.metrics[{'ok': 'signed', 'superseded': 'superseded'}.get(outcome, 'errors')] += 1
+
+
+    def status(self, assignment_id):
+        assignment, done = self._load(assignment_id)
+        failed = {vin: outcome[len('error '):] for vin, outcome in done.items() if outcome.startswith('error ')}
+        superseded = sum(1 for outcome in done.values() if outcome == 'superseded')
+        total = len(assignment['vins'])
+        remaining = total - len(done)
+        elapsed = time.time() - assignment['created_at']
+        rate = len(done) / elapsed if elapsed > 0 else 0
+        if not remaining:
+            eta_seconds = 0
+        else:
+            eta_seconds = round(remaining / rate, 1) if rate else None
+
+        return {
+            'assignment_id': assignment_id,
+            'image': assignment['image'],
+            'total': total,
+            'signed': len(done) - len(failed) - superseded,
+            'failed': len(failed),
+            'superseded': superseded,
+            'remaining': remaining,
+            'done': remaining == 0,
+            'vehicles_per_second': round(rate, 2),
+            'eta_seconds': eta_seconds,
+            # the first few, an assignment to a whole fleet could have thousands
+            'errors': dict(list(failed.items())[:20]),
+        }
+
+
+    def get_metrics(self):
+        with self.condition:
+            return {
+                **self.metrics,
+                'waiting': len(self.ready),
+                'vehicles_pending': len(self.pending),
+            }
@@ -0,0 +1,424 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import logging
+import platform
+import shutil
+import tempfile
+import threading
+import statistics
+import contextlib
+import importlib.util
+from styles import GREEN, RED, YELLOW, ENDCOLORS
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+BENCHMARK SUITE
+
+Times the hot paths of the mock uptane tooling so a change that is meant to make one of them faster can be
+measured, and one that makes one slower is noticed:
+* manifest_generation       Primary.generate_signed_vehicle_manifest()
+* put_target                server.put_target() into the image repo, a signed and committed metadata update
+* process_vehicle_manifest  server.process_vehicle_manifest() of a fresh manifest from a vehicle with an image
+* update_cycle              Primary.update_cycle() against the server over http, with nothing new to pull after
+                            the first one but a re-signed timestamp. A cycle that fails is an error rather than a
+                            fast result
+* metadata_get              GET of the image timestamp and targets through the flask test client
+* metadata_get_gzip         the same with Accept-Encoding: gzip
+* ostree_push               push-ostree-repo.py pushing a synthetic repo of OSTREE_OBJECTS objects to a local
+                            stand-in treehub
+* import_primary            `import primary` in a fresh interpreter, see bench_importtime.py
+
+The server runs against a throwaway db (SERVER_DB_PATH) so the benchmarks never touch db/. Each benchmark is
+run `runs` times and each run times a fixed number of operations; the median time per operation is what is
+compared.
+
+    python bench.py [runs] [baseline.json|-] [benchmark ...] > results.json
+
+The results are printed as json so they can be kept and passed back in as the baseline of a later change. The
+script exits with 1 if any benchmark got slower than its baseline by more than REGRESSION_THRESHOLD.
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+DEFAULT_RUNS = 5
+REGRESSION_THRESHOLD = 0.2
+OSTREE_OBJECTS = int(os.environ.get('BENCH_OSTREE_OBJECTS', 500))
+OSTREE_OBJECT_MAX_BYTES = 64 * 1024
+TREEHUB_NAMESPACE = 'bench'
+BENCH_VIN = 'bench-vehicle'
+PUSH_SCRIPT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'push-ostree-repo.py')
+
+
+def measure(op, ops, runs):
+    '''
+    Seconds per call of op, one sample per run of `ops` calls
+    '''
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        for _ in range(ops):
+            op()
+        samples.append((time.perf_counter() - start) / ops)
+    return samples
+
+
+
+def summarize(samples, ops, **extra):
+    return {
+        'ops_per_run': ops,
+        'median_us': round(statistics.median(samples) * 1e6, 1),
+        'min_us': round(min(samples) * 1e6, 1),
+        'max_us': round(max(samples) * 1e6, 1),
+        **extra,
+    }
+
+
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+SETUP
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+def make_db(root):
+    # the layout the server expects, it does not create it itself
+    for d in ('image/metadata', 'image/targets', 'director/metadata', 'director/targets',
+            'director/inventory', 'targets'):
+        os.makedirs(os.path.join(root, d), exist_ok=True)
+
+
+
+def register_vehicle(server, image):
+    '''
+    A vehicle with the primary's ecus that has been assigned image
+    '''
+    from common import load_pem_key, TEAM_ID, PRIMARY_ECU_SERIAL, SECONDARY_ECU_SERIAL
+
+    server.create_vehicle(BENCH_VIN)
+    for ecu_serial in (PRIMARY_ECU_SERIAL, SECONDARY_ECU_SERIAL):
+        server.add_ecu_to_vehicle(BENCH_VIN, ecu_serial, load_pem_key(f'{TEAM_ID}-{ecu_serial}-public'))
+
+    vehicle = server.find_vehicle(BENCH_VIN)
+    vehicle['image'] = image
+    with open(os.path.join(server.DB_ROOT_PATH, 'director', 'inventory', BENCH_VIN), 'w') as f:
+        f.write(json.dumps(vehicle))
+
+
+
+def make_ostree_repo(root, objects):
+    '''
+    A repo laid out like an ostree archive repo with `objects` objects of
+    random content, returns the total size of the objects
+    '''
+    rng = random.Random(objects)
+    total = 0
+    for i in range(objects):
+        content = rng.randbytes(rng.randint(64, OSTREE_OBJECT_MAX_BYTES))
+        digest = hashlib.sha256(content).hexdigest()
+        object_type = 'commit' if i == 0 else rng.choice(['dirtree', 'dirmeta', 'filez'])
+        os.makedirs(os.path.join(root, 'objects', digest[:2]), exist_ok=True)
+        with open(os.path.join(root, 'objects', digest[:2], f'{digest[2:]}.{object_type}'), 'wb') as f:
+            f.write(content)
+        total += len(content)
+
+        if i == 0:
+            os.makedirs(os.path.join(root, 'refs', 'heads'), exist_ok=True)
+            with open(os.path.join(root, 'refs', 'heads', 'main'), 'w') as f:
+                f.write(digest + '\n')
+
+    with open(os.path.join(root, 'summary'), 'wb') as f:
+        f.write(rng.randbytes(4096))
+
+    return total
+
+
+
+def start_treehub():
+    '''
+    A stand-in treehub that accepts pushes and discards them, returns the
+    server and what it received
+    '''
+    from flask import Flask, request
+    from werkzeug.serving import make_server
+
+    app = Flask('treehub')
+    received = {'requests': 0, 'bytes': 0}
+
+    @app.route(f'/api/v1/treehub/{TREEHUB_NAMESPACE}/<path:path>', methods=['PUT'])
+    def put(path):
+        received['requests'] += 1
+        received['bytes'] += len(request.get_data())
+        return 'ok'
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('localhost', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, received
+
+
+
+def start_app():
+    '''
+    The server's flask app served over http, for clients that fetch with
+    requests rather than through the test client
+    '''
+    import server
+    from werkzeug.serving import make_server
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app_server = make_server('localhost', 0, server.app, threaded=True)
+    threading.Thread(target=app_server.serve_forever, daemon=True).start()
+    return app_server
+
+
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+BENCHMARKS
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+def bench_manifest_generation(runs):
+    from primary import Primary
+
+    primary = Primary()
+    ops = 5
+    return summarize(measure(primary.generate_signed_vehicle_manifest, ops, runs), ops)
+
+
+
+def bench_put_target(runs):
+    import server
+
+    counter = iter(range(sys.maxsize))
+    ops = 5
+    samples = measure(lambda: server.put_target(f'bench-{next(counter)}.txt', 'bench content', 'image'), ops, runs)
+    return summarize(samples, ops)
+
+
+
+def bench_process_vehicle_manifest(runs):
+    import server
+    from primary import Primary
+
+    server.put_target('bench-image.txt', 'bench image', 'director')
+    register_vehicle(server, 'bench-image.txt')
+
+    # every manifest is new, a vehicle would not send the same one twice
+    ops = 5
+    primary = Primary()
+    manifests = iter([primary.generate_signed_vehicle_manifest() for _ in range(ops * runs)])
+
+    def op():
+        result = server.process_vehicle_manifest(BENCH_VIN, next(manifests))
+        if isinstance(result, tuple):
+            raise RuntimeError(f'manifest rejected: {result[0]}')
+
+    return summarize(measure(op, ops, runs), ops)
+
+
+
+def bench_update_cycle(runs):
+    import server
+    import primary
+    from mirrors import MirrorPool
+
+    app_server = start_app()
+    base_url = f'http://localhost:{app_server.server_port}'
+
+    # a primary-fs of its own that trusts the roots of the throwaway db
+    primary_fs = tempfile.mkdtemp(prefix='bench-primary-fs-')
+    for repo_name in ('director', 'image'):
+        meta_dir = os.path.join(primary_fs, repo_name, 'metadata')
+        targets_dir = os.path.join(primary_fs, repo_name, 'targets')
+        os.makedirs(meta_dir)
+        os.makedirs(targets_dir)
+        shutil.copy(os.path.join(os.environ['SERVER_DB_PATH'], repo_name, 'metadata', 'root.json'),
+            os.path.join(meta_dir, 'root.json'))
+        setattr(primary, f'{repo_name.upper()}_REPO_META_DIR', meta_dir)
+        setattr(primary, f'{repo_name.upper()}_REPO_TARGETS_DIR', targets_dir)
+
+    client = primary.Primary()
+    # no vehicle id, so the cycles are not held to one vehicle's request rate
+    client.director_mirrors = MirrorPool([f'{base_url}/director'])
+    client.image_mirrors = MirrorPool([f'{base_url}/image'])
+    outcomes = []
+
+    def op():
+        outcome = client.update_cycle()
+        if outcome == primary.CYCLE_FAILED:
+            raise RuntimeError('update cycle failed')
+        outcomes.append(outcome)
+
+    try:
+        # the first cycle downloads everything, the ones timed find nothing new. The timestamp is re-signed
+        # in between, as the resigner does, which must still count as nothing new
+        op()
+        server.resign_timestamp()
+        ops = 5
+        samples = measure(op, ops, runs)
+    finally:
+        app_server.shutdown()
+
+    return summarize(samples, ops, outcomes={outcome: outcomes.count(outcome) for outcome in set(outcomes)})
+
+
+
+def _bench_metadata_get(runs, headers):
+    import server
+
+    client = server.app.test_client()
+    version = server.get_metadata_versions('image')['targets']
+    paths = ['/image/timestamp.json', f'/image/{version}.targets.json']
+    sent = []
+
+    def op():
+        for path in paths:
+            response = client.get(path, headers=headers)
+            if response.status_code != 200:
+                raise RuntimeError(f'{response.status_code} for {path}')
+            sent.append(len(response.data))
+
+    ops = 200
+    samples = measure(op, ops, runs)
+    return summarize(samples, ops, requests_per_op=len(paths), bytes_per_op=sum(sent) // (ops * runs))
+
+
+
+def bench_metadata_get(runs):
+    return _bench_metadata_get(runs, {})
+
+
+
+def bench_metadata_get_gzip(runs):
+    return _bench_metadata_get(runs, {'Accept-Encoding': 'gzip'})
+
+
+
+def bench_ostree_push(runs):
+    repo = tempfile.mkdtemp(prefix='bench-ostree-')
+    object_bytes = make_ostree_repo(repo, OSTREE_OBJECTS)
+
+    spec = importlib.util.spec_from_file_location('push_ostree_repo', PUSH_SCRIPT_PATH)
+    push = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(push)
+
+    treehub, received = start_treehub()
+    push.REPO_ROOT_DIR = repo
+    push.BASE_URL = f'http://localhost:{treehub.server_port}/api/v1/treehub/{TREEHUB_NAMESPACE}'
+
+    try:
+        samples = measure(push.main, 1, runs)
+    finally:
+        treehub.shutdown()
+
+    return summarize(samples, 1,
+        objects=OSTREE_OBJECTS,
+        object_bytes=object_bytes,
+        requests_per_op=received['requests'] // runs,
+        objects_per_second=round(OSTREE_OBJECTS / statistics.median(samples), 1))
+
+
+
+def bench_import_primary(runs):
+    from bench_importtime import run_benchmark, MODULE
+
+    results = run_benchmark(MODULE, runs)
+    return {
+        'ops_per_run': 1,
+        'median_us': results['total_us_median'],
+        'min_us': results['total_us_min'],
+        'modules_imported': results['modules_imported'],
+    }
+
+
+
+BENCHMARKS = {
+    'manifest_generation': bench_manifest_generation,
+    'put_target': bench_put_target,
+    'process_vehicle_manifest': bench_process_vehicle_manifest,
+    'update_cycle': bench_update_cycle,
+    'metadata_get': bench_metadata_get,
+    'metadata_get_gzip': bench_metadata_get_gzip,
+    'ostree_push': bench_ostree_push,
+    'import_primary': bench_import_primary,
+}
+
+
+
+def run_benchmarks(names, runs):
+    db_path = tempfile.mkdtemp(prefix='bench-db-')
+    make_db(db_path)
+    # before server and common are imported, they read it once
+    os.environ['SERVER_DB_PATH'] = db_path
+
+    import server
+    # the server and primary print as they go, which would end up in the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        server.init_repos()
+
+    results = {}
+    for name in names:
+        print(f'{YELLOW}running {name}{ENDCOLORS}', file=sys.stderr)
+        with contextlib.redirect_stdout(io.StringIO()):
+            results[name] = BENCHMARKS[name](runs)
+
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'runs': runs,
+        'db_path': db_path,
+        'benchmarks': results,
+    }
+
+
+
+def compare(results, baseline):
+    '''
+    True if no benchmark got slower than the threshold over the baseline
+    '''
+    ok = True
+    for name, result in results['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+        if base is None:
+            print(f"{YELLOW}{name}: {result['median_us']}us, not in the baseline{ENDCOLORS}", file=sys.stderr)
+            continue
+
+        change = (result['median_us'] - base['median_us']) / base['median_us']
+        regressed = change > REGRESSION_THRESHOLD
+        ok = ok and not regressed
+        color = RED if regressed else GREEN
+        print(f"{color}{name}: {result['median_us']}us, baseline {base['median_us']}us ({change:+.1%}){ENDCOLORS}",
+            file=sys.stderr)
+
+    return ok
+
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_RUNS
+    baseline_path = sys.argv[2] if len(sys.argv) > 2 and sys.argv[2] != '-' else None
+    names = sys.argv[3:] or list(BENCHMARKS)
+
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        print(f'{RED}unknown benchmarks {unknown}, pick from {list(BENCHMARKS)}{ENDCOLORS}', file=sys.stderr)
+        sys.exit(2)
+
+    results = run_benchmarks(names, runs)
+    print(json.dumps(results, indent=2))
+
+    if baseline_path:
+        with open(baseline_path, 'r') as f:
+            baseline = json.loads(f.read())
+        if not compare(results, baseline):
+            sys.exit(1)
+    else:
+        for name, result in results['benchmarks'].items():
+            print(f"{GREEN}{name}: {result['median_us']}us per op (median of {runs}){ENDCOLORS}", file=sys.stderr)
@@ -0,0 +1,121 @@
+import os
+import sys
+import json
+import platform
+import statistics
+import subprocess
+from styles import GREEN, RED, YELLOW, ENDCOLORS
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+IMPORT TIME BENCHMARK
+
+Measures how long `import primary` takes in a fresh interpreter using `python -X importtime`, which is what a
+robot pays on every boot before the first update check. Each run is a new process so nothing is cached in
+sys.modules; the median of the runs is reported along with the modules that took the longest.
+
+    python bench_importtime.py [runs] [baseline.json] > results.json
+
+The results are printed as json so they can be kept and passed back in as the baseline of a later release. The
+script exits with 1 if the total import time grew by more than REGRESSION_THRESHOLD over the baseline.
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+MODULE = 'primary'
+DEFAULT_RUNS = 10
+TOP_MODULES = 15
+REGRESSION_THRESHOLD = 0.2
+
+
+def import_times(module):
+    '''
+    Self and cumulative import time in us of every module imported by a fresh
+    interpreter importing `module`
+    '''
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, check=True)
+
+    times = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # site and everything it imports are loaded by the interpreter before `module`
+        if name.strip() == 'site':
+            times = {}
+            continue
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+
+    return times
+
+
+
+def run_benchmark(module, runs):
+    samples = [import_times(module) for _ in range(runs)]
+    totals = [sample[module][1] for sample in samples]
+
+    # median self and cumulative time of each module over the runs it showed up in
+    modules = {}
+    for sample in samples:
+        for name, times in sample.items():
+            modules.setdefault(name, []).append(times)
+
+    top = sorted((
+        {
+            'module': name,
+            'self_us': int(statistics.median(t[0] for t in times)),
+            'cumulative_us': int(statistics.median(t[1] for t in times)),
+        }
+        for name, times in modules.items() if name != module),
+        key=lambda m: m['cumulative_us'], reverse=True)[:TOP_MODULES]
+
+    return {
+        'module': module,
+        'python': platform.python_version(),
+        'runs': runs,
+        'modules_imported': len(samples[0]),
+        'total_us_median': int(statistics.median(totals)),
+        'total_us_min': min(totals),
+        'top': top,
+    }
+
+
+
+def compare(results, baseline):
+    '''
+    True if the total import time is within the threshold of the baseline
+    '''
+    change = (results['total_us_median'] - baseline['total_us_median']) / baseline['total_us_median']
+    color = RED if change > REGRESSION_THRESHOLD else GREEN
+    print(f"{color}import {results['module']}: {results['total_us_median']}us, "
+        f"baseline {baseline['total_us_median']}us ({change:+.1%}){ENDCOLORS}", file=sys.stderr)
+
+    new_modules = {m['module'] for m in results['top']} - {m['module'] for m in baseline['top']}
+    if new_modules:
+        print(f'{YELLOW}new in the slowest modules: {sorted(new_modules)}{ENDCOLORS}', file=sys.stderr)
+
+    return change <= REGRESSION_THRESHOLD
+
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_RUNS
+    results = run_benchmark(MODULE, runs)
+    print(json.dumps(results, indent=2))
+
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], 'r') as f:
+            baseline = json.loads(f.read())
+        if not compare(results, baseline):
+            sys.exit(1)
+    else:
+        print(f"{GREEN}import {MODULE}: {results['total_us_median']}us (median of {runs}){ENDCOLORS}", file=sys.stderr)
@@ -0,0 +1,203 @@
+import os
+import uuid
+import hashlib
+import shutil
+from common import DB_ROOT_PATH
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+CONTENT ADDRESSED BLOB STORE
+
+Targets and metadata are stored once under db/blobs/<first 2 chars of sha256>/<sha256>. Wherever the repos
+and vehicles expect a file (db/image/targets/<name>, db/director/<vin>/1.root.json, ...) a hard link to the
+blob is put in its place. The existing read paths work unchanged and identical content is only on disk, and
+in the page cache, once.
+
+A blob's reference count is its hard link count. A blob with a link count of 1 is referenced by nothing but
+the store, and collect_garbage() removes it. On a filesystem without hard links blobs are copied into place
+instead, and the link count says nothing. Every blob that was copied is pinned under db/blobs/pinned/ and
+never collected.
+
+Files in the repos must never be opened for writing in place or the shared blob would be changed, they are
+replaced with link_blob() instead. tuf's Metadata.to_file removes the file before writing so it is safe too.
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+BLOBS_PATH = os.path.join(DB_ROOT_PATH, 'blobs')
+PINNED_PATH = os.path.join(BLOBS_PATH, 'pinned')
+
+
+def blob_path(digest):
+    return os.path.join(BLOBS_PATH, digest[:2], digest)
+
+
+
+def pin_blob(digest):
+    '''
+    Keep a blob from being collected, for one that was copied rather than
+    linked somewhere so its link count doesn't count that reference
+    '''
+    os.makedirs(PINNED_PATH, exist_ok=True)
+    open(os.path.join(PINNED_PATH, digest), 'a').close()
+
+
+
+def _blob_dirs():
+    # the prefix dirs, not the pins
+    return [prefix for prefix in os.listdir(BLOBS_PATH) if len(prefix) == 2]
+
+
+
+def put_blob(data):
+    '''
+    Store data if it is not stored already, returns its sha256
+    '''
+    digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(digest)
+
+    if os.path.exists(path):
+        return digest
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+
+    # link rather than rename so a blob that appeared in the meantime, and its links, are left alone
+    try:
+        os.link(tmp_path, path)
+    except FileExistsError:
+        pass
+    except OSError:
+        # no hard links on this filesystem, there are no links to leave alone either
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return digest
+
+
+
+def adopt_blob(path, digest):
+    '''
+    Store the file at path, whose sha256 the caller has already worked out,
+    without reading it. The file is linked into the store and left in place,
+    the caller removes it once the blob is linked wherever it is needed so
+    the blob is never unreferenced in between
+    '''
+    dest = blob_path(digest)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+
+    try:
+        os.link(path, dest)
+    except FileExistsError:
+        pass
+    except OSError:
+        # no hard links on this filesystem, the file at path is linked somewhere as a copy as well
+        pin_blob(digest)
+        shutil.copyfile(path, dest)
+
+    return digest
+
+
+
+def is_blob_of(digest, path):
+    '''
+    True if the file at path is the stored blob digest
+    '''
+    if os.path.samefile(blob_path(digest), path):
+        return True
+    if os.path.getsize(blob_path(digest)) != os.path.getsize(path):
+        return False
+    # a private copy, on a filesystem without hard links
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest() == digest
+
+
+
+def link_blob(data, dest_path):
+    '''
+    Store data and atomically replace dest_path with a link to it
+    '''
+    return link_digest(put_blob(data), dest_path)
+
+
+
+def link_digest(digest, dest_path):
+    '''
+    Atomically replace dest_path with a link to a stored blob
+    '''
+    if os.path.exists(dest_path) and os.path.samefile(blob_path(digest), dest_path):
+        return digest
+
+    tmp_path = f'{dest_path}.{uuid.uuid4().hex}.tmp'
+
+    try:
+        os.link(blob_path(digest), tmp_path)
+    except OSError:
+        # no hard links on this filesystem, fall back to a private copy
+        pin_blob(digest)
+        shutil.copyfile(blob_path(digest), tmp_path)
+
+    os.replace(tmp_path, dest_path)
+
+    # renaming onto another link to the same file leaves both in place
+    try:
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        pass
+
+    return digest
+
+
+
+def collect_garbage():
+    '''
+    Remove every blob nothing links to any more, other than pinned ones
+    '''
+    removed = 0
+    freed = 0
+
+    if not os.path.isdir(BLOBS_PATH):
+        return {'removed': removed, 'freed_bytes': freed}
+
+    pinned = set(os.listdir(PINNED_PATH)) if os.path.isdir(PINNED_PATH) else set()
+
+    for prefix in _blob_dirs():
+        for digest in os.listdir(os.path.join(BLOBS_PATH, prefix)):
+            path = os.path.join(BLOBS_PATH, prefix, digest)
+            stat = os.stat(path)
+            if stat.st_nlink == 1 and not digest.endswith('.tmp') and digest not in pinned:
+                os.remove(path)
+                removed += 1
+                freed += stat.st_size
+
+    return {'removed': removed, 'freed_bytes': freed}
+
+
+
+def blob_stats():
+    blobs = 0
+    stored = 0
+    referenced = 0
+
+    if os.path.isdir(BLOBS_PATH):
+        for prefix in _blob_dirs():
+            for digest in os.listdir(os.path.join(BLOBS_PATH, prefix)):
+                stat = os.stat(os.path.join(BLOBS_PATH, prefix, digest))
+                blobs += 1
+                stored += stat.st_size
+                referenced += stat.st_size * (stat.st_nlink - 1)
+
+    # referenced is what the same files would take up without deduplication
+    return {'blobs': blobs, 'stored_bytes': stored, 'referenced_bytes': referenced}
@@ -0,0 +1,408 @@
+import os
+import re
+import sys
+import uuid
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+import requests
+from flask import Flask, Response, request, send_file
+from colored import stylize, fg
+from common import (PROXY_PORT, PROXY_UPSTREAM, PROXY_CACHE_PATH, PROXY_CACHE_MAX_BYTES,
+    PROXY_METADATA_TTL_SECONDS, PROXY_METADATA_MAX_BYTES)
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+DEPOT CACHING PROXY
+
+Sits between the robots in a depot and the server so every image and ostree object is only pulled over the
+uplink once. Robots use it in place of the server, e.g. as the tuf target_base_url (set PRIMARY_TARGETS_PROXY
+for primary.py) or as the treehub base url. Requests are forwarded to the same path on the upstream.
+
+What is cached depends on the path:
+* content addressed objects never change, they are kept in an on disk LRU bounded by PROXY_CACHE_MAX_BYTES.
+  These are ostree objects (/objects/<2 chars>/<rest of sha256>.<type>), targets requested by hash
+  (/targets/<sha256>.<name>), whose content is checked against the hash before it is cached, and versioned
+  tuf metadata (<version>.<role>.json).
+* metadata that can change (timestamp.json and the other *.json, ostree refs, summary and config) is kept in
+  memory for PROXY_METADATA_TTL_SECONDS. Expired entries are dropped as new ones come in, and the bodies kept
+  take up no more than PROXY_METADATA_MAX_BYTES.
+* everything else (targets by name, pushes, manifests, ...) is streamed straight through without being held.
+
+Concurrent misses for the same path are collapsed, one request fetches from upstream and the rest wait for it.
+
+To try it against the mock server run `python server.py`, then `python cache_proxy.py [upstream] [port]` and
+fetch e.g. http://localhost:8002/image/timestamp.json. Hit and miss counts are at /_proxy/stats.
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+UPSTREAM_TIMEOUT_SECONDS = 30
+CHUNK_SIZE = 1024 * 1024
+
+OSTREE_OBJECT = re.compile(r'/objects/[0-9a-f]{2}/[0-9a-f]{62}\.[a-z]+$')
+HASHED_TARGET = re.compile(r'/targets/(?:.+/)?([0-9a-f]{64})\.[^/]+$')
+VERSIONED_METADATA = re.compile(r'/[0-9]+\.[a-z-]+\.json$')
+MUTABLE_METADATA = re.compile(r'(?:\.json|/refs/.+|/summary(?:\.sig)?|/config)$')
+
+# headers that describe the connection to upstream rather than the content
+HOP_HEADERS = {'connection', 'content-encoding', 'content-length', 'keep-alive', 'transfer-encoding'}
+
+
+app = Flask(__name__)
+
+metrics = {
+    'hits': 0,
+    'misses': 0,
+    'collapsed': 0,
+    'metadata_hits': 0,
+    'metadata_misses': 0,
+    'upstream_fetches': 0,
+    'upstream_errors': 0,
+    'evictions': 0,
+    'rejected': 0,
+}
+
+
+class UpstreamResponse():
+
+    def __init__(self, status, content_type, body=None):
+        self.status = status
+        self.content_type = content_type
+        # None when the body was written to the object cache
+        self.body = body
+
+
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+OBJECT CACHE
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+class ObjectCache():
+    '''
+    Immutable objects on disk, evicted least recently used first once they
+    take up more than max_bytes. Files are named by the sha256 of the path
+    they were requested with, recency survives restarts through their mtime
+    '''
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # file name -> size, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self._load()
+
+
+    def _path(self, name):
+        return os.path.join(self.root, name[:2], name)
+
+
+    def _load(self):
+        os.makedirs(self.root, exist_ok=True)
+        found = []
+
+        for entry in os.scandir(self.root):
+            if entry.is_file():
+                # a download that was interrupted
+                os.remove(entry.path)
+                continue
+            for cached in os.scandir(entry.path):
+                stat = cached.stat()
+                found.append((stat.st_mtime, cached.name, stat.st_size))
+
+        for _, name, size in sorted(found):
+            self.entries[name] = size
+            self.size += size
+
+        self._evict()
+
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.entries:
+            name, size = self.entries.popitem(last=False)
+            os.remove(self._path(name))
+            self.size -= size
+            metrics['evictions'] += 1
+
+
+    def open(self, name):
+        '''
+        An open file of a cached object, or None if it is not cached. Once
+        opened the file can be read even if it is evicted afterwards
+        '''
+        with self.lock:
+            if name not in self.entries:
+                return None
+            self.entries.move_to_end(name)
+            path = self._path(name)
+            os.utime(path)
+            return open(path, 'rb')
+
+
+    def tmp_path(self):
+        # next to the cache so it can be renamed into place
+        return os.path.join(self.root, f'{uuid.uuid4().hex}.tmp')
+
+
+    def put(self, name, tmp_path):
+        size = os.path.getsize(tmp_path)
+        with self.lock:
+            os.makedirs(os.path.dirname(self._path(name)), exist_ok=True)
+            os.replace(tmp_path, self._path(name))
+            self.size += size - self.entries.pop(name, 0)
+            self.entries[name] = size
+            self._evict()
+
+
+    def stats(self):
+        with self.lock:
+            return {'objects': len(self.entries), 'bytes': self.size, 'max_bytes': self.max_bytes}
+
+
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+COLLAPSED FETCHES
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+class MissCollapser():
+    '''
+    Runs one fetch per key at a time, callers asking for a key that is
+    already being fetched wait for that fetch and share its result
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = {}
+
+
+    def fetch(self, key, fetch):
+        with self.lock:
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self.inflight[key] = Future()
+
+        if not leader:
+            metrics['collapsed'] += 1
+            return future.result()
+
+        try:
+            result = fetch()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+
+
+
+object_cache = ObjectCache(PROXY_CACHE_PATH, PROXY_CACHE_MAX_BYTES)
+collapser = MissCollapser()
+
+# path -> (expires at, UpstreamResponse), soonest to expire first
+metadata_cache = OrderedDict()
+metadata_bytes = 0
+metadata_lock = threading.Lock()
+
+upstream = PROXY_UPSTREAM
+
+
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+HELPERS
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+def _upstream_url(path):
+    url = f"{upstream.rstrip('/')}/{path}"
+    if request.query_string:
+        url += '?' + request.query_string.decode('utf-8')
+    return url
+
+
+
+def _is_immutable(path):
+    return bool(OSTREE_OBJECT.search(path) or HASHED_TARGET.search(path) or VERSIONED_METADATA.search(path))
+
+
+
+def _is_metadata(path):
+    return bool(MUTABLE_METADATA.search(path))
+
+
+
+def _guess_content_type(path):
+    return 'application/json' if path.endswith('.json') else 'application/octet-stream'
+
+
+
+def fetch_object(path, name):
+    '''
+    Stream an immutable object from upstream into the object cache. Targets
+    requested by hash are only cached if the content matches the hash
+    '''
+    metrics['upstream_fetches'] += 1
+    res = requests.get(_upstream_url(path), stream=True, timeout=UPSTREAM_TIMEOUT_SECONDS)
+
+    with res:
+        if res.status_code != 200:
+            return UpstreamResponse(res.status_code, res.headers.get('content-type'), res.content)
+
+        tmp_path = object_cache.tmp_path()
+        sha256 = hashlib.sha256()
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in res.iter_content(CHUNK_SIZE):
+                    sha256.update(chunk)
+                    f.write(chunk)
+
+            hashed_target = HASHED_TARGET.search(path)
+            if hashed_target and hashed_target.group(1) != sha256.hexdigest():
+                metrics['rejected'] += 1
+                os.remove(tmp_path)
+                return UpstreamResponse(502, 'text/plain', b'upstream content does not match its hash')
+
+            object_cache.put(name, tmp_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    return UpstreamResponse(200, _guess_content_type(path))
+
+
+
+def fetch_metadata(path):
+    global metadata_bytes
+
+    metrics['upstream_fetches'] += 1
+    res = requests.get(_upstream_url(path), timeout=UPSTREAM_TIMEOUT_SECONDS)
+    response = UpstreamResponse(res.status_code, res.headers.get('content-type'), res.content)
+
+    # a body that would take up the whole cache is served but not kept
+    if res.status_code == 200 and len(response.body) <= PROXY_METADATA_MAX_BYTES:
+        now = time.monotonic()
+        with metadata_lock:
+            replaced = metadata_cache.pop(path, None)
+            if replaced:
+                metadata_bytes -= len(replaced[1].body)
+            metadata_cache[path] = (now + PROXY_METADATA_TTL_SECONDS, response)
+            metadata_bytes += len(response.body)
+            # every entry is kept as long, so the ones inserted first expire first
+            while metadata_cache and (metadata_bytes > PROXY_METADATA_MAX_BYTES or next(iter(metadata_cache.values()))[0] <= now):
+                _, (_, evicted) = metadata_cache.popitem(last=False)
+                metadata_bytes -= len(evicted.body)
+
+    return response
+
+
+
+def serve_object(path):
+    name = hashlib.sha256(path.encode('utf-8')).hexdigest()
+
+    f = object_cache.open(name)
+    if f is not None:
+        metrics['hits'] += 1
+    else:
+        metrics['misses'] += 1
+        fetched = collapser.fetch(path, lambda: fetch_object(path, name))
+        if fetched.body is not None:
+            return Response(fetched.body, fetched.status, content_type=fetched.content_type)
+        f = object_cache.open(name)
+        if f is None:
+            # evicted already, the object is bigger than the cache or the cache is thrashing
+            return pass_through(path)
+
+    response = send_file(f, mimetype=_guess_content_type(path), max_age=365 * 24 * 60 * 60)
+    response.headers['Cache-Control'] += ', immutable'
+    return response
+
+
+
+def serve_metadata(path):
+    with metadata_lock:
+        cached = metadata_cache.get(path)
+
+    if cached and cached[0] > time.monotonic():
+        metrics['metadata_hits'] += 1
+        response = cached[1]
+    else:
+        metrics['metadata_misses'] += 1
+        response = collapser.fetch(path, lambda: fetch_metadata(path))
+
+    headers = {'Cache-Control': f'max-age={PROXY_METADATA_TTL_SECONDS}'} if response.status == 200 else {}
+    return Response(response.body, response.status, content_type=response.content_type, headers=headers)
+
+
+
+def pass_through(path):
+    '''
+    Forward the request upstream and stream the response back a chunk at a
+    time, so nothing passed through is held in memory whole
+    '''
+    res = requests.request(
+        request.method,
+        _upstream_url(path),
+        data=request.get_data(),
+        headers={k: v for k, v in request.headers.items() if k.lower() not in HOP_HEADERS and k.lower() != 'host'},
+        stream=True,
+        timeout=UPSTREAM_TIMEOUT_SECONDS)
+
+    headers = {k: v for k, v in res.headers.items() if k.lower() not in HOP_HEADERS}
+    response = Response(res.iter_content(CHUNK_SIZE), res.status_code, headers=headers)
+    # also when the body is never read, e.g. for a HEAD
+    response.call_on_close(res.close)
+    return response
+
+
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+PROXY API
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+@app.route('/_proxy/stats')
+def proxy_stats():
+    with metadata_lock:
+        metadata_entries = len(metadata_cache)
+        metadata_size = metadata_bytes
+    return {**metrics, 'cache': object_cache.stats(), 'metadata_entries': metadata_entries, 'metadata_bytes': metadata_size}
+
+
+
+@app.route('/', defaults={'path': ''}, methods=['GET', 'POST', 'PUT', 'DELETE'])
+@app.route('/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
+def proxy(path):
+    try:
+        if request.method not in ('GET', 'HEAD'):
+            return pass_through(path)
+        if _is_immutable('/' + path):
+            return serve_object(path)
+        if _is_metadata('/' + path):
+            return serve_metadata(path)
+        return pass_through(path)
+
+    except requests.exceptions.RequestException as e:
+        metrics['upstream_errors'] += 1
+        print(stylize(f'unable to reach upstream for /{path}: {e}', fg('red')))
+        return 'upstream unavailable', 502
+
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        upstream = sys.argv[1]
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else PROXY_PORT
+
+    print(stylize(f'proxying {upstream} on port {port}, caching in {PROXY_CACHE_PATH}', fg('green')))
+    app.run(port=port, threaded=True)
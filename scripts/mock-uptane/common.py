@@ -1,9 +1,13 @@
 import os
 import json
 from datetime import datetime, timedelta
-from securesystemslib.keys import generate_rsa_key
-from securesystemslib.formats import encode_canonical
 import hashlib
+import random
+from functools import lru_cache
+from urllib.parse import urlsplit
+from canonical import encode_canonical
+# securesystemslib and tuf are imported by the functions that need them. The primary imports
+# this module on boot and pulling in cryptography here would slow every start down
 
 '''''''''''''''''''''''''''''''''''''''''''''''''''''''''
 CONSTANTS
@@ -16,12 +20,19 @@ SECONDARY_ECU_SERIAL = 'seed-secondary-ecu'
 
 KEYS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), '.keys')
 PRIMARY_FS_ROOT_PATH = os.path.join(os.path.dirname(__file__), 'primary-fs')
+DB_ROOT_PATH = os.environ.get('SERVER_DB_PATH', os.path.join(os.path.dirname(__file__), 'db'))
+BULK_KEYS_PATH = os.path.join(KEYS_PATH, 'bulk')
 
 IMAGE_REPO_PORT = 8001
 DIRECTOR_REPO_PORT = 8001
 IMAGE_REPO_HOST = f'http://localhost:{IMAGE_REPO_PORT}/api/v0/image/{TEAM_ID}'
 DIRECTOR_REPO_HOST = f'http://localhost:{DIRECTOR_REPO_PORT}/api/v0/director/{TEAM_ID}/robots/{ROBOT_ID}'
 
+# Mirrors of each repo the primary fetches metadata and targets from, see mirrors.py. The repo itself comes first,
+# more can be added as comma separated base urls
+IMAGE_REPO_MIRRORS = [IMAGE_REPO_HOST] + [url for url in os.environ.get('PRIMARY_IMAGE_MIRRORS', '').split(',') if url]
+DIRECTOR_REPO_MIRRORS = [DIRECTOR_REPO_HOST] + [url for url in os.environ.get('PRIMARY_DIRECTOR_MIRRORS', '').split(',') if url]
+
 IMAGE_REPO_NAME = 'image-repo'
 IMAGE_REPO_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'primary-fs', IMAGE_REPO_NAME)
 IMAGE_REPO_META_DIR = os.path.join(IMAGE_REPO_DIR, 'metadata')
@@ -32,6 +43,91 @@ DIRECTOR_REPO_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'p
 DIRECTOR_REPO_META_DIR = os.path.join(DIRECTOR_REPO_DIR, 'metadata')
 DIRECTOR_REPO_TARGETS_DIR = os.path.join(DIRECTOR_REPO_DIR, 'targets')
 
+# How long before expiry the server re-signs metadata, the window re-signs are spread over and the max rate
+RESIGN_LEAD_SECONDS = 2 * 60 * 60
+RESIGN_SPREAD_SECONDS = 30 * 60
+RESIGN_MAX_PER_SECOND = 20
+
+# Where vehicle manifests wait to be processed and how many workers process them, see manifest_queue.py
+MANIFEST_QUEUE_PATH = os.path.join(DB_ROOT_PATH, 'manifest-queue')
+MANIFEST_WORKERS = os.cpu_count()
+
+# Where large images are assembled while they are uploaded in chunks, and the chunk size, see image_uploads.py
+UPLOADS_PATH = os.path.join(DB_ROOT_PATH, 'uploads')
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_MAX_CHUNK_SIZE = 64 * 1024 * 1024
+UPLOAD_WORKERS = 8
+# The header a chunk's sha256 is sent in
+CHUNK_SHA256_HEADER = 'X-Chunk-Sha256'
+
+# Where bulk image assignments are kept, how many workers sign for them and how many vehicles a second, see
+# assignments.py
+ASSIGNMENTS_PATH = os.path.join(DB_ROOT_PATH, 'assignments')
+ASSIGNMENT_WORKERS = os.cpu_count()
+ASSIGNMENT_VEHICLES_PER_SECOND = 20
+ASSIGNMENT_BURST = 20
+# Vehicles assigned the same image within this many seconds share one signed copy of their director metadata
+VEHICLE_METADATA_REUSE_SECONDS = 60
+
+# How many requests the server handles at once and how many each vehicle may make, see admission.py
+ADMISSION_MAX_CONCURRENT = 32
+VEHICLE_REQUESTS_PER_SECOND = 5
+VEHICLE_REQUEST_BURST = 20
+# Vehicles name themselves with this header on requests that don't have their vin in the path
+VEHICLE_ID_HEADER = 'X-Vehicle-Id'
+
+# How clients back off when the server turns them away
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30
+BACKOFF_ATTEMPTS = 5
+
+# Where the server records a trace of the requests it answers, off unless set, see request_trace.py
+SERVER_TRACE_PATH = os.environ.get('SERVER_TRACE_PATH')
+
+# How many report counters and nonces the director remembers per ecu, for how long and for how many ecus, see
+# replay_window.py
+REPLAY_WINDOW_ENTRIES = 16
+REPLAY_WINDOW_SECONDS = 7 * 24 * 60 * 60
+REPLAY_MAX_ECUS = 200000
+# attestation requests that don't name their vehicle share one window of this many nonces
+REPLAY_GLOBAL_ENTRIES = 4096
+
+# How long the server waits for concurrent metadata writes to join a group commit
+METADATA_COMMIT_WINDOW_SECONDS = 0.005
+
+# How many processes serve requests and where, 1 runs the flask dev server instead, see server_workers.py
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', 1))
+SERVER_HOST = os.environ.get('SERVER_HOST', 'localhost')
+SERVER_PORT = int(os.environ.get('SERVER_PORT', 5000))
+# How often the worker running the background work picks up what the other workers queued
+WORKER_RESCAN_SECONDS = 1
+# Where the workers share the metadata they serve and how big it gets, see metadata_store.py. A tmpfs such as
+# /dev/shm keeps the kernel from writing it back to disk
+METADATA_STORE_PATH = os.environ.get('METADATA_STORE_PATH', os.path.join(DB_ROOT_PATH, 'metadata-store'))
+METADATA_STORE_BYTES = int(os.environ.get('METADATA_STORE_BYTES', 256 * 1024 ** 2))
+
+# Oldest targets version, counted back from the current one, the server will send a delta against
+DELTA_MAX_VERSIONS = 50
+
+# The depot caching proxy, see cache_proxy.py. Robots download images through it when PRIMARY_TARGETS_PROXY is set
+PROXY_PORT = 8002
+PROXY_UPSTREAM = os.environ.get('PROXY_UPSTREAM', 'http://localhost:5000')
+PROXY_CACHE_PATH = os.environ.get('PROXY_CACHE_PATH', os.path.join(os.path.dirname(__file__), 'proxy-cache'))
+PROXY_CACHE_MAX_BYTES = int(os.environ.get('PROXY_CACHE_MAX_BYTES', 10 * 1024 ** 3))
+PROXY_METADATA_TTL_SECONDS = 30
+PROXY_METADATA_MAX_BYTES = int(os.environ.get('PROXY_METADATA_MAX_BYTES', 64 * 1024 ** 2))
+TARGETS_PROXY_URL = os.environ.get('PRIMARY_TARGETS_PROXY')
+
+# Where the primary writes update cycle timing spans and cProfile captures, both off unless set
+TIMING_LOG_PATH = os.environ.get('PRIMARY_TIMING_LOG')
+PROFILE_DIR = os.environ.get('PRIMARY_PROFILE_DIR')
+
+# Secondaries the primary distributes time, metadata and images to, see secondaries.py
+SECONDARY_PORT = 9001
+SECONDARIES = [
+    { 'ecu_serial': SECONDARY_ECU_SERIAL, 'host': 'localhost', 'port': SECONDARY_PORT },
+]
+
 
 
 '''''''''''''''''''''''''''''''''''''''''''''''''''''''''
@@ -46,6 +142,89 @@ def _in(days):
     return datetime.utcnow().replace(microsecond=0) + timedelta(days=days)
 
 
+# Installed image file info keyed by path, along with the identity of the file it was computed from
+_file_info_cache = {}
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def get_file_info(file_path):
+    '''
+    Length, sha256 and sha512 of a file, computed in one streaming pass. The 
+    result is cached until the file's size, mtime or inode change so repeat 
+    calls on an unchanged image only cost a stat
+    '''
+    stat = os.stat(file_path)
+    identity = (stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev)
+
+    cached = _file_info_cache.get(file_path)
+    if cached and cached[0] == identity:
+        return cached[1]
+
+    sha256 = hashlib.sha256()
+    sha512 = hashlib.sha512()
+    length = 0
+    buf = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buf)
+
+    with open(file_path, 'rb') as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            sha256.update(view[:n])
+            sha512.update(view[:n])
+            length += n
+
+    file_info = {
+        'length': length,
+        'hashes': {
+            'sha256': sha256.hexdigest(),
+            'sha512': sha512.hexdigest(),
+        }
+    }
+
+    _file_info_cache[file_path] = (identity, file_info)
+    return file_info
+
+
+def get_meta_file(version, data):
+    '''
+    Snapshot entry for a metadata file. It carries the length and hash of the
+    file so a client that rebuilt the file from a delta can check it
+    '''
+    from tuf.api.metadata import MetaFile
+
+    return MetaFile(version, length=len(data), hashes={'sha256': hashlib.sha256(data).hexdigest()})
+
+
+def proxied(url):
+    '''
+    url with its scheme and host swapped for the targets proxy, if there is one
+    '''
+    if not TARGETS_PROXY_URL:
+        return url
+    return TARGETS_PROXY_URL.rstrip('/') + urlsplit(url).path
+
+
+def backoff_delay(attempt, retry_after=None):
+    '''
+    Seconds to wait before retry number `attempt` (from 0) of a request the
+    server turned away. At least what the server asked for, plus full jitter
+    over an exponential backoff so a fleet turned away together does not all
+    come back together
+    '''
+    ceiling = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt)
+    return (retry_after or 0) + random.uniform(0, ceiling)
+
+
+def parse_retry_after(value):
+    # only the delay in seconds form is sent by the server
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+
 def pretty_dict(d, indent=0):
    for key, value in d.items():
       print('\t' * indent + str(key))
@@ -61,6 +240,8 @@ KEYS
 '''''''''''''''''''''''''''''''''''''''''''''''''''''''''
 # Generate an rsa keypair and write the two keys to local key storage for testing
 def create_and_write_key_pair(key_name):
+    from securesystemslib.keys import generate_rsa_key
+
     key = generate_rsa_key(bits=2048, scheme='rsassa-pss-sha256')
     pub_key_path = os.path.join(KEYS_PATH, f"{key_name}-public.pem")
     priv_key_path = os.path.join(KEYS_PATH, f"{key_name}-private.pem")
@@ -70,16 +251,34 @@ def create_and_write_key_pair(key_name):
         pub.write(key['keyval']['private'])
 
 
+# Where a bulk generated ecu key lives, keys are sharded into 256 directories by a hash of the serial
+def bulk_key_dir(ecu_serial, root=BULK_KEYS_PATH):
+    return os.path.join(root, hashlib.sha256(ecu_serial.encode('utf-8')).hexdigest()[:2])
+
+
 #Read a pem key from local key storage
 def load_pem_key(key_name):
     with open(os.path.join(KEYS_PATH, f'{key_name}.pem'), 'r') as f:
         return f.read()
 
 
+#Read a private pem key from local key storage as a securesystemslib key
+def _load_key(key_name):
+    from securesystemslib.keys import import_rsakey_from_pem
+
+    return import_rsakey_from_pem(load_pem_key(f'{key_name}-private'), scheme='rsassa-pss-sha256')
+
+
 #Convert a private pem key to a TUFKey format
 def generate_priv_tuf_key(priv_key):
     
-    tuf_key = {
+    tuf_key = _priv_tuf_key(priv_key)
+    tuf_key['keyid'] = _priv_tuf_key_id(priv_key)
+    return tuf_key
+
+
+def _priv_tuf_key(priv_key):
+    return {
         'keytype': 'rsa',
         'scheme': 'rsassa-pss-sha256',
         'keyval': {
@@ -88,7 +287,8 @@ def generate_priv_tuf_key(priv_key):
         }
     }
 
-    key_id = hashlib.sha512(encode_canonical(tuf_key).encode('utf-8')).hexdigest()
 
-    tuf_key['keyid'] = key_id
-    return tuf_key
\ No newline at end of file
+#The key id only depends on the pem, so it is only computed once per key
+@lru_cache(maxsize=1024)
+def _priv_tuf_key_id(priv_key):
+    return hashlib.sha512(encode_canonical(_priv_tuf_key(priv_key)).encode('utf-8')).hexdigest()
\ No newline at end of file
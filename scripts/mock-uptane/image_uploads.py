@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+CHUNKED IMAGE UPLOADS
+
+Images too big to post inline are uploaded in fixed size chunks, in any order and several at once, see
+upload_image.py. Each upload is a directory under UPLOADS_PATH:
+* upload.json   name, length and chunk size of the image
+* data          the image, preallocated to its full length, every chunk is written straight to its offset
+* received      one line per chunk that is on disk, "<index> <sha256>", appended once the chunk is fsynced
+
+A chunk is only accepted if it has the length its index calls for and matches the sha256 it was sent with.
+Anything in `received` has been fsynced, so an upload interrupted on either side is resumed by asking which
+chunks the server has and sending the rest. That survives a server restart too.
+
+The image's sha256 is worked out while chunks arrive. sha256 has to see the image in order, so whenever the
+chunk after the hashed prefix lands the prefix is extended over it and any chunks after it that are already
+in. Once the last chunk is in, completing the upload only has whatever is left of the prefix to hash, usually
+nothing, before the image can be signed. The running hash is kept in memory, after a server restart it starts
+again from the beginning of the image.
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+class UploadError(Exception):
+
+    def __init__(self, status, reason):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+
+
+
+class Upload():
+
+    def __init__(self, path, name, length, chunk_size, received=None):
+        self.path = path
+        self.name = name
+        self.length = length
+        self.chunk_size = chunk_size
+        self.chunks = max(1, -(-length // chunk_size))
+        self.lock = threading.Lock()
+        # the fd is only closed once nobody is reading or writing through it
+        self.idle = threading.Condition(self.lock)
+        self.using_fd = 0
+        self.closed = False
+        # index -> sha256 of every chunk on disk
+        self.received = received or {}
+        # held by whoever is extending the hashed prefix
+        self.hash_lock = threading.Lock()
+        self.sha256 = hashlib.sha256()
+        self.hashed_chunks = 0
+        self.fd = os.open(os.path.join(path, 'data'), os.O_RDWR)
+
+
+    @contextmanager
+    def _fd(self):
+        with self.lock:
+            if self.closed:
+                # a late retry of a chunk of an upload that was completed or removed
+                raise UploadError(404, f'upload of {self.name} is closed')
+            self.using_fd += 1
+        try:
+            yield self.fd
+        finally:
+            with self.lock:
+                self.using_fd -= 1
+                self.idle.notify_all()
+
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.length - index * self.chunk_size)
+
+
+    def write_chunk(self, index, data, sha256):
+        if not 0 <= index < self.chunks:
+            raise UploadError(400, f'chunk {index} out of range, the image has {self.chunks} chunks')
+        if len(data) != self.chunk_length(index):
+            raise UploadError(400, f'chunk {index} should be {self.chunk_length(index)} bytes, got {len(data)}')
+        digest = hashlib.sha256(data).hexdigest()
+        if sha256 and digest != sha256.lower():
+            raise UploadError(400, f'chunk {index} does not match its sha256')
+
+        with self.lock:
+            if index in self.received:
+                # sent again after a timeout, the chunk is already in
+                return
+        with self._fd() as fd:
+            os.pwrite(fd, data, index * self.chunk_size)
+            os.fdatasync(fd)
+
+        with self.lock:
+            if index in self.received:
+                return
+            if self.closed:
+                raise UploadError(404, f'upload of {self.name} is closed')
+            with open(os.path.join(self.path, 'received'), 'a') as f:
+                f.write(f'{index} {digest}\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.received[index] = digest
+
+        self.extend_hash()
+
+
+    def extend_hash(self, wait=False):
+        '''
+        Hash the chunks that follow the hashed prefix and are in. Whoever is
+        already doing it picks up new chunks as well, so without `wait` the
+        caller leaves it to them
+        '''
+        while self.hash_lock.acquire(blocking=wait):
+            try:
+                while True:
+                    with self.lock:
+                        if self.hashed_chunks not in self.received:
+                            break
+                        index = self.hashed_chunks
+                    with self._fd() as fd:
+                        self.sha256.update(os.pread(fd, self.chunk_length(index), index * self.chunk_size))
+                    with self.lock:
+                        self.hashed_chunks += 1
+            finally:
+                self.hash_lock.release()
+
+            # a chunk that landed after the last check and before the release would be left behind
+            with self.lock:
+                if self.hashed_chunks not in self.received:
+                    return
+
+
+    def missing(self):
+        with self.lock:
+            return [index for index in range(self.chunks) if index not in self.received]
+
+
+    def status(self):
+        with self.lock:
+            received = sorted(self.received)
+            hashed_bytes = min(self.length, self.hashed_chunks * self.chunk_size)
+        return {
+            'name': self.name,
+            'length': self.length,
+            'chunk_size': self.chunk_size,
+            'chunks': self.chunks,
+            'received': received,
+            'hashed_bytes': hashed_bytes,
+        }
+
+
+    def finish(self):
+        '''
+        Length, hashes and path of the assembled image once every chunk is in
+        '''
+        missing = self.missing()
+        if missing:
+            raise UploadError(409, f'{len(missing)} chunks missing, first {missing[:10]}')
+
+        self.extend_hash(wait=True)
+        return self.length, {'sha256': self.sha256.hexdigest()}, os.path.join(self.path, 'data')
+
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            while self.using_fd:
+                self.idle.wait()
+        os.close(self.fd)
+
+
+
+class UploadStore():
+
+    def __init__(self, root, default_chunk_size, max_chunk_size):
+        self.root = root
+        self.default_chunk_size = default_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.lock = threading.Lock()
+        # upload id -> Upload, loaded from disk when first used after a restart
+        self.uploads = {}
+
+
+    def create(self, name, length, chunk_size=None):
+        chunk_size = chunk_size or self.default_chunk_size
+        if not isinstance(name, str) or not name or '/' in name or name.startswith('.'):
+            raise UploadError(400, f'invalid target name {name!r}')
+        if not isinstance(length, int) or length < 0:
+            raise UploadError(400, 'length must be a non negative integer')
+        if not isinstance(chunk_size, int) or not 0 < chunk_size <= self.max_chunk_size:
+            raise UploadError(400, f'chunk_size must be between 1 and {self.max_chunk_size}')
+
+        upload_id = uuid.uuid4().hex
+        path = os.path.join(self.root, upload_id)
+        os.makedirs(path)
+        with open(os.path.join(path, 'data'), 'wb') as f:
+            f.truncate(length)
+        with open(os.path.join(path, 'upload.json'), 'w') as f:
+            f.write(json.dumps({'name': name, 'length': length, 'chunk_size': chunk_size, 'created_at': time.time()}))
+
+        upload = Upload(path, name, length, chunk_size)
+        with self.lock:
+            self.uploads[upload_id] = upload
+        return upload_id, upload
+
+
+    def get(self, upload_id):
+        with self.lock:
+            upload = self.uploads.get(upload_id)
+            if upload:
+                return upload
+
+            path = os.path.join(self.root, upload_id)
+            if len(upload_id) != 32 or not os.path.isfile(os.path.join(path, 'upload.json')):
+                raise UploadError(404, f'no upload {upload_id}')
+
+            with open(os.path.join(path, 'upload.json'), 'r') as f:
+                info = json.loads(f.read())
+            received = {}
+            if os.path.isfile(os.path.join(path, 'received')):
+                with open(os.path.join(path, 'received'), 'r') as f:
+                    for line in f:
+                        # the last line may be torn if the server died writing it, that chunk is sent again
+                        parts = line.split()
+                        if len(parts) == 2 and line.endswith('\n'):
+                            received[int(parts[0])] = parts[1]
+
+            upload = self.uploads[upload_id] = Upload(path, info['name'], info['length'], info['chunk_size'], received)
+            return upload
+
+
+    def remove(self, upload_id):
+        with self.lock:
+            upload = self.uploads.pop(upload_id, None)
+        if upload:
+            upload.close()
+        shutil.rmtree(os.path.join(self.root, upload_id), ignore_errors=True)
@@ -0,0 +1,222 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from canonical import encode_canonical
+from common import REPLAY_WINDOW_ENTRIES, REPLAY_WINDOW_SECONDS, REPLAY_MAX_ECUS
+from replay_window import ReplayWindow, storable
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+VEHICLE MANIFEST CHECKS
+
+Runs the checks on a vehicle manifest as a pipeline of stages. The cheap structural, inventory, attack and
+installed image checks run first so a bad manifest is rejected before any crypto is done. The ecu version report signatures are then
+verified in parallel, pyca/cryptography releases the GIL while verifying so a thread pool spreads them across
+cores. Public key objects are cached per ecu serial so the pem of each ecu is only parsed once. Last, every
+report_counter has to be one the ecu has not sent recently, see replay_window.py.
+
+The first failing stage raises ManifestRejected. On success the time each stage took is returned.
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+VERIFY_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+PSS_PADDING = padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.AUTO)
+
+# ecu serial -> (pem, public key object)
+_public_keys = {}
+
+report_counters = ReplayWindow(REPLAY_WINDOW_ENTRIES, REPLAY_WINDOW_SECONDS, REPLAY_MAX_ECUS)
+
+
+class ManifestRejected(Exception):
+
+    def __init__(self, stage, reason):
+        super().__init__(f'{stage}: {reason}')
+        self.stage = stage
+        self.reason = reason
+
+
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+HELPERS
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+def _get_public_key(ecu_serial, pem):
+    cached = _public_keys.get(ecu_serial)
+    if cached and cached[0] == pem:
+        return cached[1]
+
+    try:
+        public_key = serialization.load_pem_public_key(pem.encode('utf-8'))
+    except ValueError:
+        raise ManifestRejected('keys', f'public key of {ecu_serial} could not be loaded')
+    _public_keys[ecu_serial] = (pem, public_key)
+    return public_key
+
+
+
+def _verify(public_key, signatures, signed):
+    '''
+    True if the first signature (we assume one signature per document) is a
+    valid rsassa-pss-sha256 signature of the canonical form of signed
+    '''
+    try:
+        sig = bytes.fromhex(signatures[0]['sig'])
+        public_key.verify(sig, encode_canonical(signed).encode('utf-8'), PSS_PADDING, hashes.SHA256())
+        return True
+    except (InvalidSignature, ValueError, KeyError, IndexError, TypeError):
+        return False
+
+
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+STAGES
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+def check_structure(vehicle, manifest, sent_targets):
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('signed'), dict):
+        raise ManifestRejected('structure', 'manifest has no signed portion')
+    if not isinstance(manifest.get('signatures'), list) or not manifest['signatures']:
+        raise ManifestRejected('structure', 'manifest is not signed')
+
+    signed = manifest['signed']
+    reports = signed.get('ecu_version_manifests')
+
+    if not isinstance(reports, dict) or not reports:
+        raise ManifestRejected('structure', 'manifest has no ecu version reports')
+    if signed.get('primary_ecu_serial') not in reports:
+        raise ManifestRejected('structure', 'manifest has no version report for the primary')
+
+    for ecu_serial, report in reports.items():
+        if not isinstance(report, dict) or not isinstance(report.get('signed'), dict) or not report.get('signatures'):
+            raise ManifestRejected('structure', f'version report for {ecu_serial} is malformed')
+        if report['signed'].get('ecu_serial') != ecu_serial:
+            raise ManifestRejected('structure', f'version report for {ecu_serial} names another ecu')
+        if not storable(report['signed'].get('report_counter')):
+            raise ManifestRejected('structure', f'version report for {ecu_serial} has no report counter')
+        installed = report['signed'].get('installed_image')
+        if not isinstance(installed, dict) or not isinstance(installed.get('filepath'), str):
+            raise ManifestRejected('structure', f'version report for {ecu_serial} has no installed image')
+        fileinfo = installed.get('fileinfo')
+        if (not isinstance(fileinfo, dict) or not isinstance(fileinfo.get('length'), int)
+                or not isinstance(fileinfo.get('hashes'), dict)):
+            raise ManifestRejected('structure', f'version report for {ecu_serial} has no installed image info')
+
+
+
+def check_inventory(vehicle, manifest, sent_targets):
+    registered = {ecu['ecu_serial'] for ecu in vehicle['ecus']}
+    reported = set(manifest['signed']['ecu_version_manifests'])
+
+    if reported - registered:
+        raise ManifestRejected('inventory', f'unknown ecus in manifest: {sorted(reported - registered)}')
+    if registered - reported:
+        raise ManifestRejected('inventory', f'ecus missing from manifest: {sorted(registered - reported)}')
+
+
+
+def check_attacks(vehicle, manifest, sent_targets):
+    for ecu_serial, report in manifest['signed']['ecu_version_manifests'].items():
+        if report['signed'].get('attacks_detected'):
+            raise ManifestRejected('attacks', f"{ecu_serial} reported an attack: {report['signed']['attacks_detected']}")
+
+
+
+def check_vehicle_signature(vehicle, manifest, sent_targets):
+    primary_serial = manifest['signed']['primary_ecu_serial']
+    ecu = next(ecu for ecu in vehicle['ecus'] if ecu['ecu_serial'] == primary_serial)
+    public_key = _get_public_key(primary_serial, ecu['public_key'])
+
+    if not _verify(public_key, manifest['signatures'], manifest['signed']):
+        raise ManifestRejected('vehicle_signature', 'manifest is not signed by the primary')
+
+
+
+def check_ecu_signatures(vehicle, manifest, sent_targets):
+    public_keys = {ecu['ecu_serial']: _get_public_key(ecu['ecu_serial'], ecu['public_key']) for ecu in vehicle['ecus']}
+    reports = manifest['signed']['ecu_version_manifests']
+
+    futures = {
+        ecu_serial: VERIFY_POOL.submit(_verify, public_keys[ecu_serial], report['signatures'], report['signed'])
+        for ecu_serial, report in reports.items()
+    }
+
+    invalid = sorted(ecu_serial for ecu_serial, future in futures.items() if not future.result())
+    if invalid:
+        raise ManifestRejected('ecu_signatures', f'invalid version report signatures from {invalid}')
+
+
+
+def check_installed_images(vehicle, manifest, sent_targets):
+    '''
+    If an ecu reports an image the director sent down, it has to be the same
+    image. Anything else is still waiting to be installed
+    '''
+    for ecu_serial, report in manifest['signed']['ecu_version_manifests'].items():
+        installed = report['signed']['installed_image']
+        sent = sent_targets.get(os.path.basename(installed['filepath']))
+        if sent is None:
+            continue
+        if installed['fileinfo']['length'] != sent['length']:
+            raise ManifestRejected('installed_images', f'{ecu_serial} has a different length than was sent')
+        for algo, digest in installed['fileinfo']['hashes'].items():
+            if algo in sent['hashes'] and sent['hashes'][algo] != digest:
+                raise ManifestRejected('installed_images', f'{ecu_serial} has different hashes than was sent')
+
+
+
+def check_replays(vehicle, manifest, sent_targets):
+    '''
+    Runs once the reports are known to come from their ecus, so only counters
+    of genuine reports are remembered
+    '''
+    reports = manifest['signed']['ecu_version_manifests']
+    replayed = report_counters.claim([(ecu_serial, report['signed']['report_counter']) for ecu_serial, report in reports.items()])
+    if replayed:
+        raise ManifestRejected('replays', f'replayed version reports from {sorted(ecu_serial for ecu_serial, _ in replayed)}')
+
+
+
+STAGES = [
+    ('structure', check_structure),
+    ('inventory', check_inventory),
+    ('attacks', check_attacks),
+    ('installed_images', check_installed_images),
+    ('vehicle_signature', check_vehicle_signature),
+    ('ecu_signatures', check_ecu_signatures),
+    ('replays', check_replays),
+]
+
+
+
+def check_vehicle_manifest(vehicle, manifest, sent_targets=None):
+    '''
+    Run every stage against the manifest. sent_targets are the targets (path ->
+    fileinfo) the director last sent to this vehicle. Returns the time in ms
+    each stage took, raises ManifestRejected from the first failing stage with
+    the timings so far attached
+    '''
+    sent_targets = sent_targets or {}
+    timings = {}
+
+    for name, stage in STAGES:
+        start = time.perf_counter()
+        try:
+            stage(vehicle, manifest, sent_targets)
+        except ManifestRejected as e:
+            e.timings = timings
+            raise
+        finally:
+            timings[name] = round((time.perf_counter() - start) * 1000, 3)
+
+    return timings
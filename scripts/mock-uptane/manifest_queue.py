@@ -0,0 +1,252 @@
+import os
+import time
+import uuid
+import json
+import threading
+from collections import deque
+from metadata_writer import MetadataTransaction, committer
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+MANIFEST INGEST QUEUE
+
+Vehicle manifests are appended to a queue on disk and acknowledged straight away, a pool of workers processes
+them in the background. Each manifest is a file under <queue dir>/<vin>/, named by the time it was queued, and
+is committed through the metadata writer so it has been fsynced before the vehicle is told it was accepted.
+Whatever is left in the queue when the server stops is picked up again when it starts.
+
+A vehicle is only ever handled by one worker at a time, so its manifests are processed in the order they
+arrived. When several manifests from one vehicle are waiting they are handed to the worker together, oldest
+first, and the handler decides what to do with them (the director only processes the newest one that passes
+its checks).
+
+The result of the last manifests of each vehicle is kept in <queue dir>/<vin>/result as well. In a multi worker
+deployment only one worker processes the queue, it picks up the manifests the others queued with rescan() and
+any of them can answer with the result.
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+class ManifestQueue():
+
+    def __init__(self, root, handler, workers):
+        '''
+        handler is called with a vin and a list of its queued manifests, oldest
+        first, and returns a result that is kept as the vehicle's last result
+        '''
+        self.root = root
+        self.handler = handler
+        self.workers = workers
+        self.condition = threading.Condition()
+        # vins that have manifests waiting and no worker on them, in the order they became ready
+        self.ready = deque()
+        # the vins in ready, the vins a worker is on and those of them that had more manifests arrive since
+        self.scheduled = set()
+        self.active = set()
+        self.dirty = set()
+        # vin -> time its oldest waiting manifest was queued
+        self.oldest = {}
+        self.depth = 0
+        self.results = {}
+        self.metrics = {
+            'queued': 0,
+            'processed': 0,
+            'coalesced': 0,
+            'errors': 0,
+            'last_lag_seconds': 0,
+            'max_lag_seconds': 0,
+        }
+
+
+    def _vin_dir(self, vin):
+        return os.path.join(self.root, vin)
+
+
+    def _result_path(self, vin):
+        return os.path.join(self._vin_dir(vin), 'result')
+
+
+    def _queued_files(self, vin):
+        try:
+            return sorted(name for name in os.listdir(self._vin_dir(vin)) if name.endswith('.json'))
+        except FileNotFoundError:
+            return []
+
+
+    def _schedule(self, vin):
+        # caller holds the condition
+        if vin in self.active:
+            self.dirty.add(vin)
+        elif vin not in self.scheduled:
+            self.scheduled.add(vin)
+            self.ready.append(vin)
+            self.condition.notify()
+
+
+    def enqueue(self, vin, manifest):
+        '''
+        Durably queue a manifest, returns its id once it is on disk
+        '''
+        queued_at = time.time()
+        manifest_id = f'{time.time_ns():020d}-{uuid.uuid4().hex[:8]}'
+        os.makedirs(self._vin_dir(vin), exist_ok=True)
+
+        # counted before it is on disk, where a worker could pick it up, so depth never goes negative
+        with self.condition:
+            self.depth += 1
+
+        txn = MetadataTransaction()
+        txn.stage(os.path.join(self._vin_dir(vin), f'{manifest_id}.json'), json.dumps(manifest).encode('utf-8'))
+        try:
+            committer.commit(txn)
+        except OSError:
+            with self.condition:
+                self.depth -= 1
+            raise
+
+        with self.condition:
+            self.metrics['queued'] += 1
+            self.oldest.setdefault(vin, queued_at)
+            self._schedule(vin)
+
+        return manifest_id
+
+
+    def recover(self):
+        '''
+        Schedule every manifest left on disk from before a restart
+        '''
+        os.makedirs(self.root, exist_ok=True)
+        with self.condition:
+            # counted from what is on disk, which includes anything queued before the workers started
+            self.depth = 0
+            for vin in os.listdir(self.root):
+                files = self._queued_files(vin)
+                if not files:
+                    continue
+                self.depth += len(files)
+                self.oldest[vin] = int(files[0].split('-')[0]) / 1e9
+                self._schedule(vin)
+
+
+    def rescan(self):
+        '''
+        Schedule the manifests other processes queued since the last scan
+        '''
+        with self.condition:
+            depth = 0
+            for vin in os.listdir(self.root):
+                files = self._queued_files(vin)
+                if not files:
+                    continue
+                depth += len(files)
+                if vin not in self.active and vin not in self.scheduled:
+                    self.oldest.setdefault(vin, int(files[0].split('-')[0]) / 1e9)
+                    self._schedule(vin)
+            self.depth = depth
+
+
+    def result(self, vin):
+        '''
+        The result of processing the last manifests from a vehicle
+        '''
+        try:
+            with open(self._result_path(vin), 'r') as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return self.results.get(vin, {})
+
+
+    def start(self):
+        self.recover()
+        for _ in range(self.workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self.ready:
+                    self.condition.wait()
+                vin = self.ready.popleft()
+                self.scheduled.discard(vin)
+                self.active.add(vin)
+                queued_at = self.oldest.pop(vin, time.time())
+
+            # the worker outlives anything that goes wrong with one vehicle
+            try:
+                self.process(vin, queued_at)
+            except Exception as e:
+                print(f'unable to reschedule {vin}: {e}')
+
+
+    def process(self, vin, queued_at):
+        removed = []
+        try:
+            files = self._queued_files(vin)
+            manifests = []
+            for name in files:
+                with open(os.path.join(self._vin_dir(vin), name), 'r') as f:
+                    manifests.append(json.loads(f.read()))
+
+            try:
+                if manifests:
+                    self.results[vin] = self.handler(vin, manifests)
+            except Exception as e:
+                print(f'unable to process manifests from {vin}: {e}')
+                self.results[vin] = {'error': str(e)}
+                self.metrics['errors'] += 1
+
+            if vin in self.results:
+                tmp_path = f'{self._result_path(vin)}.tmp'
+                with open(tmp_path, 'w') as f:
+                    f.write(json.dumps(self.results[vin]))
+                os.replace(tmp_path, self._result_path(vin))
+
+            # manifests are only removed once they have been handled, a crash before this replays them
+            for name in files:
+                os.remove(os.path.join(self._vin_dir(vin), name))
+                removed.append(name)
+
+        except Exception as e:
+            # whatever is left on disk is tried again with the vehicle's next manifest, a rescan or a restart
+            print(f'unable to process the queue of {vin}: {e}')
+            self.metrics['errors'] += 1
+
+        finally:
+            lag = round(time.time() - queued_at, 3)
+
+            with self.condition:
+                self.depth -= len(removed)
+                self.metrics['processed'] += len(removed)
+                self.metrics['coalesced'] += max(0, len(removed) - 1)
+                self.metrics['last_lag_seconds'] = lag
+                self.metrics['max_lag_seconds'] = max(self.metrics['max_lag_seconds'], lag)
+                self.active.discard(vin)
+                if vin in self.dirty:
+                    self.dirty.discard(vin)
+                    # manifests that arrived while this batch was processed, unless they made it into the batch
+                    newer = self._queued_files(vin)
+                    if newer:
+                        self.oldest[vin] = int(newer[0].split('-')[0]) / 1e9
+                        self._schedule(vin)
+                    else:
+                        self.oldest.pop(vin, None)
+
+
+
+    def get_metrics(self):
+        with self.condition:
+            oldest = min(self.oldest.values()) if self.oldest else None
+            return {
+                **self.metrics,
+                'depth': self.depth,
+                'vehicles_waiting': len(self.scheduled),
+                'vehicles_processing': len(self.active),
+                'oldest_queued_seconds': round(time.time() - oldest, 3) if oldest else 0,
+            }
@@ -0,0 +1,78 @@
+import gzip
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+PRE-COMPRESSED METADATA
+
+Metadata is stored compact and, next to every file, a compressed copy per content coding the server offers
+(<file>.gz, and <file>.zst when the zstandard package is installed). The copies are staged in the same
+transaction as the file, ahead of it, so they are written once per metadata version rather than compressed
+on every request, and a file is never visible before its copies are.
+
+A request for metadata is answered with the copy in the coding the client prefers out of the ones it accepts,
+or the file itself if it accepts none of them. Clients decode the response before checking it, so the length,
+hashes and signatures they check are those of the stored file whichever copy was sent.
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+GZIP_LEVEL = 9
+ZSTD_LEVEL = 12
+
+# content coding -> suffix of its copy, in the order the server prefers them
+ENCODINGS = {'zstd': '.zst', 'gzip': '.gz'} if zstandard else {'gzip': '.gz'}
+
+
+def compress(data, encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    # mtime is fixed so the same metadata always compresses to the same bytes
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+
+def encoded_copies(path, data):
+    '''
+    (path, bytes) of the compressed copy of data for each coding
+    '''
+    return [(path + suffix, compress(data, encoding)) for encoding, suffix in ENCODINGS.items()]
+
+
+
+def negotiate(accept_encoding):
+    '''
+    The coding to answer with given an Accept-Encoding header, None to send
+    the file as it is
+    '''
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding:
+            accepted[coding.lower()] = q
+
+    # the client's q-values decide first, the server's order breaks ties
+    best = None
+    for encoding in ENCODINGS:
+        q = accepted.get(encoding, accepted.get('*', 0.0))
+        if q > 0 and (best is None or q > best[1]):
+            best = (encoding, q)
+
+    return best[0] if best else None
+
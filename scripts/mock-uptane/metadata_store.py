@@ -0,0 +1,372 @@
+import os
+import mmap
+import fcntl
+import struct
+import threading
+from contextlib import contextmanager
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+SHARED METADATA STORE
+
+In a multi worker deployment (see server_workers.py) every worker maps the same store file and serves repo
+metadata straight out of it, so each file is held once in memory for all the workers and serving it never
+opens or reads a file. Metadata is still committed to disk as before, the store is kept alongside.
+
+The store is an append only log in a file of fixed size:
+* header    magic, tail (end of the last whole record), next seq, sealed (the generation that replaced it)
+* record    seq, pid of the writer, path length, data length, state, path, data
+
+Writers append a record as STAGED when a transaction is submitted and flip it to COMMITTED once its files are
+durable on disk, or ABORTED if the commit failed. Appends are serialized across processes with an flock, and
+the tail is only moved past a record once it is written, so readers never see half of one. Each process keeps
+an index of path -> offset of the newest record, brought up to date by scanning from where it left off to the
+tail, the bytes themselves only ever live in the mapping.
+
+Clients are only served COMMITTED records. Writers, who read the current versions to work out the next ones,
+see STAGED records as well, which keeps versions in order when updates land in different workers. It is what
+the committer's overlay does within one process.
+
+When a record does not fit, the writer starts the next generation: a new file with every STAGED record and the
+newest COMMITTED ones up to half its size, and seals the old one. Readers move over when they see the seal.
+Files that were left behind, and anything from before the store was created, are served from disk.
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+MAGIC = b'UPTSTOR1'
+# magic, tail, next seq, sealed
+HEADER = struct.Struct('<8sQQQ')
+TAIL_OFFSET = 8
+NEXT_SEQ_OFFSET = 16
+SEALED_OFFSET = 24
+# seq, pid, path length, data length, state
+RECORD = struct.Struct('<QIIIB3x')
+STATE_OFFSET = 20
+
+STAGED = 1
+COMMITTED = 2
+ABORTED = 3
+
+
+def _padded(length):
+    # records start 8 byte aligned so the header fields they are read through are too
+    return (length + 7) & ~7
+
+
+
+def _new_file(path, size, next_seq=1):
+    with open(path, 'wb') as f:
+        f.truncate(size)
+        f.write(HEADER.pack(MAGIC, HEADER.size, next_seq, 0))
+
+
+
+class MetadataStore():
+
+    def __init__(self, root, size, served_dirs):
+        '''
+        Map the current generation of the store under root. Every process
+        needs its own, the lock on the store file is taken per open file
+        '''
+        self.root = root
+        self.size = size
+        self.served_dirs = set(served_dirs)
+        # guards the mapping and the index within this process
+        self.lock = threading.Lock()
+        self.lock_fd = os.open(os.path.join(root, 'store.lock'), os.O_RDWR | os.O_CREAT)
+        self.mm = None
+        self._open(self._newest_generation())
+
+
+    @classmethod
+    def create(cls, root, size, served_dirs):
+        '''
+        A new store holding what is on disk in served_dirs, replacing any
+        left from an earlier run
+        '''
+        os.makedirs(root, exist_ok=True)
+        for name in os.listdir(root):
+            if name.startswith('store.') and name != 'store.lock':
+                os.remove(os.path.join(root, name))
+        _new_file(os.path.join(root, 'store.1'), size)
+
+        store = cls(root, size, served_dirs)
+        files = [os.path.join(d, name) for d in served_dirs if os.path.isdir(d)
+            for name in os.listdir(d) if not name.endswith('.tmp')]
+        # oldest first, so if they don't all fit it is the old versions that are left on disk
+        with store._exclusive():
+            for path in sorted(files, key=os.path.getmtime):
+                with open(path, 'rb') as f:
+                    store._append(path, f.read(), COMMITTED)
+        return store
+
+
+    def covers(self, path):
+        return os.path.dirname(path) in self.served_dirs
+
+
+    def _path(self, generation):
+        return os.path.join(self.root, f'store.{generation}')
+
+
+    def _newest_generation(self):
+        names = os.listdir(self.root)
+        return max(int(name[len('store.'):]) for name in names if name.startswith('store.') and name[len('store.'):].isdigit())
+
+
+    def _open(self, generation):
+        # caller holds the lock
+        with open(self._path(generation), 'r+b') as f:
+            mm = mmap.mmap(f.fileno(), 0)
+        if mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{self._path(generation)} is not a metadata store')
+        if self.mm:
+            self.mm.close()
+
+        self.mm = mm
+        self.generation = generation
+        self.cursor = HEADER.size
+        # path -> offset of its newest record that was not aborted, and of its newest committed one
+        self.newest = {}
+        self.newest_committed = {}
+        # seq -> (offset, path) of the records still staged
+        self.staged = {}
+
+
+    @contextmanager
+    def _exclusive(self):
+        with self.lock:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                yield
+            finally:
+                fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+
+    def _refresh(self):
+        '''
+        Index the records appended since the last refresh and pick up the
+        ones staged earlier that have been settled since. Caller holds the lock
+        '''
+        while struct.unpack_from('<Q', self.mm, SEALED_OFFSET)[0]:
+            try:
+                self._open(self._newest_generation())
+            except FileNotFoundError:
+                # replaced again while it was being opened
+                continue
+
+        tail = struct.unpack_from('<Q', self.mm, TAIL_OFFSET)[0]
+        while self.cursor < tail:
+            offset = self.cursor
+            seq, _, path_length, data_length, state = RECORD.unpack_from(self.mm, offset)
+            start = offset + RECORD.size
+            path = self.mm[start:start + path_length].decode('utf-8')
+            if state == STAGED:
+                self.newest[path] = offset
+                self.staged[seq] = (offset, path)
+            elif state == COMMITTED:
+                self.newest[path] = offset
+                self.newest_committed[path] = offset
+            self.cursor = offset + _padded(RECORD.size + path_length + data_length)
+
+        for seq, (offset, path) in list(self.staged.items()):
+            state = self.mm[offset + STATE_OFFSET]
+            if state == STAGED:
+                continue
+            del self.staged[seq]
+            if state == COMMITTED and self.newest_committed.get(path, -1) < offset:
+                self.newest_committed[path] = offset
+            elif state == ABORTED and self.newest.get(path) == offset:
+                # back to whatever came before it
+                candidates = [o for o, p in self.staged.values() if p == path] + [self.newest_committed.get(path, -1)]
+                if max(candidates) < 0:
+                    del self.newest[path]
+                else:
+                    self.newest[path] = max(candidates)
+
+
+    def _data(self, offset):
+        _, _, path_length, data_length, _ = RECORD.unpack_from(self.mm, offset)
+        start = offset + RECORD.size + path_length
+        return self.mm[start:start + data_length]
+
+
+    def _append(self, path, data, state):
+        # caller holds the store exclusively
+        encoded_path = path.encode('utf-8')
+        length = _padded(RECORD.size + len(encoded_path) + len(data))
+        if struct.unpack_from('<Q', self.mm, TAIL_OFFSET)[0] + length > self.size:
+            self._next_generation(length)
+        tail, next_seq = struct.unpack_from('<QQ', self.mm, TAIL_OFFSET)
+        if tail + length > self.size:
+            raise ValueError(f'{path} does not fit in the metadata store, it needs a bigger METADATA_STORE_BYTES')
+
+        RECORD.pack_into(self.mm, tail, next_seq, os.getpid(), len(encoded_path), len(data), state)
+        start = tail + RECORD.size
+        self.mm[start:start + len(encoded_path)] = encoded_path
+        self.mm[start + len(encoded_path):start + len(encoded_path) + len(data)] = data
+        # the record is whole before the tail moves past it
+        struct.pack_into('<Q', self.mm, NEXT_SEQ_OFFSET, next_seq + 1)
+        struct.pack_into('<Q', self.mm, TAIL_OFFSET, tail + length)
+
+        self._refresh()
+        return next_seq
+
+
+    def _next_generation(self, needed):
+        '''
+        Carry the staged records and as many of the newest committed ones as
+        fit in half the store over to a new file. Caller holds the store
+        exclusively
+        '''
+        keep = {offset for offset, _ in self.staged.values()}
+        budget = self.size // 2 - needed - sum(self._length(offset) for offset in keep)
+        for offset in sorted(self.newest_committed.values(), reverse=True):
+            if self._length(offset) > budget:
+                break
+            keep.add(offset)
+            budget -= self._length(offset)
+
+        generation = self.generation + 1
+        next_seq = struct.unpack_from('<Q', self.mm, NEXT_SEQ_OFFSET)[0]
+        tmp_path = f'{self._path(generation)}.tmp'
+        _new_file(tmp_path, self.size, next_seq)
+        with open(tmp_path, 'r+b') as f:
+            new = mmap.mmap(f.fileno(), 0)
+        tail = HEADER.size
+        for offset in sorted(keep):
+            length = self._length(offset)
+            new[tail:tail + length] = self.mm[offset:offset + length]
+            tail += length
+        struct.pack_into('<Q', new, TAIL_OFFSET, tail)
+        new.close()
+
+        # whole before other processes can see it
+        os.replace(tmp_path, self._path(generation))
+        struct.pack_into('<Q', self.mm, SEALED_OFFSET, generation)
+        os.remove(self._path(self.generation))
+        self._refresh()
+
+
+    def _length(self, offset):
+        _, _, path_length, data_length, _ = RECORD.unpack_from(self.mm, offset)
+        return _padded(RECORD.size + path_length + data_length)
+
+
+    def stage(self, files):
+        '''
+        Append the files the store covers as staged, returns their seqs to
+        settle once the commit is done
+        '''
+        files = [(path, data) for path, data in files if self.covers(path)]
+        if not files:
+            return []
+        with self._exclusive():
+            return [self._append(path, data, STAGED) for path, data in files]
+
+
+    def _settle(self, seqs, state):
+        if not seqs:
+            return
+        with self._exclusive():
+            for seq in seqs:
+                if seq in self.staged:
+                    self.mm[self.staged[seq][0] + STATE_OFFSET] = state
+            self._refresh()
+
+
+    def commit(self, seqs):
+        self._settle(seqs, COMMITTED)
+
+
+    def abort(self, seqs):
+        self._settle(seqs, ABORTED)
+
+
+    def abandon(self, pid):
+        '''
+        Abort what a worker that died had staged, it will never be committed
+        '''
+        with self._exclusive():
+            seqs = [seq for seq, (offset, _) in self.staged.items() if RECORD.unpack_from(self.mm, offset)[1] == pid]
+        self.abort(seqs)
+        return len(seqs)
+
+
+    def get(self, path):
+        '''
+        The committed bytes of path, None if the store doesn't have them
+        '''
+        with self.lock:
+            self._refresh()
+            offset = self.newest_committed.get(path)
+            return None if offset is None else self._data(offset)
+
+
+    def latest(self, path):
+        '''
+        The newest bytes of path including staged ones, for writers
+        '''
+        with self.lock:
+            self._refresh()
+            offset = self.newest.get(path)
+            return None if offset is None else self._data(offset)
+
+
+    def get_metrics(self):
+        with self.lock:
+            self._refresh()
+            return {
+                'generation': self.generation,
+                'bytes_used': struct.unpack_from('<Q', self.mm, TAIL_OFFSET)[0],
+                'bytes_total': self.size,
+                'files': len(self.newest_committed),
+                'staged': len(self.staged),
+            }
+
+
+
+class SharedLock():
+    '''
+    Reentrant lock that, once attached to a lock file, is also held against
+    the other processes that attached to it
+    '''
+
+    def __init__(self):
+        self.rlock = threading.RLock()
+        self.depth = 0
+        self.fd = None
+
+
+    def attach(self, path):
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT)
+
+
+    def acquire(self):
+        self.rlock.acquire()
+        self.depth += 1
+        if self.depth == 1 and self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+
+    def release(self):
+        if self.depth == 1 and self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.depth -= 1
+        self.rlock.release()
+
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.release()
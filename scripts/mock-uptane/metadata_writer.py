@@ -0,0 +1,261 @@
+import os
+import time
+import uuid
+import threading
+from common import METADATA_COMMIT_WINDOW_SECONDS
+from metadata_encoding import encoded_copies
+from blob_store import put_blob, pin_blob, blob_path
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+TRANSACTIONAL METADATA WRITES
+
+All the files of one metadata update (e.g. targets, snapshot and timestamp) are staged in a transaction and
+committed together. A commit writes every file to a temp file next to it, fsyncs them, renames them into place
+in the order they were staged and then fsyncs the directories. Readers only ever see whole files, and since
+timestamp.json is staged last it never points at a snapshot that is not there yet. Metadata files are staged
+along with their pre-compressed copies, see metadata_encoding.py. Files many paths share are staged with
+stage_blob() and committed as links to their blob, see blob_store.py.
+
+Commits are grouped. The first waiting writer becomes the leader, waits a short window for others to join and
+then commits everything that is pending in one go, so a burst of updates costs one round of fsyncs. When the
+same file is written by several transactions in a group only the last version is written.
+
+Staged files are visible to read_bytes() straight away, so a writer that reads the current versions to work out
+the next ones sees what the previous writer staged even if it has not been committed yet. In a multi worker
+deployment the files the workers serve also go through the shared store, so the same holds across workers,
+and they are only served by the other workers once committed, see metadata_store.py.
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+class MetadataTransaction():
+
+    def __init__(self):
+        self.files = []
+        # paths staged with stage_blob()
+        self.blobs = set()
+        # seqs of the files staged in the shared store
+        self.store_seqs = []
+        self.done = False
+        self.error = None
+
+    def stage(self, path, data):
+        self.files.append((path, data))
+
+    def stage_served(self, path, data):
+        '''
+        Stage a file clients download along with its compressed copies, see
+        metadata_encoding.py. The copies go first so they are never older
+        than the file
+        '''
+        for copy_path, copy in encoded_copies(path, data):
+            self.stage(copy_path, copy)
+        self.stage(path, data)
+
+    def stage_metadata(self, path, metadata, serializer):
+        self.stage_served(path, metadata.to_bytes(serializer))
+
+    def stage_blob(self, path, data):
+        '''
+        Stage a file that is committed as a link to its blob rather than a
+        copy, for content many paths share, see blob_store.py
+        '''
+        self.stage(path, data)
+        self.blobs.add(path)
+
+
+
+class GroupCommitter():
+
+    def __init__(self, window_seconds):
+        self.window_seconds = window_seconds
+        self.condition = threading.Condition()
+        self.pending = []
+        # path -> bytes that have been staged but not yet renamed into place
+        self.overlay = {}
+        self.committing = False
+        # the MetadataStore shared by the workers of a multi worker deployment
+        self.store = None
+        self.metrics = {
+            'commits': 0,
+            'transactions': 0,
+            'files_written': 0,
+            'files_coalesced': 0,
+        }
+
+
+    def read_bytes(self, path):
+        if self.store and self.store.covers(path):
+            data = self.store.latest(path)
+            if data is not None:
+                return data
+        with self.condition:
+            if path in self.overlay:
+                return self.overlay[path]
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+    def exists(self, path):
+        if self.store and self.store.covers(path) and self.store.latest(path) is not None:
+            return True
+        with self.condition:
+            if path in self.overlay:
+                return True
+        return os.path.isfile(path)
+
+
+    def submit(self, txn):
+        '''
+        Queue a transaction and make its files visible to read_bytes()
+        '''
+        if self.store:
+            txn.store_seqs = self.store.stage(txn.files)
+        with self.condition:
+            self.pending.append(txn)
+            for path, data in txn.files:
+                self.overlay[path] = data
+
+
+    def wait(self, txn):
+        '''
+        Block until a submitted transaction is durable and published, leading
+        the commit of the group if nobody else is
+        '''
+        with self.condition:
+            while not txn.done and self.committing:
+                self.condition.wait()
+            if txn.done:
+                if txn.error:
+                    raise txn.error
+                return
+            self.committing = True
+
+        # give writers arriving at the same time a chance to join this group
+        if self.window_seconds:
+            time.sleep(self.window_seconds)
+
+        with self.condition:
+            batch = self.pending
+            self.pending = []
+
+        error = None
+        try:
+            written = self._write(batch)
+        except OSError as e:
+            error = e
+            written = {}
+
+        # before anyone is told, so the other workers serve it by the time they are
+        if self.store:
+            seqs = [seq for committed in batch for seq in committed.store_seqs]
+            if error:
+                self.store.abort(seqs)
+            else:
+                self.store.commit(seqs)
+
+        with self.condition:
+            for committed in batch:
+                committed.done = True
+                committed.error = error
+            for path, data in written.items():
+                if self.overlay.get(path) is data:
+                    del self.overlay[path]
+            if error:
+                for committed in batch:
+                    for path, data in committed.files:
+                        if self.overlay.get(path) is data:
+                            del self.overlay[path]
+            self.committing = False
+            self.condition.notify_all()
+
+        if error:
+            raise error
+
+
+    def commit(self, txn):
+        self.submit(txn)
+        self.wait(txn)
+
+
+    def _write(self, batch):
+        # latest version of each file, in the order they were last staged
+        files = {}
+        blobs = set()
+        staged = 0
+        for txn in batch:
+            for path, data in txn.files:
+                staged += 1
+                files.pop(path, None)
+                files[path] = data
+                if path in txn.blobs:
+                    blobs.add(path)
+                else:
+                    blobs.discard(path)
+
+        tmp_paths = {}
+        try:
+            for path, data in files.items():
+                tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+                tmp_paths[path] = tmp_path
+                if path in blobs:
+                    self._link_blob(data, tmp_path)
+                    continue
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            for path, tmp_path in tmp_paths.items():
+                os.replace(tmp_path, path)
+                # renaming onto another link to the same blob leaves both in place
+                if path in blobs and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        except OSError:
+            for tmp_path in tmp_paths.values():
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            raise
+
+        # make the renames durable
+        for directory in {os.path.dirname(path) for path in files}:
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        self.metrics['commits'] += 1
+        self.metrics['transactions'] += len(batch)
+        self.metrics['files_written'] += len(files)
+        self.metrics['files_coalesced'] += staged - len(files)
+
+        return files
+
+
+    def _link_blob(self, data, tmp_path):
+        digest = put_blob(data)
+        try:
+            os.link(blob_path(digest), tmp_path)
+        except OSError:
+            # no hard links on this filesystem, fall back to a private copy
+            pin_blob(digest)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+        # the blob is made durable through the link
+        fd = os.open(tmp_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+
+committer = GroupCommitter(METADATA_COMMIT_WINDOW_SECONDS)
@@ -0,0 +1,318 @@
+import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from tuf.api import exceptions
+from tuf.ngclient.fetcher import FetcherInterface
+from common import backoff_delay, parse_retry_after, BACKOFF_ATTEMPTS
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+REPO MIRRORS
+
+Each repo can be served from several mirrors, all serving the same files under their own base url. A
+MirrorPool picks which mirror a file is fetched from:
+* the first RACE_FIRST_FETCHES fetches, and any fetch while a healthy mirror has not been measured yet, are
+  sent to every mirror at once and the first one to answer wins. The others are closed when they answer.
+* after that a fetch goes to the mirror with the lowest moving average latency (time to response headers)
+  and fails over to the next fastest on a connection error, timeout or server error. Any other status, such
+  as the 404 tuf expects when there is no newer root, is the answer.
+* a 404 for versioned metadata (<version>.<role>.json) may only mean the mirror lags behind, so it fails
+  over as well and is only the answer once every mirror has said it.
+* a mirror that fails is skipped for UNHEALTHY_SECONDS, unless every mirror has failed. A mirror that is
+  busy (429 or 503) is skipped for as long as its Retry-After asks. If every mirror is busy the fetch waits
+  with jittered backoff and tries again.
+
+Where the bytes came from makes no difference to verification. The tuf Updater is given MirrorFetcher as its
+fetcher and the first mirror as its base url, and checks every file it is handed exactly as it would if it
+had been downloaded from the repo itself.
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+RACE_FIRST_FETCHES = 3
+LATENCY_ALPHA = 0.3
+UNHEALTHY_SECONDS = 30
+MIRROR_TIMEOUT_SECONDS = 4
+CHUNK_SIZE = 400000
+
+RACE_POOL = ThreadPoolExecutor(max_workers=16)
+VERSIONED_METADATA = re.compile(r'(?:^|/)[0-9]+\.[a-z-]+\.json$')
+
+
+class MirrorsBusy(exceptions.DownloadHTTPError):
+
+    def __init__(self, message, status_code, retry_after):
+        super().__init__(message, status_code)
+        self.retry_after = retry_after
+
+
+
+class Mirror():
+
+    def __init__(self, base_url, headers=None):
+        self.base_url = base_url.rstrip('/') + '/'
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+        # moving average of the time to response headers in seconds, None until measured
+        self.latency = None
+        self.unhealthy_until = 0
+        self.requests = 0
+        self.inflight = 0
+        self.errors = 0
+
+
+    def healthy(self):
+        return time.monotonic() >= self.unhealthy_until
+
+
+    def record_latency(self, seconds):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency = LATENCY_ALPHA * seconds + (1 - LATENCY_ALPHA) * self.latency
+
+
+    def record_error(self, seconds=UNHEALTHY_SECONDS):
+        self.errors += 1
+        self.unhealthy_until = time.monotonic() + seconds
+
+
+    def to_dict(self):
+        return {
+            'base_url': self.base_url,
+            'latency_ms': round(self.latency * 1000, 3) if self.latency is not None else None,
+            'healthy': self.healthy(),
+            'requests': self.requests,
+            'errors': self.errors,
+        }
+
+
+
+class MirrorPool():
+
+    def __init__(self, base_urls, headers=None):
+        self.mirrors = [Mirror(base_url, headers) for base_url in base_urls]
+        # the url the Updater is given, fetches under it can be served by any mirror
+        self.base_url = self.mirrors[0].base_url
+        self.lock = threading.Lock()
+        self.fetches = 0
+
+
+    def _request(self, mirror, path):
+        with self.lock:
+            mirror.inflight += 1
+
+        start = time.monotonic()
+        try:
+            response = mirror.session.get(mirror.base_url + path, stream=True, timeout=MIRROR_TIMEOUT_SECONDS)
+        except requests.exceptions.RequestException:
+            with self.lock:
+                mirror.inflight -= 1
+                mirror.requests += 1
+                mirror.record_error()
+            raise
+
+        with self.lock:
+            mirror.inflight -= 1
+            mirror.requests += 1
+            if _busy(response):
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                mirror.record_error(retry_after if retry_after is not None else UNHEALTHY_SECONDS)
+            elif response.status_code >= 500:
+                mirror.record_error()
+            else:
+                mirror.record_latency(time.monotonic() - start)
+
+        return response
+
+
+    def ranked(self):
+        '''
+        Healthy mirrors fastest first, then the unhealthy ones as a last resort
+        '''
+        with self.lock:
+            healthy = [mirror for mirror in self.mirrors if mirror.healthy()]
+            unhealthy = [mirror for mirror in self.mirrors if not mirror.healthy()]
+
+        return sorted(healthy, key=lambda m: m.latency if m.latency is not None else float('inf')) + unhealthy
+
+
+    def get(self, path):
+        '''
+        Streaming response for path from one of the mirrors, raises a tuf
+        download error if no mirror has it
+        '''
+        with self.lock:
+            self.fetches += 1
+            # a mirror that is still answering an earlier race is measured once that answer arrives
+            unmeasured = any(m.latency is None and m.healthy() and not m.inflight for m in self.mirrors)
+            race = self.fetches <= RACE_FIRST_FETCHES or unmeasured
+
+        for attempt in range(BACKOFF_ATTEMPTS):
+            try:
+                if race and len(self.mirrors) > 1:
+                    return self._race(path)
+                return self._failover(path)
+            except MirrorsBusy as e:
+                if attempt == BACKOFF_ATTEMPTS - 1:
+                    raise
+                time.sleep(backoff_delay(attempt, e.retry_after))
+
+
+    def _failover(self, path):
+        errors = []
+        for mirror in self.ranked():
+            try:
+                response = self._request(mirror, path)
+            except requests.exceptions.RequestException as e:
+                errors.append(_download_error(mirror, e))
+                continue
+
+            if response.status_code == 200:
+                return mirror, response
+
+            response.close()
+            # the mirror is up and does not have the file, a stale mirror would serve a stale
+            # timestamp too so asking the others would not help. Only server errors, and versioned
+            # metadata a lagging mirror may not have yet, fail over
+            if response.status_code < 500 and not _busy(response) and not _lagging(path, response):
+                raise _status_error(mirror, response)
+            errors.append(_status_error(mirror, response))
+
+        raise _pick_error(errors)
+
+
+    def _race(self, path):
+        with self.lock:
+            # mirrors that failed recently only take part if every mirror has
+            racing = [mirror for mirror in self.mirrors if mirror.healthy()] or self.mirrors
+
+        futures = {RACE_POOL.submit(self._request, mirror, path): mirror for mirror in racing}
+        winner = None
+        errors = []
+
+        for future in as_completed(futures):
+            mirror = futures[future]
+            try:
+                response = future.result()
+            except requests.exceptions.RequestException as e:
+                errors.append(_download_error(mirror, e))
+                continue
+
+            if response.status_code < 500 and not _busy(response) and not _lagging(path, response):
+                winner = future
+                break
+            response.close()
+            errors.append(_status_error(mirror, response))
+
+        # the losers are still measured, their responses are closed as they arrive
+        for future in futures:
+            if future is not winner:
+                future.add_done_callback(_close_response)
+
+        if winner is None:
+            raise _pick_error(errors)
+
+        response = winner.result()
+        if response.status_code != 200:
+            response.close()
+            raise _status_error(futures[winner], response)
+        return futures[winner], response
+
+
+    def stats(self):
+        with self.lock:
+            return [mirror.to_dict() for mirror in self.mirrors]
+
+
+
+class MirrorFetcher(FetcherInterface):
+    '''
+    tuf fetcher that serves urls under a pool's base url from its mirrors and
+    fetches anything else directly
+    '''
+
+    def __init__(self, pools):
+        self.pools = pools
+        self.session = requests.Session()
+
+
+    def _fetch(self, url):
+        for pool in self.pools:
+            if url.startswith(pool.base_url):
+                mirror, response = pool.get(url[len(pool.base_url):])
+                return self._chunks(response, pool, mirror)
+
+        try:
+            response = self.session.get(url, stream=True, timeout=MIRROR_TIMEOUT_SECONDS)
+        except requests.exceptions.Timeout as e:
+            raise exceptions.SlowRetrievalError from e
+        if response.status_code != 200:
+            response.close()
+            raise exceptions.DownloadHTTPError(f'{response.status_code} fetching {url}', response.status_code)
+        return self._chunks(response)
+
+
+    def _chunks(self, response, pool=None, mirror=None):
+        try:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                yield chunk
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if pool:
+                with pool.lock:
+                    mirror.record_error()
+            raise exceptions.SlowRetrievalError from e
+        finally:
+            response.close()
+
+
+
+def _close_response(future):
+    if not future.exception():
+        future.result().close()
+
+
+
+def _download_error(mirror, e):
+    if isinstance(e, requests.exceptions.Timeout):
+        return exceptions.SlowRetrievalError(f'{mirror.base_url} timed out')
+    return exceptions.DownloadError(f'unable to reach {mirror.base_url}: {e}')
+
+
+
+def _busy(response):
+    return response.status_code in (429, 503)
+
+
+
+def _lagging(path, response):
+    # versioned metadata is never removed, a mirror that does not have it may not have caught up yet
+    return response.status_code == 404 and bool(VERSIONED_METADATA.search(path))
+
+
+
+def _status_error(mirror, response):
+    message = f'{response.status_code} from {mirror.base_url}'
+    if _busy(response):
+        return MirrorsBusy(message, response.status_code, parse_retry_after(response.headers.get('Retry-After')))
+    return exceptions.DownloadHTTPError(message, response.status_code)
+
+
+
+def _pick_error(errors):
+    # a mirror that answered says more than one that could not be reached, tuf relies on a 404
+    # to know that there is no newer root for example. One that is busy says to come back later
+    for error in errors:
+        if isinstance(error, exceptions.DownloadHTTPError) and not isinstance(error, MirrorsBusy):
+            return error
+    for error in errors:
+        if isinstance(error, MirrorsBusy):
+            return error
+    return errors[0]
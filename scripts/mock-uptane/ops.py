@@ -3,9 +3,11 @@ import shutil
 import os
 import requests
 import json
+from multiprocessing import Pool
+from securesystemslib.keys import generate_rsa_key
 
-from common import (create_and_write_key_pair,
-    PRIMARY_ECU_SERIAL, SECONDARY_ECU_SERIAL, PRIMARY_FS_ROOT_PATH,
+from common import (create_and_write_key_pair, bulk_key_dir,
+    PRIMARY_ECU_SERIAL, SECONDARY_ECU_SERIAL, PRIMARY_FS_ROOT_PATH, BULK_KEYS_PATH,
     IMAGE_REPO_HOST, DIRECTOR_REPO_HOST, IMAGE_REPO_META_DIR, DIRECTOR_REPO_META_DIR)
 
 
@@ -16,6 +18,47 @@ def generate_ecu_keys():
 
 
 
+# generate and write the keypair of a single ecu, runs in a worker process
+def _generate_bulk_key(ecu_serial):
+    key = generate_rsa_key(bits=2048, scheme='rsassa-pss-sha256')
+    key_dir = bulk_key_dir(ecu_serial)
+    os.makedirs(key_dir, exist_ok=True)
+
+    with open(os.path.join(key_dir, f'{ecu_serial}-public.pem'), 'w') as pub:
+        pub.write(key['keyval']['public'])
+    # readable by the owner only, from the moment it is created
+    fd = os.open(os.path.join(key_dir, f'{ecu_serial}-private.pem'), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    # a key left from an earlier run keeps its mode otherwise
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, 'w') as priv:
+        priv.write(key['keyval']['private'])
+
+    return ecu_serial, key['keyid'], key['keyval']['public']
+
+
+
+def bulk_generate_ecu_keys(count, prefix):
+    '''
+    Generate keys for `count` ecus named <prefix>-<n> on every core. Keys are
+    written to a sharded layout under BULK_KEYS_PATH along with index.jsonl, 
+    one line of ecu_serial, keyid and public_key per ecu for bulk registration
+    '''
+    print(f'generating keys for {count} ecus in {BULK_KEYS_PATH}')
+    os.makedirs(BULK_KEYS_PATH, exist_ok=True)
+
+    serials = (f'{prefix}-{n:07d}' for n in range(count))
+    index_path = os.path.join(BULK_KEYS_PATH, 'index.jsonl')
+
+    with Pool() as pool, open(index_path, 'w') as index:
+        for done, (ecu_serial, keyid, public_key) in enumerate(pool.imap_unordered(_generate_bulk_key, serials, chunksize=16), 1):
+            index.write(json.dumps({ 'ecu_serial': ecu_serial, 'keyid': keyid, 'public_key': public_key }) + '\n')
+            if done % 1000 == 0:
+                print(f'generated {done}/{count}')
+
+    print(f'index of generated keys was written to {index_path}')
+
+
+
 def init_primary_fs(): 
     print('initing primary filesystem')
     try:
@@ -70,6 +113,13 @@ def main():
     
     elif action == 'gen-keys':
         generate_ecu_keys()
+
+    elif action == 'bulk-gen-keys':
+        if len(sys.argv) < 3:
+            print('usage: python ops.py bulk-gen-keys <count> [serial prefix]')
+            exit(-1)
+        prefix = sys.argv[3] if len(sys.argv) > 3 else 'ecu'
+        bulk_generate_ecu_keys(int(sys.argv[2]), prefix)
     
     else:
         print('no such command')
@@ -1,18 +1,28 @@
-from tuf.ngclient import Updater
-from securesystemslib.formats import encode_canonical
-from securesystemslib.keys import create_signature
-import requests 
-import hashlib
 from styles import GREEN, RED, YELLOW, ENDCOLORS
 import json 
 import uuid
 import sys
 import random
-from common import (load_pem_key, _get_time, generate_priv_tuf_key,
+import os
+import time
+from functools import cached_property
+from secondaries import build_metadata_bundle, send_to_secondaries
+from timing import Tracer, JsonLinesSink, HistogramSink
+from canonical import encode_canonical
+from targets_stream import iter_targets
+from common import (load_pem_key, _get_time, generate_priv_tuf_key, get_file_info, proxied,
+  backoff_delay, parse_retry_after, BACKOFF_ATTEMPTS, VEHICLE_ID_HEADER,
   TEAM_ID, ROBOT_ID,
-  PRIMARY_ECU_SERIAL, SECONDARY_ECU_SERIAL, PRIMARY_FS_ROOT_PATH,
-  IMAGE_REPO_HOST, DIRECTOR_REPO_HOST, IMAGE_REPO_META_DIR, DIRECTOR_REPO_META_DIR,
-  DIRECTOR_REPO_TARGETS_DIR, IMAGE_REPO_TARGETS_DIR)
+  PRIMARY_ECU_SERIAL, SECONDARY_ECU_SERIAL, PRIMARY_FS_ROOT_PATH, SECONDARIES,
+  IMAGE_REPO_MIRRORS, DIRECTOR_REPO_MIRRORS, DIRECTOR_REPO_HOST, IMAGE_REPO_META_DIR, DIRECTOR_REPO_META_DIR,
+  DIRECTOR_REPO_TARGETS_DIR, IMAGE_REPO_TARGETS_DIR, TIMING_LOG_PATH, PROFILE_DIR)
+
+
+# Possible outcomes of an update cycle
+CYCLE_FAILED = 'failed'
+CYCLE_NO_OP = 'no-op'
+CYCLE_NO_TARGETS = 'no-targets'
+CYCLE_COMPLETE = 'complete'
 
 
 '''
@@ -43,9 +53,9 @@ perform the following seven steps:
 2. Download and check current time                                  [✓] 
 3. Download and verify metadata                                     [1/2]    
 4. Download and verify images                                       [✓]  
-5. Send latest time to Secondaries                                  []
-6. Send metadata to Secondaries                                     []
-7. Send images to Secondaries                                       []
+5. Send latest time to Secondaries                                  [✓]
+6. Send metadata to Secondaries                                     [✓]
+7. Send images to Secondaries                                       [✓]
 
 ---------------------------------------------------------------------------------------------------------------
 
@@ -120,6 +130,11 @@ At this stage, we have the lastest metadata file sets from the image and directo
 10. Verify that Targets metadata from the Director and Image repositories match. A Primary ECU SHALL perform
     this check on metadata for all images listed in the Targets metadata file from the Director repository 
     downloaded in step 6. To check that the metadata for an image matches, complete the following procedure: 
+      a) Locate and download a Targets metadata file from the Image repository that contains an image with 
+         exactly the same file name listed in the Director metadata.
+      b) Check that the Targets metadata from the Image repository matches the Targets metadata from the 
+         Director repository: the non-custom metadata (length and hashes) SHALL match, and the custom 
+         ecu_serial SHALL identify an ECU on this vehicle.
 
 ---------------------------------------------------------------------------------------------------------------
 
@@ -133,17 +148,25 @@ metadata for that image.
 ---------------------------------------------------------------------------------------------------------------
 
 5. SEND LATEST TIME TO SECONDARIES 
+[Uptane Spec 5.4.2.5]
 
+The Primary SHALL send the latest time attestation it has verified to each of its Secondaries.
 
 ---------------------------------------------------------------------------------------------------------------
 
 6. SEND METADATA TO SECONDARIES 
+[Uptane Spec 5.4.2.6]
 
+The Primary SHALL send the latest metadata it has downloaded and verified to all of its associated Secondaries.
+The bundle is serialized once and the same bytes are sent to every Secondary.
 
 ---------------------------------------------------------------------------------------------------------------
 
 7. SEND IMAGES TO SECONDARIES
+[Uptane Spec 5.4.2.7]
 
+The Primary SHALL send the latest images it has downloaded and verified to each Secondary they are meant for.
+Images are streamed from disk and all Secondaries are served concurrently, see secondaries.py.
 
 ---------------------------------------------------------------------------------------------------------------
 
@@ -170,19 +193,64 @@ class Primary():
     'secondary': '',
   }
 
-  def __init__(self):
+  ECU_SERIALS = (PRIMARY_ECU_SERIAL, SECONDARY_ECU_SERIAL)
+
+  def __init__(self, tracer=None):
+
+    self.tracer = tracer or Tracer()
+
+    self.directed_targets = []
+    self.image_targets_index = {}
+
+    # version reports hash the installed images on disk, so make sure the mocked ones exist
+    for installed_image in (self.INSTALLED_PRIMARY_ECU_IMAGE, self.INSTALLED_SECONDARY_ECU_IMAGE):
+      if not os.path.isfile(installed_image['path']):
+        self.write_mock_image(installed_image)
+
+
 
-    self.director_updater = Updater(
+  # tuf, securesystemslib and requests take a noticeable time to import on a robot, so they are
+  # only imported by the methods that use them and the updaters are only built when first used
+
+  @cached_property
+  def director_mirrors(self):
+    from mirrors import MirrorPool
+    return MirrorPool(DIRECTOR_REPO_MIRRORS, headers={VEHICLE_ID_HEADER: ROBOT_ID})
+
+
+  @cached_property
+  def image_mirrors(self):
+    from mirrors import MirrorPool
+    return MirrorPool(IMAGE_REPO_MIRRORS, headers={VEHICLE_ID_HEADER: ROBOT_ID})
+
+
+  @cached_property
+  def director_updater(self):
+    from targets_delta import DeltaUpdater
+    from mirrors import MirrorFetcher
+
+    # targets.json is fetched as a delta against the local copy when the repo has one, and
+    # metadata is fetched from whichever mirror is fastest. The updater verifies it either way
+    return DeltaUpdater(
         metadata_dir=DIRECTOR_REPO_META_DIR,
         target_dir=DIRECTOR_REPO_TARGETS_DIR,
-        metadata_base_url=DIRECTOR_REPO_HOST,
-        target_base_url=DIRECTOR_REPO_HOST)
+        metadata_base_url=self.director_mirrors.base_url,
+        target_base_url=proxied(self.director_mirrors.base_url),
+        fetcher=MirrorFetcher([self.director_mirrors]))
+
+
+  @cached_property
+  def image_updater(self):
+    from targets_delta import DeltaUpdater
+    from mirrors import MirrorFetcher
 
-    self.image_updater = Updater(
+    return DeltaUpdater(
         metadata_dir=IMAGE_REPO_META_DIR,
         target_dir=IMAGE_REPO_TARGETS_DIR,
-        metadata_base_url=IMAGE_REPO_HOST,
-        target_base_url=IMAGE_REPO_HOST)
+        metadata_base_url=self.image_mirrors.base_url,
+        # images are served under targets/ of the repo
+        target_base_url=proxied(self.image_mirrors.base_url + 'targets/'),
+        fetcher=MirrorFetcher([self.image_mirrors]))
 
   
 
@@ -190,8 +258,9 @@ class Primary():
       """
       Creates ECU manifest that complies with Uptane Spec 5.4.2.1
       """
+      from securesystemslib.keys import create_signature
 
-      def generate_ecu_version_report(ecu_serial, priv_tuf_key, file_name, file_body, attack):
+      def generate_ecu_version_report(ecu_serial, priv_tuf_key, file_path, attack):
         
         ecu_report = {
           'signatures': [],
@@ -202,25 +271,23 @@ class Primary():
             'timeserver_time': _get_time(),
             'report_counter': random.randint(0, 10000000),
             'installed_image': {
-              'filepath': file_name,
-              'fileinfo': {
-                'length': len(file_body.encode('utf-8')),
-                'hashes': {
-                  'sha256': hashlib.sha256(file_body.encode('utf-8')).hexdigest(),
-                  'sha512': hashlib.sha512(file_body.encode('utf-8')).hexdigest(),
-                }
-              }
+              'filepath': file_path,
+              'fileinfo': get_file_info(file_path)
             } 
           }
         }
         
-        report_signed_canonical = encode_canonical(ecu_report['signed'])
+        report_signed_canonical = encode_canonical(ecu_report['signed'], canonical_cache)
         report_signature = create_signature(priv_tuf_key, report_signed_canonical.encode('utf-8'))
         ecu_report['signatures'].append(report_signature)
         
         return ecu_report
 
 
+      # The signed part of each ecu report is encoded once to be signed and 
+      # reused when the full manifest is encoded
+      canonical_cache = {}
+
       # Load the ECU private keys from pem files
       primary_ecu_key = load_pem_key(f'{TEAM_ID}-{PRIMARY_ECU_SERIAL}-private')
       secondary_ecu_key = load_pem_key(f'{TEAM_ID}-{SECONDARY_ECU_SERIAL}-private')
@@ -233,14 +300,12 @@ class Primary():
         PRIMARY_ECU_SERIAL, 
         primary_ecu_tuf_key, 
         self.INSTALLED_PRIMARY_ECU_IMAGE['path'], 
-        self.INSTALLED_PRIMARY_ECU_IMAGE['body'],
         self.IDENTIFIED_ATTACKS['primary'])
 
       secondary_ecu_report = generate_ecu_version_report(
         SECONDARY_ECU_SERIAL, 
         secondary_ecu_tuf_key, 
         self.INSTALLED_SECONDARY_ECU_IMAGE['path'], 
-        self.INSTALLED_SECONDARY_ECU_IMAGE['body'],
         self.IDENTIFIED_ATTACKS['secondary'])
 
 
@@ -257,7 +322,7 @@ class Primary():
       }
 
       # Canonicalize the signed portion of the manifest
-      manifest_signed_canonical = encode_canonical(robot_manifest['signed'])
+      manifest_signed_canonical = encode_canonical(robot_manifest['signed'], canonical_cache)
 
       # Sign the signed portion of the manifest with the primarys keys
       manifest_signature = create_signature(primary_ecu_tuf_key, manifest_signed_canonical.encode('utf-8'))
@@ -272,30 +337,57 @@ class Primary():
     
     #TODO check the signed_vehicle_manifest has valid schema
 
-    url = f'{DIRECTOR_REPO_HOST}/manifests'
+    import requests
 
-    try:
-      res = requests.post(url, json = signed_vehicle_manifest)
-      if res.status_code == 200:
-        print(f'{GREEN}{str(res.status_code)} successfully sent vehicle manifest to the director {ENDCOLORS}') 
-      else:
-        print(f'{RED}HTTP {str(res.status_code)} while trying to send the vehicle manifest to the director{ENDCOLORS}') 
-        print(f'{RED}Server error: {str(res.text)} {ENDCOLORS}') 
+    with self.tracer.span('manifest_submit'):
+      url = f'{DIRECTOR_REPO_HOST}/manifests'
+
+      try:
+        res = self.post_with_backoff(url, signed_vehicle_manifest)
+        if res.status_code in (200, 202):
+          print(f'{GREEN}{str(res.status_code)} successfully sent vehicle manifest to the director {ENDCOLORS}') 
+        else:
+          print(f'{RED}HTTP {str(res.status_code)} while trying to send the vehicle manifest to the director{ENDCOLORS}') 
+          print(f'{RED}Server error: {str(res.text)} {ENDCOLORS}') 
 
-        # print(f'{RED} HTTP {str(res.message)} while trying to send the vehicle manifest to the director') 
-    except requests.exceptions.RequestException:
-      print(f'{RED}primary has blown up trying to submit vehicle manifest to director') 
+          # print(f'{RED} HTTP {str(res.message)} while trying to send the vehicle manifest to the director') 
+      except requests.exceptions.RequestException:
+        print(f'{RED}primary has blown up trying to submit vehicle manifest to director') 
 
 
 
 
 
+  def post_with_backoff(self, url, body):
+    '''
+    POST to the server, waiting and trying again with jittered backoff while
+    it answers 429 or 503
+    '''
+    import requests
+
+    for attempt in range(BACKOFF_ATTEMPTS):
+      res = requests.post(url, json = body, headers = {VEHICLE_ID_HEADER: ROBOT_ID})
+      if res.status_code not in (429, 503) or attempt == BACKOFF_ATTEMPTS - 1:
+        return res
+
+      delay = backoff_delay(attempt, parse_retry_after(res.headers.get('Retry-After')))
+      print(f'{YELLOW}HTTP {res.status_code} from {url}, trying again in {delay:.1f}s{ENDCOLORS}')
+      time.sleep(delay)
+
+
+
   def get_signed_time(self, nonces):
     '''
     Forget about getting a correct signed time from a timeserver for now
     '''
     self.clock = _get_time()
-    pass
+    self.time_attestation = {
+      'signed': {
+        'nonces': nonces,
+        'timestamp': self.clock
+      },
+      'signatures': []
+    }
 
 
 
@@ -303,40 +395,140 @@ class Primary():
   def refresh_toplevel_metadata(self):
     """
     For each repo download the TUF meta data. To start the only repos are 
-    the director and image repo
+    the director and image repo. Raises if either cannot be verified
     """
     
+    # an Updater can only refresh once, each refresh gets new ones that start from what the last one persisted
+    self.__dict__.pop('director_updater', None)
+    self.__dict__.pop('image_updater', None)
+
     #TODO potentially get metadata from other repos
-    try:
+    with self.tracer.span('metadata_refresh', repo='director'):
       self.director_updater.refresh()
-      self.image_updater.refresh()
-    except Exception as e:
-      print(f'{RED}{e}{ENDCOLORS}')
-      print(f'{RED}Unable to update manifest{ENDCOLORS}')
+
+    # Uptane Spec 5.4.4.2 substep 8, an image repo whose snapshot has not changed has nothing new to verify
+    with self.tracer.span('timestamp_check', repo='image'):
+      image_unchanged = self.snapshot_unchanged(IMAGE_REPO_META_DIR, self.image_mirrors)
+    if not image_unchanged:
+      with self.tracer.span('metadata_refresh', repo='image'):
+        self.image_updater.refresh()
+
+    with self.tracer.span('target_listing'):
+      self.index_targets()
+
+
+
+  def index_targets(self):
+    """
+    Stream the local director and image targets metadata once per refresh, 
+    see targets_stream.py. Only the director targets meant for one of our ecus
+    are kept, and only the image targets the director pointed us at, keyed by
+    path so each directed target can be cross-checked with a single lookup
+    """
+
+    with open(os.path.join(DIRECTOR_REPO_META_DIR, 'targets.json'), 'rb') as f:
+      self.directed_targets = list(iter_targets(f, ecu_serials=self.ECU_SERIALS))
+
+    directed_paths = {target.path for target in self.directed_targets}
+    with open(os.path.join(IMAGE_REPO_META_DIR, 'targets.json'), 'rb') as f:
+      self.image_targets_index = {target.path: target for target in iter_targets(f, paths=directed_paths)}
+
+
+
+  def director_metadata_unchanged(self):
+    """
+    Uptane Spec 5.4.4.2 substep 4. If the director snapshot is unchanged there
+    are no new updates and the rest of the verification can be skipped
+    """
+    return self.snapshot_unchanged(DIRECTOR_REPO_META_DIR, self.director_mirrors)
+
+
+
+  def snapshot_unchanged(self, meta_dir, mirrors):
+    """
+    Download only the timestamp of a repo and compare the snapshot it lists
+    against the snapshot we already hold. The new timestamp is verified the
+    way a refresh would (signed by the root we trust, no rollback, not
+    expired) so a replayed or frozen timestamp can not hold us on old
+    metadata. If it lists the same snapshot version, length and hashes as our
+    copy there is nothing new in the repo. The timestamp is re-signed on its
+    own as it nears expiry, so its version is not what decides it
+    """
+
+    from tuf.api.exceptions import DownloadError, EqualVersionNumberError, RepositoryError
+    from tuf.api.metadata import Metadata
+    from tuf.ngclient._internal.trusted_metadata_set import TrustedMetadataSet
+
+    # the updater only writes metadata here once it has verified it
+    try:
+      with open(os.path.join(meta_dir, 'root.json'), 'rb') as f:
+        trusted_set = TrustedMetadataSet(f.read())
+      with open(os.path.join(meta_dir, 'timestamp.json'), 'rb') as f:
+        trusted_timestamp_bytes = f.read()
+      with open(os.path.join(meta_dir, 'snapshot.json'), 'rb') as f:
+        trusted_snapshot_bytes = f.read()
+      trusted_snapshot = Metadata.from_bytes(trusted_snapshot_bytes)
+    except (OSError, RepositoryError):
+      # nothing cached yet
+      return False
+
+    # what we have can no longer be relied on
+    if trusted_snapshot.signed.is_expired(trusted_set.reference_time):
+      return False
+
+    # an expired timestamp we already trust still loads, it is what the new one is checked against for rollback
+    try:
+      trusted_set.update_timestamp(trusted_timestamp_bytes)
+    except RepositoryError:
+      if trusted_set.timestamp is None:
+        return False
+
+    try:
+      _, res = mirrors.get('timestamp.json')
+      with res:
+        new_timestamp_bytes = res.content
+      trusted_set.update_timestamp(new_timestamp_bytes)
+      self.persist_timestamp(meta_dir, new_timestamp_bytes)
+    except EqualVersionNumberError:
+      # the same timestamp as ours, which only stands while it has not expired
+      if trusted_set.timestamp.signed.is_expired(trusted_set.reference_time):
+        return False
+    except (DownloadError, RepositoryError, OSError):
+      # a bad, rolled back or expired timestamp goes through the full refresh, which turns it away
+      return False
+
+    snapshot_meta = trusted_set.timestamp.signed.snapshot_meta
+    if snapshot_meta.version != trusted_snapshot.signed.version:
+      return False
+    try:
+      snapshot_meta.verify_length_and_hashes(trusted_snapshot_bytes)
+    except RepositoryError:
+      return False
+
+    return True
+
+
+
+  def persist_timestamp(self, meta_dir, data):
+    """
+    Keep a verified timestamp the way the updater does, so the next check
+    turns away anything older than it
+    """
+    tmp_path = os.path.join(meta_dir, 'timestamp.json.tmp')
+    with open(tmp_path, 'wb') as f:
+      f.write(data)
+    os.replace(tmp_path, os.path.join(meta_dir, 'timestamp.json'))
+
 
 
 
-  
-  
   def get_target_list_from_director(self):
     # newer updater client lost the abilty to quickly grab
-    # get_target_list_from_director from 0.9.8
-    
-    directed_targets = json.loads(self.director_updater._load_local_metadata('targets').decode())
+    # get_target_list_from_director from 0.9.8 so the list is built
+    # by index_targets() after each refresh
+    return self.directed_targets
 
-    directed_targets_sanitised = []
-    
-    for filepath, fileinfo in directed_targets['signed']['targets'].items():
-      new_target = {} 
-      new_target['path'] = filepath 
-      new_target['fileinfo'] = fileinfo
-      new_target['fileinfo'] = fileinfo
-      directed_targets_sanitised.append(new_target)
-
-    return directed_targets_sanitised
 
-    
-    
     # validated_target_info will now look something like this:
     # {
     #   'Director': {
@@ -346,19 +538,116 @@ class Primary():
     #     filepath: 'django/django.1.9.3.tgz',
     #     fileinfo: {hashes: ..., length: ... } } }
     # }
-  def get_validated_target_info(self, target_filepath):
-    #TODO check if target from director repo matches target from image repo
-    return True
+  def get_validated_target_info(self, directed_target):
+    """
+    Uptane Spec 5.4.4.2 step 10. The director target must be listed by the image
+    repo with the same length and hashes, and must be meant for one of our ecus
+    """
+
+    image_target = self.image_targets_index.get(directed_target.path)
+
+    if image_target is None:
+      return False
+
+    if directed_target.length != image_target.length:
+      return False
+
+    # every hash function both repos have listed must agree, and there must be at least one
+    director_hashes = directed_target.hashes
+    image_hashes = image_target.hashes
+    shared_hash_algos = director_hashes.keys() & image_hashes.keys()
+
+    if not shared_hash_algos:
+      return False
+
+    for algo in shared_hash_algos:
+      if director_hashes[algo] != image_hashes[algo]:
+        return False
+
+    return directed_target.ecu_serial in self.ECU_SERIALS
+
+
+  def download_secondary_images(self, verified_targets):
+    """
+    Download the images of the verified targets meant for one of the
+    configured secondaries, unless a copy that matches the image repo is
+    there already. Returns ecu serial -> (name, path) of the images that are
+    there and match, an image that could not be downloaded is left out
+    """
+
+    from tuf.api.metadata import TargetFile
+    from tuf.api.exceptions import DownloadError, RepositoryError
+
+    secondary_serials = {secondary['ecu_serial'] for secondary in SECONDARIES}
+    images = {}
+
+    for target in verified_targets:
+      if target.ecu_serial not in secondary_serials:
+        continue
+
+      image_target = self.image_targets_index[target.path]
+      target_file = TargetFile(image_target.length, image_target.hashes, image_target.path)
+      image_path = os.path.join(IMAGE_REPO_TARGETS_DIR, target.path)
+
+      try:
+        if not self.image_updater.find_cached_target(target_file, image_path):
+          print(f"{GREEN}Attempting to download target: {target.path}{ENDCOLORS}")
+          os.makedirs(os.path.dirname(image_path), exist_ok=True)
+          self.image_updater.download_target(target_file, image_path)
+      except (DownloadError, RepositoryError, OSError) as e:
+        print(f'{RED}Unable to download {target.path} for secondary {target.ecu_serial}: {e}{ENDCOLORS}')
+        continue
+
+      images.setdefault(target.ecu_serial, []).append((target.path, image_path))
+
+    return images
+
+
+
+  def distribute_to_secondaries(self, images):
+    """
+    Send the latest time, metadata and the images meant for each secondary
+    to all secondaries at once, see download_secondary_images()
+    """
+
+    if not SECONDARIES:
+      return {}
+
+    metadata_bundle = build_metadata_bundle({
+      'director': DIRECTOR_REPO_META_DIR,
+      'image': IMAGE_REPO_META_DIR
+    })
+
+    results = send_to_secondaries(self.time_attestation, metadata_bundle, images)
+
+    for ecu_serial, error in results.items():
+      if error is None:
+        print(f'{GREEN}Sent time, metadata and images to secondary {ecu_serial}{ENDCOLORS}')
+      else:
+        print(f'{RED}Unable to send to secondary {ecu_serial}: {error}{ENDCOLORS}')
+
+    return results
+
+
+
+  def write_mock_image(self, installed_image):
+    # a bare filename is written to the working directory
+    if os.path.dirname(installed_image['path']):
+      os.makedirs(os.path.dirname(installed_image['path']), exist_ok=True)
+    with open(installed_image['path'], 'w') as f:
+      f.write(installed_image['body'])
 
 
   def mock_install_primary_image(self, path, body):
     self.INSTALLED_PRIMARY_ECU_IMAGE['path'] = path
     self.INSTALLED_PRIMARY_ECU_IMAGE['body'] = body
+    self.write_mock_image(self.INSTALLED_PRIMARY_ECU_IMAGE)
 
 
   def mock_install_secondary_image(self, path, body):
     self.INSTALLED_SECONDARY_ECU_IMAGE['path'] = path
     self.INSTALLED_SECONDARY_ECU_IMAGE['body'] = body
+    self.write_mock_image(self.INSTALLED_SECONDARY_ECU_IMAGE)
 
 
   def mock_attack(self, attack, is_primary):
@@ -369,48 +658,66 @@ class Primary():
 
 
   def update_cycle(self): 
+    with self.tracer.cycle() as cycle:
+      cycle['outcome'] = self._update_cycle()
+      return cycle['outcome']
+
+
+
+  def _update_cycle(self):
 
     print('Starting update cycle')
 
     print('Fetching secure time')
-    self.get_signed_time(nonces=[])
+    with self.tracer.span('secure_time'):
+      self.get_signed_time(nonces=[])
     print(f'{GREEN} Secure time fetched {ENDCOLORS}')
 
+    with self.tracer.span('timestamp_check', repo='director'):
+      unchanged = self.director_metadata_unchanged()
+
+    if unchanged:
+      print(f'{YELLOW}No-op cycle, director snapshot is unchanged{ENDCOLORS}')
+      return CYCLE_NO_OP
+
     print('Attempting to refresh image and director metadata files')
     try:
       self.refresh_toplevel_metadata()
     except Exception as e:
       print(f'{RED}{e}{ENDCOLORS}')
-      return
+      return CYCLE_FAILED
     print(f'{GREEN}Metadata from director and image repo was fetched{ENDCOLORS}')
 
     directed_targets = self.get_target_list_from_director()
 
     if not directed_targets: 
       print(f'{YELLOW}No new targets to pull{ENDCOLORS}')
+      return CYCLE_NO_TARGETS
 
-    else: 
-      print(f'{GREEN}New targets to pull, attempting to verify{ENDCOLORS}')
+    print(f'{GREEN}New targets to pull, attempting to verify{ENDCOLORS}')
 
-      verified_targets = []
+    verified_targets = []
 
-      # Validate each of the directed targets 
+    # Validate each of the directed targets 
+    with self.tracer.span('validation', targets=len(directed_targets)):
       for directed_target in directed_targets: 
-        if self.get_validated_target_info(directed_target['path']):
+        if self.get_validated_target_info(directed_target):
           verified_targets.append(directed_target)
         else:
           print(RED + 'Director has instructed us to download a target (' +
-            directed_target['filepath'] + ') that is not validated by the combination of '
+            directed_target.path + ') that is not validated by the combination of '
             'Image + Director Repositories. That update IS BEING SKIPPED.' + ENDCOLORS)
 
-      #TODO check if the custom attribute `ecu_serial` matches
+    print(f'{GREEN}All new targets to pull have been verified successfully{ENDCOLORS}')
+    
+    # the primary's own image is installed by hand, see mock_install_primary_image()
+    with self.tracer.span('download', targets=len(verified_targets)):
+      images = self.download_secondary_images(verified_targets)
 
-      print(f'{GREEN}All new targets to pull have been verified successfully{ENDCOLORS}')
-      
-      for verified_target in verified_targets:
-        print(f"{GREEN}Attempting to download target: {verified_target['path']}{ENDCOLORS}")
-        # self.image_updater.download_target(verified_target, verified_target['path'])
+    with self.tracer.span('distribute'):
+      self.distribute_to_secondaries(images)
 
+    return CYCLE_COMPLETE
 
 
 
@@ -454,7 +761,12 @@ def main():
 
   print(f'{GREEN}Creating mocked primary client...{ENDCOLORS}')
 
-  primary = Primary()
+  histogram = HistogramSink()
+  sinks = [histogram]
+  if TIMING_LOG_PATH:
+    sinks.append(JsonLinesSink(TIMING_LOG_PATH))
+
+  primary = Primary(tracer=Tracer(sinks=sinks, profile_dir=PROFILE_DIR))
 
   actions = [
     '1. Inspect generated robot manifest',
@@ -463,7 +775,9 @@ def main():
     '4. Run update cycle',
     '5. "Install" image on primary ECU',
     '6. "Install" image on secondary ECU',
-    '7. "Report" detected attack on ECU'
+    '7. "Report" detected attack on ECU',
+    '8. Send time, metadata and images to secondaries',
+    '9. Show update cycle timings'
   ]
 
   while True:
@@ -499,8 +813,11 @@ def main():
     #Refresh top level metadata
     elif action_idx == 3:
       print(f'{GREEN}Attempting to refresh top level metadata{ENDCOLORS}')
-      primary.refresh_toplevel_metadata()
-      pass
+      try:
+        primary.refresh_toplevel_metadata()
+      except Exception as e:
+        print(f'{RED}{e}{ENDCOLORS}')
+        print(f'{RED}Unable to update manifest{ENDCOLORS}')
 
     #Run update cycle
     elif action_idx == 4:
@@ -529,6 +846,19 @@ def main():
       primary.mock_attack(attack, ecu)
       print(f'{GREEN}Changed the "Reported" attack field, will be reported when the next manifest is sent{ENDCOLORS}')
 
+    #Send time, metadata and images to the secondaries
+    elif action_idx == 8:
+      print(f'{GREEN}Attempting to send time, metadata and images to secondaries{ENDCOLORS}')
+      verified_targets = [target for target in primary.get_target_list_from_director() if primary.get_validated_target_info(target)]
+      primary.distribute_to_secondaries(primary.download_secondary_images(verified_targets))
+
+    #Show the timings of each phase recorded so far
+    elif action_idx == 9:
+      print(f'{GREEN}Update cycle timings (ms): {ENDCOLORS}')
+      print(json.dumps(histogram.summary(), indent=2))
+      print(f'{GREEN}Mirror latencies: {ENDCOLORS}')
+      print(json.dumps({'director': primary.director_mirrors.stats(), 'image': primary.image_mirrors.stats()}, indent=2))
+
 
     else: 
       print('Unknown action')
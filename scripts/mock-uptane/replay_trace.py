@@ -0,0 +1,197 @@
+import sys
+import json
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from styles import GREEN, YELLOW, ENDCOLORS
+from common import VEHICLE_ID_HEADER
+from request_trace import load_trace
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+TRACE REPLAY
+
+Plays a trace recorded by the server (see request_trace.py) back against a server, keeping the gaps between
+requests but divided by `speed`, so 10 replays an hour of traffic in six minutes. Requests are sent by a
+pool of `clients` threads, each with its own connection, on behalf of the vehicle that sent them.
+
+    python replay_trace.py trace.jsonl [base_url] [speed] [clients] > report.json
+
+GETs are replayed as recorded. Traces don't keep request bodies, so of the requests with a body only those
+vehicles make are replayed, with a stand-in body of about the recorded size: manifests (which the server
+queues and later rejects) and time attestation requests. Other writes, and GETs that change the repos such
+as /init, are skipped and counted.
+
+The report is printed as json with the latency distribution of each route, next to the latency the server
+saw when the trace was recorded. `late_ms` is how far behind schedule requests were sent; if it grows the
+replay needs more clients to keep up with the speed asked for, and the latencies say more about the client
+than the server.
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+DEFAULT_BASE_URL = 'http://localhost:5000'
+DEFAULT_SPEED = 1
+DEFAULT_CLIENTS = 64
+REQUEST_TIMEOUT_SECONDS = 30
+
+# GETs that change what the server holds
+SKIPPED_ROUTES = {'/init', '/resign-timestamp'}
+
+
+def manifest_body(size):
+    # the shape of a manifest so it is queued, padded to the recorded size
+    return {'signatures': [], 'signed': {'padding': 'x' * max(0, size - 40)}}
+
+
+
+def attestation_body(size):
+    # a nonce is about 10 bytes of json
+    return {'nonces': [random.randint(0, 2 ** 31) for _ in range(max(1, size // 12))]}
+
+
+
+# (method, route) -> stand-in body of about the given size
+BODIES = {
+    ('POST', '/director/vehicles/<id>/manifest'): manifest_body,
+    ('POST', '/timeserver/attestation'): attestation_body,
+}
+
+
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+
+class Replay():
+
+    def __init__(self, base_url, speed, clients):
+        self.base_url = base_url.rstrip('/')
+        self.speed = speed
+        self.pool = ThreadPoolExecutor(max_workers=clients)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # route -> list of (status, latency ms)
+        self.results = {}
+        self.late_ms = []
+        self.skipped = 0
+
+
+    def _session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+
+    def _send(self, record, due_at):
+        started_at = time.monotonic()
+        headers = {VEHICLE_ID_HEADER: record['vin']} if record.get('vin') else {}
+        body = BODIES.get((record['method'], record['route']))
+
+        try:
+            response = self._session().request(
+                record['method'],
+                self.base_url + record['path'],
+                json=body(record['request_bytes']) if body else None,
+                headers=headers,
+                timeout=REQUEST_TIMEOUT_SECONDS)
+            status = response.status_code
+        except requests.exceptions.RequestException:
+            status = None
+        latency_ms = (time.monotonic() - started_at) * 1000
+
+        with self.lock:
+            self.results.setdefault(record['route'], []).append((status, latency_ms))
+            self.late_ms.append(max(0, started_at - due_at) * 1000)
+
+
+    def replayable(self, record):
+        if record['route'] is None or record['route'] in SKIPPED_ROUTES:
+            return False
+        return record['method'] == 'GET' or (record['method'], record['route']) in BODIES
+
+
+    def run(self, records):
+        start = time.monotonic()
+        first_at = records[0]['at'] if records else 0
+
+        for record in records:
+            if not self.replayable(record):
+                self.skipped += 1
+                continue
+            due_at = start + (record['at'] - first_at) / self.speed
+            wait = due_at - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self.pool.submit(self._send, record, due_at)
+
+        self.pool.shutdown(wait=True)
+        return time.monotonic() - start
+
+
+    def report(self, records, seconds):
+        recorded = {}
+        for record in records:
+            recorded.setdefault(record['route'], []).append(record['ms'])
+
+        routes = {}
+        for route, results in sorted(self.results.items()):
+            ordered = sorted(latency for _, latency in results)
+            statuses = {}
+            for status, _ in results:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+            recorded_ms = sorted(recorded.get(route, [0]))
+            routes[route] = {
+                'count': len(results),
+                'statuses': statuses,
+                'p50_ms': round(percentile(ordered, 0.5), 3),
+                'p90_ms': round(percentile(ordered, 0.9), 3),
+                'p99_ms': round(percentile(ordered, 0.99), 3),
+                'max_ms': round(ordered[-1], 3),
+                'recorded_p50_ms': percentile(recorded_ms, 0.5),
+                'recorded_p99_ms': percentile(recorded_ms, 0.99),
+            }
+
+        sent = sum(len(results) for results in self.results.values())
+        late = sorted(self.late_ms) or [0]
+        return {
+            'speed': self.speed,
+            'recorded_seconds': round(records[-1]['at'] - records[0]['at'], 3) if records else 0,
+            'replay_seconds': round(seconds, 3),
+            'sent': sent,
+            'skipped': self.skipped,
+            'requests_per_second': round(sent / seconds, 1) if seconds else 0,
+            'late_p50_ms': round(percentile(late, 0.5), 3),
+            'late_p99_ms': round(percentile(late, 0.99), 3),
+            'routes': routes,
+        }
+
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python replay_trace.py trace.jsonl [base_url] [speed] [clients]', file=sys.stderr)
+        sys.exit(2)
+
+    records = load_trace(sys.argv[1])
+    base_url = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_BASE_URL
+    speed = float(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_SPEED
+    clients = int(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_CLIENTS
+
+    print(f'{YELLOW}replaying {len(records)} requests against {base_url} at {speed}x with {clients} clients{ENDCOLORS}',
+        file=sys.stderr)
+    replay = Replay(base_url, speed, clients)
+    report = replay.report(records, replay.run(records))
+    print(json.dumps(report, indent=2))
+
+    for route, stats in report['routes'].items():
+        print(f"{GREEN}{route}: {stats['count']} requests, p50 {stats['p50_ms']}ms, p99 {stats['p99_ms']}ms "
+            f"(recorded p50 {stats['recorded_p50_ms']}ms){ENDCOLORS}", file=sys.stderr)
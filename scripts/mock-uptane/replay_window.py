@@ -0,0 +1,170 @@
+import mmap
+import time
+import hashlib
+from metadata_store import SharedLock
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+REPLAY DETECTION
+
+Remembers the values an ecu has recently sent that must never be sent twice, the report_counter of its ecu
+version reports and the nonces of its time attestation requests, so a report or request that is played back
+is turned away.
+
+Each ecu gets a slot with a ring buffer of its last `entries` values and when they were seen. A value counts as
+seen while it is in the ring and younger than `window_seconds`, so a lookup is a scan of `entries` 8 byte
+integers whatever the size of the fleet. The rings of all ecus share flat arrays, which costs about 12 bytes
+per entry, and values are kept as they are, so they have to be 64 bit signed integers.
+
+Slots are found by a 64 bit hash of the ecu serial in a table of `max_ecus` slots. An ecu can only go in one of
+the PROBE_SLOTS slots after the one its hash points at, and once those are taken the least recently seen of
+them gives its slot up.
+
+The arrays live in a shared anonymous mapping, so the worker processes forked after a window is created all
+see the same one. Each worker attaches the window's lock to a lock file, which makes the lock exclusive across
+them too. Nothing is kept across restarts.
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+PROBE_SLOTS = 8
+MIN_VALUE = -2 ** 63
+MAX_VALUE = 2 ** 63 - 1
+
+# shared counters
+ECUS = 0
+CHECKED = 1
+REPLAYS = 2
+EVICTED = 3
+
+
+
+def storable(value):
+    return isinstance(value, int) and MIN_VALUE <= value <= MAX_VALUE
+
+
+
+class ReplayWindow():
+
+    def __init__(self, entries, window_seconds, max_ecus):
+        self.entries = entries
+        self.window_seconds = window_seconds
+        self.max_ecus = max_ecus
+        self.lock = SharedLock()
+
+        # 8 byte arrays first, then 4 then 2, so every array is aligned
+        layout = [
+            ('counts', 'Q', 4),
+            # the hash of the ecu serial in each slot, 0 for a free one
+            ('keys', 'Q', max_ecus),
+            # the ring of slot s is values[s * entries:(s + 1) * entries]
+            ('values', 'q', max_ecus * entries),
+            # in seconds since the epoch, 0 marks a free slot or an empty entry
+            ('last_seen', 'I', max_ecus),
+            ('seen_at', 'I', max_ecus * entries),
+            # where each ring is written to next
+            ('next', 'H', max_ecus),
+        ]
+        sizes = {'Q': 8, 'q': 8, 'I': 4, 'H': 2}
+        # untouched pages of the mapping take no memory
+        self.mm = mmap.mmap(-1, sum(sizes[fmt] * length for _, fmt, length in layout))
+        view = memoryview(self.mm)
+        offset = 0
+        for name, fmt, length in layout:
+            setattr(self, name, view[offset:offset + sizes[fmt] * length].cast(fmt))
+            offset += sizes[fmt] * length
+
+
+    def attach(self, path):
+        '''
+        Hold the lock against the other processes that share the window,
+        each of them has to attach after it was forked
+        '''
+        self.lock.attach(path)
+
+
+    def _slot(self, ecu_serial, now):
+        # caller holds the lock
+        key = int.from_bytes(hashlib.blake2b(ecu_serial.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+        home = key % self.max_ecus
+
+        # a free slot is seen least recently of all
+        victim = None
+        for probe in range(min(PROBE_SLOTS, self.max_ecus)):
+            slot = (home + probe) % self.max_ecus
+            if self.keys[slot] == key:
+                self.last_seen[slot] = now
+                return slot
+            if victim is None or self.last_seen[slot] < self.last_seen[victim]:
+                victim = slot
+
+        if self.keys[victim]:
+            start = victim * self.entries
+            self.seen_at[start:start + self.entries] = memoryview(bytes(self.seen_at.itemsize * self.entries)).cast('I')
+            self.counts[EVICTED] += 1
+        else:
+            self.counts[ECUS] += 1
+        self.keys[victim] = key
+        self.last_seen[victim] = now
+        self.next[victim] = 0
+        return victim
+
+
+    def _seen(self, slot, value, now):
+        start = slot * self.entries
+        if value not in self.values[start:start + self.entries]:
+            return False
+        for i in range(start, start + self.entries):
+            if self.values[i] == value and self.seen_at[i] and now - self.seen_at[i] < self.window_seconds:
+                return True
+        return False
+
+
+    def claim(self, pairs):
+        '''
+        Remember (ecu serial, value) pairs unless any of them has been seen in
+        the window. Returns the pairs that are replays, in which case none of
+        them are remembered
+        '''
+        if not all(storable(value) for _, value in pairs):
+            raise ValueError('replay window values must be 64 bit signed integers')
+        now = int(time.time())
+
+        with self.lock:
+            self.counts[CHECKED] += len(pairs)
+            slots = [(self._slot(ecu_serial, now), value) for ecu_serial, value in pairs]
+
+            replayed = []
+            claimed = set()
+            for pair, (slot, value) in zip(pairs, slots):
+                # the same value twice in one go is a replay as well
+                if (slot, value) in claimed or self._seen(slot, value, now):
+                    replayed.append(pair)
+                claimed.add((slot, value))
+            if replayed:
+                self.counts[REPLAYS] += len(replayed)
+                return replayed
+
+            for slot, value in slots:
+                i = slot * self.entries + self.next[slot]
+                self.values[i] = value
+                self.seen_at[i] = now
+                self.next[slot] = (self.next[slot] + 1) % self.entries
+            return []
+
+
+    def get_metrics(self):
+        with self.lock:
+            return {
+                'checked': self.counts[CHECKED],
+                'replays': self.counts[REPLAYS],
+                'evicted': self.counts[EVICTED],
+                'ecus': self.counts[ECUS],
+                'max_ecus': self.max_ecus,
+                'ring_bytes': len(self.mm),
+            }
@@ -0,0 +1,85 @@
+import json
+import time
+import atexit
+import threading
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+REQUEST TRACES
+
+When SERVER_TRACE_PATH is set the server appends one compact json line per request it answers to that file:
+
+    {"at":12.345678,"method":"GET","route":"/director/<metadata>.json","path":"/director/timestamp.json",
+     "vin":"seed-robot","request_bytes":0,"response_bytes":812,"status":200,"ms":1.204}
+
+`at` is when the request arrived in seconds since the trace was started, so the inter-arrival times are the
+differences between consecutive lines once they are sorted by it (lines are written as requests finish, not
+as they arrive). `route` is the flask rule the request matched and `vin` the vehicle it came from if it could
+be told. Request bodies are not kept, only their size. replay_trace.py plays a trace back against a server.
+
+Lines are buffered and written out at most every FLUSH_SECONDS, and when the server exits, so tracing costs a
+dict and a json.dumps per request.
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+FLUSH_SECONDS = 1
+
+
+class TraceRecorder():
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.lines = []
+        self.flushed_at = self.started_at
+        atexit.register(self.flush)
+
+
+    def record(self, arrived_at, method, route, path, vin, request_bytes, response_bytes, status, seconds):
+        line = json.dumps({
+            'at': round(arrived_at - self.started_at, 6),
+            'method': method,
+            'route': route,
+            'path': path,
+            'vin': vin,
+            'request_bytes': request_bytes,
+            'response_bytes': response_bytes,
+            'status': status,
+            'ms': round(seconds * 1000, 3),
+        }, separators=(',', ':'))
+
+        with self.lock:
+            self.lines.append(line)
+            if time.monotonic() - self.flushed_at >= FLUSH_SECONDS:
+                self._flush()
+
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+
+    def _flush(self):
+        # caller holds the lock, so batches are never interleaved in the file
+        if self.lines:
+            with open(self.path, 'a') as f:
+                f.write('\n'.join(self.lines) + '\n')
+        self.lines = []
+        self.flushed_at = time.monotonic()
+
+
+
+def load_trace(path):
+    '''
+    The requests of a trace in the order they arrived
+    '''
+    with open(path, 'r') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return sorted(records, key=lambda record: record['at'])
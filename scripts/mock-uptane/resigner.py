@@ -0,0 +1,223 @@
+import os
+import time
+import heapq
+import zlib
+import threading
+from datetime import datetime, timedelta
+from tuf.api.metadata import Metadata, MetaFile, Snapshot, Targets, Timestamp
+from tuf.api.serialization.json import JSONSerializer
+from securesystemslib.signer import SSlibSigner
+from common import _in, get_meta_file
+from metadata_writer import MetadataTransaction, committer
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+TUF RESIGNER
+
+Background worker that keeps the targets, snapshot and timestamp metadata of every repo from expiring. This
+covers the image repo, the director repo and the director metadata of each vehicle.
+
+Every tracked metadata directory sits in a priority queue keyed by when it next needs signing, which is its
+earliest expiry minus a lead time. A stable per directory offset spreads directories that expire together
+over a window, and signing is rate limited so a burst of expiries never turns into a burst of signing.
+
+Each directory is versioned on its own. Re-signing a role bumps that role's version only, and the roles that
+reference it are re-signed to point at the new version.
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+def load_repo_metadata(meta_dir):
+    '''
+    The current timestamp, snapshot and targets of a metadata directory
+    '''
+    timestamp = Metadata[Timestamp].from_bytes(committer.read_bytes(os.path.join(meta_dir, 'timestamp.json')))
+    snapshot_ver = timestamp.signed.snapshot_meta.version
+    snapshot = Metadata[Snapshot].from_bytes(committer.read_bytes(os.path.join(meta_dir, f'{snapshot_ver}.snapshot.json')))
+    targets_ver = snapshot.signed.meta['targets.json'].version
+    targets = Metadata[Targets].from_bytes(committer.read_bytes(os.path.join(meta_dir, f'{targets_ver}.targets.json')))
+
+    return {
+        'timestamp': timestamp,
+        'snapshot': snapshot,
+        'targets': targets,
+    }
+
+
+
+def resign_repo(meta_dir, keys, txn, lead=timedelta(0)):
+    '''
+    Re-sign the roles of meta_dir that expire within `lead`. The timestamp is
+    always re-signed. keys maps role name to a securesystemslib key, the new
+    files are staged in txn for the caller to commit
+    '''
+    metadata = load_repo_metadata(meta_dir)
+    soon = datetime.utcnow() + lead
+    serializer = JSONSerializer(compact=True)
+
+    targets = metadata['targets']
+    snapshot = metadata['snapshot']
+    timestamp = metadata['timestamp']
+
+    resign_targets = targets.signed.expires <= soon
+    resign_snapshot = resign_targets or snapshot.signed.expires <= soon
+
+    if resign_targets:
+        targets.signed.version += 1
+        targets.signed.expires = _in(7)
+        targets.signatures.clear()
+        targets.sign(SSlibSigner(keys['targets']))
+        targets_bytes = targets.to_bytes(serializer)
+        txn.stage_served(os.path.join(meta_dir, f'{targets.signed.version}.targets.json'), targets_bytes)
+
+    if resign_snapshot:
+        snapshot.signed.version += 1
+        snapshot.signed.expires = _in(7)
+        if resign_targets:
+            snapshot.signed.meta['targets.json'] = get_meta_file(targets.signed.version, targets_bytes)
+        snapshot.signatures.clear()
+        snapshot.sign(SSlibSigner(keys['snapshot']))
+        txn.stage_metadata(os.path.join(meta_dir, f'{snapshot.signed.version}.snapshot.json'), snapshot, serializer)
+
+    timestamp.signed.version += 1
+    timestamp.signed.expires = _in(1)
+    timestamp.signed.snapshot_meta = MetaFile(snapshot.signed.version)
+    timestamp.signatures.clear()
+    timestamp.sign(SSlibSigner(keys['timestamp']))
+    txn.stage_metadata(os.path.join(meta_dir, 'timestamp.json'), timestamp, serializer)
+
+    return {
+        'timestamp': timestamp.signed.version,
+        'snapshot': snapshot.signed.version,
+        'targets': targets.signed.version,
+    }
+
+
+
+def next_expiry(meta_dir):
+    metadata = load_repo_metadata(meta_dir)
+    return min(md.signed.expires for md in metadata.values())
+
+
+
+class Resigner(threading.Thread):
+
+    def __init__(self, lock, lead_seconds, spread_seconds, max_per_second):
+        super().__init__(daemon=True)
+        self.lock = lock
+        self.lead = timedelta(seconds=lead_seconds)
+        self.spread_seconds = spread_seconds
+        self.min_interval = 1 / max_per_second
+        self.condition = threading.Condition()
+        # heap of (due at, meta dir), entries that no longer match `scheduled` are stale and skipped
+        self.queue = []
+        self.scheduled = {}
+        self.keys = {}
+        # set in a process that leaves re-signing to another one, which picks up what this one writes from disk
+        self.elsewhere = False
+        self.last_signed_at = 0
+        self.metrics = {
+            'resigned': 0,
+            'errors': 0,
+            'last_lag_seconds': 0,
+            'max_lag_seconds': 0,
+            'min_seconds_to_expiry': None,
+        }
+
+
+    def _due_at(self, meta_dir, expires):
+        # a stable offset per directory so directories expiring together are spread out
+        offset = zlib.crc32(meta_dir.encode('utf-8')) % self.spread_seconds if self.spread_seconds else 0
+        due = expires - self.lead - timedelta(seconds=offset)
+        return time.time() + (due - datetime.utcnow()).total_seconds()
+
+
+    def _schedule(self, meta_dir, due_at):
+        with self.condition:
+            self.scheduled[meta_dir] = due_at
+            heapq.heappush(self.queue, (due_at, meta_dir))
+            self.condition.notify()
+
+
+    def track(self, meta_dir, keys):
+        '''
+        Start tracking a metadata directory, or reschedule it after it was 
+        written to. keys are the role keys used to sign it
+        '''
+        if self.elsewhere:
+            return
+
+        with self.lock:
+            expires = next_expiry(meta_dir)
+
+        self.keys[meta_dir] = keys
+        self._schedule(meta_dir, self._due_at(meta_dir, expires))
+
+
+    def _pop_due(self):
+        with self.condition:
+            while True:
+                while self.queue and self.scheduled.get(self.queue[0][1]) != self.queue[0][0]:
+                    heapq.heappop(self.queue)
+                if self.queue and self.queue[0][0] <= time.time():
+                    return heapq.heappop(self.queue)
+                self.condition.wait(self.queue[0][0] - time.time() if self.queue else None)
+
+
+    def run(self):
+        while True:
+            due_at, meta_dir = self._pop_due()
+
+            # waited out before taking the lock, every writer waits on it
+            wait = self.last_signed_at + self.min_interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+            try:
+                txn = MetadataTransaction()
+                with self.lock:
+                    # it may have been written to since it was scheduled
+                    expires = next_expiry(meta_dir)
+                    if self._due_at(meta_dir, expires) > time.time():
+                        self._schedule(meta_dir, self._due_at(meta_dir, expires))
+                        continue
+
+                    resign_repo(meta_dir, self.keys[meta_dir], txn, self.lead)
+                    committer.submit(txn)
+                    self.last_signed_at = time.time()
+                    expires_after = next_expiry(meta_dir)
+
+                committer.wait(txn)
+
+            # the only thread re-signing, whatever goes wrong with one directory it carries on with the rest
+            except Exception as e:
+                print(f'unable to resign {meta_dir}: {e}')
+                self.metrics['errors'] += 1
+                # try again once the spread window has passed rather than spinning
+                self._schedule(meta_dir, time.time() + max(self.spread_seconds, 1))
+                continue
+
+            lag = round(max(0, self.last_signed_at - due_at), 3)
+            seconds_to_expiry = round((expires - datetime.utcnow()).total_seconds(), 3)
+            self.metrics['resigned'] += 1
+            self.metrics['last_lag_seconds'] = lag
+            self.metrics['max_lag_seconds'] = max(self.metrics['max_lag_seconds'], lag)
+            if self.metrics['min_seconds_to_expiry'] is None or seconds_to_expiry < self.metrics['min_seconds_to_expiry']:
+                self.metrics['min_seconds_to_expiry'] = seconds_to_expiry
+
+            self._schedule(meta_dir, self._due_at(meta_dir, expires_after))
+
+
+    def get_metrics(self):
+        with self.condition:
+            next_due = min(self.scheduled.values()) if self.scheduled else None
+            return {
+                **self.metrics,
+                'tracked': len(self.scheduled),
+                'next_due_in_seconds': round(next_due - time.time(), 3) if next_due else None,
+            }
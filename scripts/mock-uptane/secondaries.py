@@ -0,0 +1,251 @@
+import os
+import sys
+import json
+import struct
+import socket
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+from styles import GREEN, RED, ENDCOLORS
+from common import SECONDARIES, PRIMARY_FS_ROOT_PATH
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+SEND TIME, METADATA AND IMAGES TO SECONDARIES [Uptane Spec 5.4.2.5 - 5.4.2.7]
+
+The in-vehicle network is stood in for by a plain TCP connection per secondary. Every secondary is sent the
+latest time attestation, then the metadata bundle, then any images meant for it, over a single connection.
+All secondaries are served at the same time so distribution takes as long as the slowest one.
+
+Every message is a frame: a 4 byte big endian header length, a json header and then `length` payload bytes.
+The secondary replies to each frame with an `ack` frame.
+
+A mock secondary can be started with:
+  python secondaries.py <ecu_serial> <port>
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+CHUNK_SIZE = 64 * 1024
+HEADER_PREFIX = struct.Struct('!I')
+
+
+class SecondaryError(Exception):
+    pass
+
+
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+FRAMING
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+def _send_header(sock, header):
+    header_bytes = json.dumps(header).encode('utf-8')
+    sock.sendall(HEADER_PREFIX.pack(len(header_bytes)) + header_bytes)
+
+
+def _recv_exact(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            raise SecondaryError('connection closed mid frame')
+        received += n
+    return bytes(buf)
+
+
+def _recv_header(sock):
+    prefix = sock.recv(HEADER_PREFIX.size, socket.MSG_WAITALL)
+    if not prefix:
+        return None
+    if len(prefix) != HEADER_PREFIX.size:
+        raise SecondaryError('connection closed mid frame')
+    (header_len,) = HEADER_PREFIX.unpack(prefix)
+    return json.loads(_recv_exact(sock, header_len))
+
+
+def _expect_ack(sock):
+    ack = _recv_header(sock)
+    if not ack or ack.get('type') != 'ack':
+        raise SecondaryError(f'unexpected reply from secondary: {ack}')
+    if not ack.get('ok'):
+        raise SecondaryError(ack.get('error', 'secondary rejected the message'))
+
+
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+PRIMARY SIDE
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+def build_metadata_bundle(repo_meta_dirs):
+    '''
+    Serialize the metadata of every repo once, the same bytes are sent to
+    every secondary. Files are kept as the raw strings we verified so the
+    secondary can check the signatures itself
+    '''
+    bundle = {}
+    for repo_name, meta_dir in repo_meta_dirs.items():
+        bundle[repo_name] = {}
+        for file_name in sorted(os.listdir(meta_dir)):
+            with open(os.path.join(meta_dir, file_name), 'r') as f:
+                bundle[repo_name][file_name] = f.read()
+
+    return json.dumps(bundle, separators=(',', ':')).encode('utf-8')
+
+
+
+def send_to_secondary(secondary, time_payload, metadata_bundle, images):
+    '''
+    Send the time, metadata and images to a single secondary. Images are
+    (name, path) pairs and are streamed from disk rather than loaded whole
+    '''
+    with socket.create_connection((secondary['host'], secondary['port']), timeout=secondary.get('timeout', 30)) as sock:
+
+        _send_header(sock, {'type': 'time', 'length': len(time_payload)})
+        sock.sendall(time_payload)
+        _expect_ack(sock)
+
+        _send_header(sock, {'type': 'metadata', 'length': len(metadata_bundle)})
+        sock.sendall(metadata_bundle)
+        _expect_ack(sock)
+
+        for name, path in images:
+            with open(path, 'rb') as f:
+                _send_header(sock, {'type': 'image', 'name': name, 'length': os.fstat(f.fileno()).st_size})
+                sock.sendfile(f)
+            _expect_ack(sock)
+
+
+
+def send_to_secondaries(time_attestation, metadata_bundle, images, secondaries=SECONDARIES):
+    '''
+    Fan out to every secondary at once. `images` maps an ecu serial to the
+    (name, path) pairs of the images for it. Returns a dict of ecu serial to
+    None on success or the error message on failure
+    '''
+    if not secondaries:
+        return {}
+
+    time_payload = json.dumps(time_attestation).encode('utf-8')
+
+    with ThreadPoolExecutor(max_workers=len(secondaries)) as pool:
+        futures = {
+            secondary['ecu_serial']: pool.submit(send_to_secondary, secondary, time_payload, metadata_bundle,
+                images.get(secondary['ecu_serial'], []))
+            for secondary in secondaries
+        }
+
+    results = {}
+    for ecu_serial, future in futures.items():
+        try:
+            future.result()
+            results[ecu_serial] = None
+        except (OSError, SecondaryError) as e:
+            results[ecu_serial] = str(e)
+
+    return results
+
+
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+MOCK SECONDARY
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+class SecondaryHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        while True:
+            try:
+                header = _recv_header(self.request)
+            except (OSError, ValueError, SecondaryError) as e:
+                # the rest of the stream can't be framed any more
+                _send_header(self.request, {'type': 'ack', 'ok': False, 'error': f'bad header: {e}'})
+                return
+            if header is None:
+                return
+            try:
+                self.server.receive(header, self.request)
+                _send_header(self.request, {'type': 'ack', 'ok': True})
+            except (OSError, ValueError, SecondaryError) as e:
+                _send_header(self.request, {'type': 'ack', 'ok': False, 'error': str(e)})
+                return
+
+
+
+class MockSecondary(socketserver.ThreadingTCPServer):
+    '''
+    Receives time, metadata and images from the primary and stores them under
+    fs_root. Nothing is verified, this only stands in for a real secondary
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, ecu_serial, port, fs_root, host='localhost'):
+        super().__init__((host, port), SecondaryHandler)
+        self.ecu_serial = ecu_serial
+        self.fs_root = fs_root
+        self.time_attestation = None
+        os.makedirs(os.path.join(fs_root, 'targets'), exist_ok=True)
+
+
+    def receive(self, header, sock):
+        # the payload can't be skipped without its length, so a bad header ends the connection
+        if not isinstance(header, dict) or header.get('type') not in ('time', 'metadata', 'image'):
+            raise SecondaryError(f'unknown message: {header}')
+        if not isinstance(header.get('length'), int) or header['length'] < 0:
+            raise SecondaryError(f"{header['type']} message without a valid length")
+        if header['type'] == 'image' and not isinstance(header.get('name'), str):
+            raise SecondaryError('image message without a name')
+
+        if header['type'] == 'time':
+            self.time_attestation = json.loads(_recv_exact(sock, header['length']))
+
+        elif header['type'] == 'metadata':
+            bundle = json.loads(_recv_exact(sock, header['length']))
+            for repo_name, files in bundle.items():
+                meta_dir = os.path.join(self.fs_root, repo_name, 'metadata')
+                os.makedirs(meta_dir, exist_ok=True)
+                for file_name, content in files.items():
+                    with open(os.path.join(meta_dir, os.path.basename(file_name)), 'w') as f:
+                        f.write(content)
+
+        elif header['type'] == 'image':
+            remaining = header['length']
+            with open(os.path.join(self.fs_root, 'targets', os.path.basename(header['name'])), 'wb') as f:
+                while remaining:
+                    chunk = sock.recv(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise SecondaryError('connection closed mid image')
+                    f.write(chunk)
+                    remaining -= len(chunk)
+
+
+
+def main():
+
+    if len(sys.argv) < 3:
+        print('usage: python secondaries.py <ecu_serial> <port>')
+        exit(-1)
+
+    ecu_serial = sys.argv[1]
+    port = int(sys.argv[2])
+    fs_root = os.path.join(PRIMARY_FS_ROOT_PATH, 'secondaries', ecu_serial)
+
+    with MockSecondary(ecu_serial, port, fs_root) as secondary:
+        print(f'{GREEN}Mock secondary {ecu_serial} listening on port {port}{ENDCOLORS}')
+        try:
+            secondary.serve_forever()
+        except KeyboardInterrupt:
+            print(f'{RED}Mock secondary {ecu_serial} stopped{ENDCOLORS}')
+
+
+
+if __name__ == '__main__':
+    main()
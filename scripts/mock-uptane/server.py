@@ -1,5 +1,8 @@
 import os
-from flask import Flask, request, abort
+import time
+import threading
+from functools import lru_cache
+from flask import Flask, Response, request, abort, g, send_file
 from colored import stylize, fg
 import json
 from securesystemslib.keys import create_signature
@@ -15,7 +18,27 @@ from tuf.api.metadata import (
 )
 from tuf.api.serialization.json import JSONSerializer
 from securesystemslib.signer import SSlibSigner
-from common import DB_ROOT_PATH, PRIMARY_ECU_SERIAL, _get_time, _in, _load_key
+from common import (DB_ROOT_PATH, PRIMARY_ECU_SERIAL, _get_time, _in, _load_key, get_meta_file,
+    DELTA_MAX_VERSIONS, MANIFEST_QUEUE_PATH, MANIFEST_WORKERS, RESIGN_LEAD_SECONDS, VEHICLE_ID_HEADER,
+    ADMISSION_MAX_CONCURRENT, VEHICLE_REQUESTS_PER_SECOND, VEHICLE_REQUEST_BURST, RESIGN_SPREAD_SECONDS, RESIGN_MAX_PER_SECOND,
+    SERVER_TRACE_PATH, UPLOADS_PATH, UPLOAD_CHUNK_SIZE, UPLOAD_MAX_CHUNK_SIZE, CHUNK_SHA256_HEADER,
+    SERVER_WORKERS, SERVER_HOST, SERVER_PORT, WORKER_RESCAN_SECONDS, METADATA_STORE_PATH, METADATA_STORE_BYTES,
+    REPLAY_WINDOW_ENTRIES, REPLAY_WINDOW_SECONDS, REPLAY_MAX_ECUS, REPLAY_GLOBAL_ENTRIES, ASSIGNMENTS_PATH, ASSIGNMENT_WORKERS,
+    ASSIGNMENT_VEHICLES_PER_SECOND, ASSIGNMENT_BURST, VEHICLE_METADATA_REUSE_SECONDS)
+from resigner import Resigner, resign_repo
+from manifest_checks import check_vehicle_manifest, ManifestRejected, report_counters
+from blob_store import blob_path, link_blob, link_digest, adopt_blob, collect_garbage, blob_stats, is_blob_of
+from metadata_writer import MetadataTransaction, committer
+from metadata_encoding import ENCODINGS, negotiate
+from targets_delta import compute_targets_delta
+from manifest_queue import ManifestQueue
+from admission import AdmissionController, retry_after_header
+from request_trace import TraceRecorder
+from image_uploads import UploadStore, UploadError
+from metadata_store import MetadataStore, SharedLock
+from server_workers import serve_workers
+from replay_window import ReplayWindow, storable
+from assignments import AssignmentRunner
 
 
 app = Flask(__name__)
@@ -34,6 +57,57 @@ director_targets_key    = _load_key('director-targets')
 director_snapshot_key   = _load_key('director-snapshot')
 director_timestamp_key  = _load_key('director-timestamp')
 
+image_keys = {
+    'targets': image_targets_key,
+    'snapshot': image_snapshot_key,
+    'timestamp': image_timestamp_key,
+}
+director_keys = {
+    'targets': director_targets_key,
+    'snapshot': director_snapshot_key,
+    'timestamp': director_timestamp_key,
+}
+
+
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+BACKGROUND RESIGNER
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+# held while any metadata is being read to be bumped or written, by all the workers of a multi worker deployment
+metadata_lock = SharedLock()
+
+resigner = Resigner(metadata_lock, RESIGN_LEAD_SECONDS, RESIGN_SPREAD_SECONDS, RESIGN_MAX_PER_SECOND)
+
+
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+ADMISSION CONTROL
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+admission = AdmissionController(ADMISSION_MAX_CONCURRENT, VEHICLE_REQUESTS_PER_SECOND, VEHICLE_REQUEST_BURST)
+
+# endpoints for looking at the server itself are never turned away
+ADMISSION_EXEMPT = {
+    'init_repos', 'blobs', 'blobs_gc', 'metadata_commits', 'manifest_queue_metrics', 'resigner_metrics',
+    'admission_metrics', 'metadata_store_metrics', 'replay_metrics',
+}
+
+
+def requesting_vehicle():
+    '''
+    The vin of the vehicle making the request, if it can be told. Requests
+    from unknown clients only count towards the global limit
+    '''
+    if request.path.startswith('/director/vehicles/') and request.view_args:
+        return request.view_args.get('id')
+    return request.headers.get(VEHICLE_ID_HEADER)
+
+
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+REQUEST TRACE
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+trace = TraceRecorder(SERVER_TRACE_PATH) if SERVER_TRACE_PATH else None
+
 
 
 '''''''''''''''''''''''''''''''''''''''''''''''''''''''''
@@ -44,10 +118,11 @@ def get_metadata_versions(repo_name):
     Assume the director and image repos are always in sync for now
     '''
 
-    if os.path.isfile(os.path.join(DB_ROOT_PATH, repo_name, 'metadata', f'timestamp.json')):
-        curr_timestamp = Metadata[Timestamp].from_file(os.path.join(DB_ROOT_PATH, repo_name, 'metadata', f'timestamp.json'))
+    # read through the committer so versions staged by a commit that is still in flight are seen
+    if committer.exists(os.path.join(DB_ROOT_PATH, repo_name, 'metadata', f'timestamp.json')):
+        curr_timestamp = Metadata[Timestamp].from_bytes(committer.read_bytes(os.path.join(DB_ROOT_PATH, repo_name, 'metadata', f'timestamp.json')))
         curr_snapshot_ver = curr_timestamp.signed.snapshot_meta.version
-        curr_snapshot = Metadata[Snapshot].from_file(os.path.join(DB_ROOT_PATH, repo_name, 'metadata', f'{curr_snapshot_ver}.snapshot.json'))
+        curr_snapshot = Metadata[Snapshot].from_bytes(committer.read_bytes(os.path.join(DB_ROOT_PATH, repo_name, 'metadata', f'{curr_snapshot_ver}.snapshot.json')))
         curr_target_ver = curr_snapshot.signed.meta['targets.json'].version
 
         return {
@@ -76,7 +151,9 @@ def init_image_repo():
     root.signed.add_key(Key.from_securesystemslib_key(image_timestamp_key), 'timestamp')
     root.signed.add_key(Key.from_securesystemslib_key(image_root_key), 'root')
     root.sign(SSlibSigner(image_root_key))
-    root.to_file(os.path.join(DB_ROOT_PATH, 'image', 'metadata', 'root.json'), serializer=JSONSerializer(compact=False))
+    txn = MetadataTransaction()
+    txn.stage_metadata(os.path.join(DB_ROOT_PATH, 'image', 'metadata', 'root.json'), root, JSONSerializer(compact=True))
+    committer.commit(txn)
 
     put_target('init.txt', 'init_content', 'image')
     
@@ -92,7 +169,9 @@ def init_director_repo():
     root.signed.add_key(Key.from_securesystemslib_key(director_timestamp_key), 'timestamp')
     root.signed.add_key(Key.from_securesystemslib_key(director_root_key), 'root')
     root.sign(SSlibSigner(director_root_key))
-    root.to_file(os.path.join(DB_ROOT_PATH, 'director', 'metadata', 'root.json'), serializer=JSONSerializer(compact=False))
+    txn = MetadataTransaction()
+    txn.stage_metadata(os.path.join(DB_ROOT_PATH, 'director', 'metadata', 'root.json'), root, JSONSerializer(compact=True))
+    committer.commit(txn)
     
     put_target('init.txt', 'init_content', 'director')
     
@@ -100,6 +179,12 @@ def init_director_repo():
 
 
 
+# the nonces each vehicle asked the timeserver to sign, a vehicle's ecus send theirs through its primary.
+# Requests that don't name their vehicle are checked against the nonces of all of them
+attestation_nonces = ReplayWindow(REPLAY_WINDOW_ENTRIES, REPLAY_WINDOW_SECONDS, REPLAY_MAX_ECUS)
+global_attestation_nonces = ReplayWindow(REPLAY_GLOBAL_ENTRIES, REPLAY_WINDOW_SECONDS, 1)
+
+
 def get_time_attestation(nonces):
     signed = {
         'nonces': nonces,
@@ -116,12 +201,20 @@ def find_vehicle(vin):
     try:
         with open(os.path.join(DB_ROOT_PATH, 'director', 'inventory', vin), 'r') as f:
             return json.loads(f.read())
-    except:
+    except FileNotFoundError:
         print('vehicle not found')
         return None
 
 
 
+def write_vehicle(vehicle):
+    # replaced whole through the committer, so a reader never sees half of it
+    txn = MetadataTransaction()
+    txn.stage(os.path.join(DB_ROOT_PATH, 'director', 'inventory', vehicle['vin']), json.dumps(vehicle).encode('utf-8'))
+    committer.commit(txn)
+
+
+
 def create_vehicle(vin):
     vehicle = {
         'vin': vin,
@@ -130,8 +223,7 @@ def create_vehicle(vin):
         'image': None
     }
 
-    with open(os.path.join(DB_ROOT_PATH, 'director', 'inventory', vin), 'w') as f:
-        f.write(json.dumps(vehicle))
+    write_vehicle(vehicle)
     
     return vehicle
     
@@ -159,8 +251,7 @@ def add_ecu_to_vehicle(vin, ecu_serial, public_key):
 
     vehicle['ecus'].append(ecu)
 
-    with open(os.path.join(DB_ROOT_PATH, 'director', 'inventory', vin), 'w') as f:
-        f.write(json.dumps(vehicle))
+    write_vehicle(vehicle)
 
     return ecu
 
@@ -172,49 +263,124 @@ def list_targets():
 
 
 def get_target(id):
-    with open(os.path.join(DB_ROOT_PATH, 'targets', id), 'r') as f:
-        return f.read()
+    # clients of a repo with consistent snapshots ask for <sha256>.<name>, which is the blob itself
+    digest, _, name = id.partition('.')
+    if len(digest) == 64 and os.path.isfile(os.path.join(DB_ROOT_PATH, 'targets', name)):
+        # only the blob of that target, the store holds every vehicle's metadata as well
+        if not os.path.isfile(blob_path(digest)) or not is_blob_of(digest, os.path.join(DB_ROOT_PATH, 'targets', name)):
+            return abort(404)
+        # streamed, uploaded images can be several GB
+        return send_file(blob_path(digest), mimetype='application/octet-stream')
+
+    return send_file(os.path.join(DB_ROOT_PATH, 'targets', id), mimetype='application/octet-stream')
+
+
+
+def read_served_file(path):
+    # workers of a multi worker deployment serve from the shared store, files it does not hold come from disk
+    if committer.store:
+        data = committer.store.get(path)
+        if data is not None:
+            return data
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            return f.read()
+    return None
+
+
+
+def get_metadata_file(path):
+    # served exactly as stored, clients check the length and hashes of what they download. Clients
+    # that accept it get the copy compressed when it was written, see metadata_encoding.py
+    encoding = negotiate(request.headers.get('Accept-Encoding'))
+    data = read_served_file(path + ENCODINGS[encoding]) if encoding else None
+    if data is not None:
+        response = Response(data, mimetype='application/json')
+        response.headers['Content-Encoding'] = encoding
+    else:
+        data = read_served_file(path)
+        if data is None:
+            return abort(404)
+        response = Response(data, mimetype='application/json')
+
+    response.vary.add('Accept-Encoding')
+    return response
 
 
 
 def get_director_repo_timestamp():
-    with open(os.path.join(DB_ROOT_PATH, 'director', 'metadata', 'timestamp.json'), 'r') as f:
-        return json.loads(f.read())
+    return get_metadata_file(os.path.join(DB_ROOT_PATH, 'director', 'metadata', 'timestamp.json'))
 
 
 
 def get_image_repo_timestamp():
-    with open(os.path.join(DB_ROOT_PATH, 'image', 'metadata', 'timestamp.json'), 'r') as f:
-        return json.loads(f.read())
+    return get_metadata_file(os.path.join(DB_ROOT_PATH, 'image', 'metadata', 'timestamp.json'))
 
 
 
 def get_director_repo_metadata(version, role):
-    metadata_path = os.path.join(DB_ROOT_PATH, 'director', 'metadata', f'{version}.{role}.json')
-    if os.path.isfile(metadata_path):
-        with open(metadata_path, 'r') as f:
-            return json.loads(f.read())
-    else:
-        return abort(404)
+    return get_metadata_file(os.path.join(DB_ROOT_PATH, 'director', 'metadata', f'{version}.{role}.json'))
 
 
 
 def get_image_repo_metadata(version, role):
-    metadata_path = os.path.join(DB_ROOT_PATH, 'image', 'metadata', f'{version}.{role}.json')
-    if os.path.isfile(metadata_path):
-        with open(metadata_path, 'r') as f:
-            return json.loads(f.read())
-    else:
+    return get_metadata_file(os.path.join(DB_ROOT_PATH, 'image', 'metadata', f'{version}.{role}.json'))
+
+
+
+def get_targets_delta(repo_name, from_version):
+    '''
+    Signed delta from the targets version a client holds to the current one.
+    404 if that version is too old or unknown, the client downloads the whole
+    targets file instead
+    '''
+    to_version = get_metadata_versions(repo_name)['targets']
+    base_path = os.path.join(DB_ROOT_PATH, repo_name, 'metadata', f'{from_version}.targets.json')
+
+    if not 0 < from_version < to_version or to_version - from_version > DELTA_MAX_VERSIONS:
         return abort(404)
+    if not committer.exists(base_path):
+        return abort(404)
+
+    return _targets_delta(repo_name, from_version, to_version)
+
+
 
+# targets files are never rewritten once versioned, so a delta between two versions never changes
+@lru_cache(maxsize=1024)
+def _targets_delta(repo_name, from_version, to_version):
+    meta_dir = os.path.join(DB_ROOT_PATH, repo_name, 'metadata')
+    base = json.loads(committer.read_bytes(os.path.join(meta_dir, f'{from_version}.targets.json')))
+    current = json.loads(committer.read_bytes(os.path.join(meta_dir, f'{to_version}.targets.json')))
+    targets_key = image_targets_key if repo_name == 'image' else director_targets_key
+
+    return compute_targets_delta(base, current, True, targets_key)
+
+
+
+def put_target(name, content, repo_name, target_file=None):
+    # versions are worked out and the new files staged under the lock, the commit
+    # happens outside it so updates arriving close together share one commit
+    txn = MetadataTransaction()
+    with metadata_lock:
+        message = _put_target(name, content, repo_name, txn, target_file)
+        committer.submit(txn)
+    committer.wait(txn)
 
+    resigner.track(os.path.join(DB_ROOT_PATH, repo_name, 'metadata'), image_keys if repo_name == 'image' else director_keys)
+    return message
 
-def put_target(name, content, repo_name):
-    #Write the target file
+
+
+def _put_target(name, content, repo_name, txn, target_file=None):
+    #Write the target file, the same content is only stored once however many repos reference it
     file_path = os.path.join(DB_ROOT_PATH, repo_name, 'targets', name)
 
-    with open(file_path, 'w') as f:
-        f.write(content)
+    # an uploaded image is already linked in place and its length and hashes are known, see publish_upload()
+    if target_file is None:
+        link_blob(content.encode('utf-8'), file_path)
+        link_blob(content.encode('utf-8'), os.path.join(DB_ROOT_PATH, 'targets', name))
+        target_file = TargetFile.from_file(name, file_path)
 
     # Compute the current versions of each metadata files
     curr_meta_versions = get_metadata_versions(repo_name)
@@ -235,21 +401,22 @@ def put_target(name, content, repo_name):
             expires=_in(7),
             version=curr_meta_versions['targets'] + 1))
 
-    targets_metadata.signed.targets[name] = TargetFile.from_file(name, file_path)
+    targets_metadata.signed.targets[name] = target_file
     targets_key = image_targets_key if repo_name == 'image' else director_targets_key
     targets_metadata.sign(SSlibSigner(targets_key))
-    targets_metadata.to_file(os.path.join(DB_ROOT_PATH, repo_name, 'metadata', f'{targets_metadata.signed.version}.targets.json'), serializer=JSONSerializer(compact=False))
+    targets_bytes = targets_metadata.to_bytes(JSONSerializer(compact=True))
+    txn.stage_served(os.path.join(DB_ROOT_PATH, repo_name, 'metadata', f'{targets_metadata.signed.version}.targets.json'), targets_bytes)
 
     
     #Create the new snapshot metadata
     snapshot_metadata = Metadata(Snapshot(
         expires=_in(7), 
-        meta = {"targets.json": MetaFile(targets_metadata.signed.version) },
+        meta = {"targets.json": get_meta_file(targets_metadata.signed.version, targets_bytes) },
         version=curr_meta_versions['snapshot']+1))
 
     snapshot_key = image_snapshot_key if repo_name == 'image' else director_snapshot_key
     snapshot_metadata.sign(SSlibSigner(snapshot_key))
-    snapshot_metadata.to_file(os.path.join(DB_ROOT_PATH, repo_name, 'metadata', f'{snapshot_metadata.signed.version}.snapshot.json'), serializer=JSONSerializer(compact=False))
+    txn.stage_metadata(os.path.join(DB_ROOT_PATH, repo_name, 'metadata', f'{snapshot_metadata.signed.version}.snapshot.json'), snapshot_metadata, JSONSerializer(compact=True))
 
 
     #Create the new timestamp metadata
@@ -260,12 +427,189 @@ def put_target(name, content, repo_name):
     
     timestamp_key = image_timestamp_key if repo_name == 'image' else director_timestamp_key
     timestamp_metadata.sign(SSlibSigner(timestamp_key))
-    timestamp_metadata.to_file(os.path.join(DB_ROOT_PATH, repo_name, 'metadata', f'timestamp.json'), serializer=JSONSerializer(compact=False))
+    txn.stage_metadata(os.path.join(DB_ROOT_PATH, repo_name, 'metadata', f'timestamp.json'), timestamp_metadata, JSONSerializer(compact=True))
 
     return {'message': f'new target written to {file_path}, and meta datafiles were updated'}
 
 
 
+upload_store = UploadStore(UPLOADS_PATH, UPLOAD_CHUNK_SIZE, UPLOAD_MAX_CHUNK_SIZE)
+
+
+
+def publish_upload(upload_id):
+    '''
+    Add a fully uploaded image to both repos, like a target posted inline,
+    then drop the upload. Its hashes were worked out as the chunks arrived
+    '''
+    upload = upload_store.get(upload_id)
+    length, hashes, data_path = upload.finish()
+
+    # the image is moved into the blob store rather than copied, it can be several GB
+    adopt_blob(data_path, hashes['sha256'])
+    for repo_dir in ('targets', os.path.join('image', 'targets'), os.path.join('director', 'targets')):
+        link_digest(hashes['sha256'], os.path.join(DB_ROOT_PATH, repo_dir, upload.name))
+
+    target_file = TargetFile(length, hashes, upload.name)
+    put_target(upload.name, None, 'image', target_file)
+    put_target(upload.name, None, 'director', target_file)
+    upload_store.remove(upload_id)
+
+    return {'name': upload.name, 'length': length, 'hashes': hashes}
+
+
+
+def read_vehicle_metadata(vin):
+    '''
+    The current timestamp, snapshot and targets the director signed for a
+    vehicle, as json. None if it has none yet
+    '''
+    meta_dir = os.path.join(DB_ROOT_PATH, 'director', vin)
+    if not committer.exists(os.path.join(meta_dir, 'timestamp.json')):
+        return None
+    timestamp = json.loads(committer.read_bytes(os.path.join(meta_dir, 'timestamp.json')))
+    snapshot_version = timestamp['signed']['meta']['snapshot.json']['version']
+    snapshot = json.loads(committer.read_bytes(os.path.join(meta_dir, f'{snapshot_version}.snapshot.json')))
+    targets_version = snapshot['signed']['meta']['targets.json']['version']
+    targets = json.loads(committer.read_bytes(os.path.join(meta_dir, f'{targets_version}.targets.json')))
+
+    return {
+        'timestamp': timestamp,
+        'snapshot': snapshot,
+        'targets': targets,
+    }
+
+
+
+def get_sent_targets(vin):
+    '''
+    The targets the director last sent down to this vehicle
+    '''
+    metadata = read_vehicle_metadata(vin)
+    return metadata['targets']['signed']['targets'] if metadata else {}
+
+
+
+def next_vehicle_versions(vin):
+    # targets, snapshot and timestamp, each one past what the vehicle has
+    metadata = read_vehicle_metadata(vin)
+    if not metadata:
+        return (1, 1, 1)
+    return tuple(metadata[role]['signed']['version'] + 1 for role in ('targets', 'snapshot', 'timestamp'))
+
+
+
+# rsa-pss signatures are randomized, so metadata is only the same bytes, and stored once, if it is signed
+# once and reused. Every vehicle gets the same root, signed once a day
+@lru_cache(maxsize=1)
+def _signed_vehicle_root(day):
+    root = Metadata(Root(expires=_in(365)))
+    root.signed.add_key(Key.from_securesystemslib_key(director_root_key), 'root')
+    root.signed.add_key(Key.from_securesystemslib_key(director_targets_key), 'targets')
+    root.signed.add_key(Key.from_securesystemslib_key(director_snapshot_key), 'snapshot')
+    root.signed.add_key(Key.from_securesystemslib_key(director_timestamp_key), 'timestamp')
+    root.sign(SSlibSigner(director_root_key))
+    return f'{root.signed.version}.root.json', root.to_bytes(JSONSerializer(compact=True))
+
+
+
+def image_target_file(image_id):
+    '''
+    The length and hashes the image repo signed for a target, rather than
+    hashing the image again. Each version of the image targets lists the
+    target put in it, so the newest version that lists it is used
+    '''
+    meta_dir = os.path.join(DB_ROOT_PATH, 'image', 'metadata')
+    version = get_metadata_versions('image')['targets']
+    while version > 0:
+        targets = Metadata[Targets].from_bytes(committer.read_bytes(os.path.join(meta_dir, f'{version}.targets.json')))
+        if image_id in targets.signed.targets:
+            return targets.signed.targets[image_id]
+        version -= 1
+    raise ValueError(f'{image_id} is not in the image repo')
+
+
+
+# every vehicle assigned an image gets the same metadata but for the versions, so metadata signed for an
+# image and versions is kept for a while and linked into every vehicle it is for. period changes every
+# VEHICLE_METADATA_REUSE_SECONDS so what is linked is never much older than what would be signed
+@lru_cache(maxsize=256)
+def _signed_vehicle_metadata(image_id, targets_version, snapshot_version, timestamp_version, period):
+    root_name, root_bytes = _signed_vehicle_root(int(time.time() // (24 * 60 * 60)))
+
+    targets = Metadata(Targets(expires=_in(7), version=targets_version))
+    targets.signed.targets[image_id] = image_target_file(image_id)
+    targets.sign(SSlibSigner(director_targets_key))
+    targets_bytes = targets.to_bytes(JSONSerializer(compact=True))
+
+    snapshot = Metadata(Snapshot(
+        expires=_in(7),
+        version=snapshot_version,
+        meta={'targets.json': get_meta_file(targets_version, targets_bytes)}))
+    snapshot.sign(SSlibSigner(director_snapshot_key))
+
+    timestamp = Metadata(Timestamp(expires=_in(1), version=timestamp_version, snapshot_meta=MetaFile(snapshot_version)))
+    timestamp.sign(SSlibSigner(director_timestamp_key))
+
+    return {
+        root_name: root_bytes,
+        f'{targets_version}.targets.json': targets_bytes,
+        f'{snapshot_version}.snapshot.json': snapshot.to_bytes(JSONSerializer(compact=True)),
+        'timestamp.json': timestamp.to_bytes(JSONSerializer(compact=True)),
+    }
+
+
+
+def sign_vehicle_metadata(vin, image_id):
+    '''
+    Sign the director metadata that sends image_id to a vehicle
+    '''
+    meta_dir = os.path.join(DB_ROOT_PATH, 'director', vin)
+    while True:
+        with metadata_lock:
+            versions = next_vehicle_versions(vin)
+        # signed outside the lock, it is the slow part
+        files = _signed_vehicle_metadata(image_id, *versions, int(time.time() // VEHICLE_METADATA_REUSE_SECONDS))
+
+        with metadata_lock:
+            # re-signed in the meantime, go again from its versions
+            if next_vehicle_versions(vin) != versions:
+                continue
+            os.makedirs(meta_dir, exist_ok=True)
+            # through the committer like any other write, so it is ordered with a re-sign still being committed.
+            # The same blobs are linked into every vehicle that shares them
+            txn = MetadataTransaction()
+            for name, data in files.items():
+                txn.stage_blob(os.path.join(meta_dir, name), data)
+            committer.submit(txn)
+        break
+
+    committer.wait(txn)
+
+    resigner.track(meta_dir, director_keys)
+
+
+
+def assign_image(vin, image_id):
+    '''
+    Point a vehicle at an image once its metadata for it is signed, see
+    assignments.py
+    '''
+    vehicle = find_vehicle(vin)
+    if not vehicle:
+        raise ValueError(f'no vehicle {vin}')
+
+    sign_vehicle_metadata(vin, image_id)
+
+    vehicle['image'] = image_id
+    write_vehicle(vehicle)
+
+
+
+assignment_runner = AssignmentRunner(ASSIGNMENTS_PATH, assign_image, ASSIGNMENT_WORKERS, ASSIGNMENT_VEHICLES_PER_SECOND, ASSIGNMENT_BURST)
+
+
+
 def process_vehicle_manifest(vin, manifest):
     vehicle = find_vehicle(vin)
 
@@ -273,26 +617,21 @@ def process_vehicle_manifest(vin, manifest):
     # whether or not it's valid we want a history so we add it
     # ...
 
-    # now we validate
-    # NOTE this is a lot of code, implement this using a pipeline pattern in js
-
-    # validate format is correct
-    # verify signature of vehicle manifest
-    # verify vin exists in invetory db
-    # verify all ecus in manifest belong to this vehicle according to the inventory db
-    # verify all ecus in the vehicle according to inventory db are in the manifest
-    # verify signature of all ecu manifests
-    # verify the installed images in the manifest correspond to the last set that were sent down
-    # verify there were no attacks detected
-    # verify the vehicle is commisionsed
-    # verify the account is in good standing order
-
-    # NOTE not bothered implementing this, well just check the vehicle exists for now, everything else passed
     if not vehicle:
         print('not found')
         return {}
 
-    # pprint(manifest)
+    # now we validate, see manifest_checks.py for the stages
+    # NOTE not implemented: verify the vehicle is commisionsed
+    # NOTE not implemented: verify the account is in good standing order
+    sent_targets = get_sent_targets(vin)
+    try:
+        timings = check_vehicle_manifest(vehicle, manifest, sent_targets)
+    except ManifestRejected as e:
+        print(stylize(f'manifest from {vin} rejected at {e.stage}: {e.reason} {e.timings}', fg('red')))
+        return { 'stage': e.stage, 'error': e.reason }, 400
+
+    print(stylize(f'manifest from {vin} verified {timings}', fg('green')))
 
 
     # lets compute which images if any should be put on this vehicle
@@ -303,51 +642,172 @@ def process_vehicle_manifest(vin, manifest):
 
 
 
-    # record that this image was instructed to be put on this vehicle at this time
-    
-    # create new tuf metadata for the ecus on this vehicle
-    root = Metadata(Root(expires=_in(365)))
-    root.signed.add_key(Key.from_securesystemslib_key(director_root_key), 'root')
-    root.signed.add_key(Key.from_securesystemslib_key(director_targets_key), 'targets')
-    root.signed.add_key(Key.from_securesystemslib_key(director_snapshot_key), 'snapshot')
-    root.signed.add_key(Key.from_securesystemslib_key(director_timestamp_key), 'timestamp')
+    # signed ahead of time by a bulk assignment, or at an earlier check-in
+    if vehicle['image'] in sent_targets:
+        return {}
+    # a bulk assignment is about to sign for it, at a rate that keeps the fleet checking in from signing all at once
+    if assignment_runner.is_pending(vin):
+        return {}
 
-    targets = Metadata(Targets(expires=_in(7)))
-    snapshot = Metadata(Snapshot(expires=_in(7)))
-    timestamp = Metadata(Timestamp(expires=_in(1)))
+    sign_vehicle_metadata(vin, vehicle['image'])
 
-    image_id = vehicle['image']
-    image_path = os.path.join(DB_ROOT_PATH, 'targets', image_id)
-    
-    targets.signed.targets[image_id] = TargetFile.from_file(image_id, image_path)
+    return {}
 
-    root.sign(SSlibSigner(director_root_key))
-    targets.sign(SSlibSigner(director_targets_key))
-    snapshot.sign(SSlibSigner(director_snapshot_key))
-    timestamp.sign(SSlibSigner(director_timestamp_key))
 
-    root.to_file(os.path.join(DB_ROOT_PATH, 'director', vin, f'{root.signed.version}.root.json'), serializer=JSONSerializer(compact=False))
-    targets.to_file(os.path.join(DB_ROOT_PATH, 'director', vin, f'{targets.signed.version}.targets.json'), serializer=JSONSerializer(compact=False))
-    snapshot.to_file(os.path.join(DB_ROOT_PATH, 'director', vin, f'{snapshot.signed.version}.snapshot.json'), serializer=JSONSerializer(compact=False))
-    timestamp.to_file(os.path.join(DB_ROOT_PATH, 'director', vin, f'timestamp.json'), serializer=JSONSerializer(compact=False))
 
-    return {}
 
+def ingest_vehicle_manifests(vin, manifests):
+    '''
+    Handle the manifests a vehicle sent since it was last processed, oldest
+    first. Only the newest one that passes the checks matters, it supersedes
+    the others
+    '''
+    result = {}
+    for manifest in reversed(manifests):
+        result = process_vehicle_manifest(vin, manifest)
+        if not isinstance(result, tuple):
+            return {'status': 'processed'}
+    return {'status': 'rejected', **result[0]}
+
+
+
+manifest_queue = ManifestQueue(MANIFEST_QUEUE_PATH, ingest_vehicle_manifests, MANIFEST_WORKERS)
 
 
 
 def resign_timestamp(): 
-    prev_timestamp_version = Metadata[Timestamp].from_file(os.path.join(DB_ROOT_PATH, 'image', 'metadata', f'timestamp.json')).signed.version
-  
-    image_timestamp_metadata = Metadata(Timestamp(expires=_in(1), version=prev_timestamp_version+1))
-    image_timestamp_metadata.sign(SSlibSigner(image_timestamp_key))
-    image_timestamp_metadata.to_file(os.path.join(DB_ROOT_PATH, 'image', 'metadata', f'timestamp.json'), serializer=JSONSerializer(compact=False))
+    '''
+    Re-sign the timestamp of both repos now, each repo keeps its own versions
+    '''
+    txn = MetadataTransaction()
+    with metadata_lock:
+        image_versions = resign_repo(os.path.join(DB_ROOT_PATH, 'image', 'metadata'), image_keys, txn)
+        director_versions = resign_repo(os.path.join(DB_ROOT_PATH, 'director', 'metadata'), director_keys, txn)
+        committer.submit(txn)
+    committer.wait(txn)
 
-    director_timestamp_metadata = Metadata(Timestamp(expires=_in(1), version=prev_timestamp_version+1))
-    director_timestamp_metadata.sign(SSlibSigner(director_timestamp_key))
-    director_timestamp_metadata.to_file(os.path.join(DB_ROOT_PATH, 'director', 'metadata', f'timestamp.json'), serializer=JSONSerializer(compact=False))
-    
-    return { 'timestamp_version': prev_timestamp_version + 1 }
+    return {
+        'image_timestamp_version': image_versions['timestamp'],
+        'director_timestamp_version': director_versions['timestamp'],
+    }
+
+
+
+def track_repos():
+    '''
+    Track the image repo, director repo and every vehicle's director metadata
+    that exists and is not tracked yet
+    '''
+    tracked = [
+        (os.path.join(DB_ROOT_PATH, 'image', 'metadata'), image_keys),
+        (os.path.join(DB_ROOT_PATH, 'director', 'metadata'), director_keys),
+    ]
+    for vin in list_vehicles():
+        tracked.append((os.path.join(DB_ROOT_PATH, 'director', vin), director_keys))
+
+    for meta_dir, keys in tracked:
+        if meta_dir not in resigner.keys and os.path.isfile(os.path.join(meta_dir, 'timestamp.json')):
+            resigner.track(meta_dir, keys)
+
+
+
+def start_resigner():
+    '''
+    Track the metadata that exists already and start re-signing in the background
+    '''
+    track_repos()
+    resigner.start()
+
+
+
+def start_manifest_queue():
+    '''
+    Process the manifests left in the queue and any that arrive from now on
+    '''
+    manifest_queue.start()
+
+
+
+def start_assignments():
+    '''
+    Carry on with the bulk assignments left unfinished and any created from now on
+    '''
+    assignment_runner.start()
+
+
+
+background_work = {'started': False}
+background_work_lock = threading.Lock()
+
+
+def start_background_work():
+    '''
+    Start re-signing, the manifest queue and bulk assignments, once per process
+    '''
+    with background_work_lock:
+        if background_work['started']:
+            return
+        background_work['started'] = True
+    start_resigner()
+    start_manifest_queue()
+    start_assignments()
+
+
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+MULTI WORKER DEPLOYMENT
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+# the metadata clients download, which the workers share through the store
+SERVED_METADATA_DIRS = [
+    os.path.join(DB_ROOT_PATH, 'image', 'metadata'),
+    os.path.join(DB_ROOT_PATH, 'director', 'metadata'),
+]
+
+
+def pick_up_other_workers():
+    '''
+    Worker 0 does the background work for all the workers. Manifests queued,
+    assignments created and vehicles that got metadata in the others are
+    picked up from disk
+    '''
+    while True:
+        time.sleep(WORKER_RESCAN_SECONDS)
+        try:
+            manifest_queue.rescan()
+            assignment_runner.rescan()
+            track_repos()
+        except (OSError, ValueError, KeyError) as e:
+            print(f'unable to pick up work from the other workers: {e}')
+
+
+
+def start_worker(index):
+    committer.store = MetadataStore(METADATA_STORE_PATH, METADATA_STORE_BYTES, SERVED_METADATA_DIRS)
+    metadata_lock.attach(os.path.join(METADATA_STORE_PATH, 'metadata.lock'))
+    # the windows were mapped before the workers were forked, so they are shared already
+    attestation_nonces.attach(os.path.join(METADATA_STORE_PATH, 'attestation-nonces.lock'))
+    global_attestation_nonces.attach(os.path.join(METADATA_STORE_PATH, 'global-attestation-nonces.lock'))
+    if index == 0:
+        start_background_work()
+        threading.Thread(target=pick_up_other_workers, daemon=True).start()
+    else:
+        # worker 0 does it for every worker
+        background_work['started'] = True
+        resigner.elsewhere = True
+
+
+
+def stop_worker(index):
+    if trace:
+        trace.flush()
+
+
+
+def worker_exited(pid):
+    # anything it staged and did not get to commit never will be
+    abandoned = MetadataStore(METADATA_STORE_PATH, METADATA_STORE_BYTES, SERVED_METADATA_DIRS).abandon(pid)
+    if abandoned:
+        print(f'aborted {abandoned} metadata files staged by worker {pid}')
 
 
 
@@ -355,10 +815,89 @@ def resign_timestamp():
 SERVER API
 '''''''''''''''''''''''''''''''''''''''''''''''''''''''''
 
+# registered first so requests turned away by admission control are traced too
+@app.before_request
+def start_trace():
+    if trace:
+        g.arrived_at = time.monotonic()
+
+
+
+@app.after_request
+def trace_response(response):
+    if trace and 'arrived_at' in g:
+        # the header, send_file responses are not buffered so their length can't be calculated
+        g.traced_response = (response.content_length or 0, response.status_code)
+    return response
+
+
+
+# recorded once the request is torn down, after_request is skipped when a view raises
+@app.teardown_request
+def trace_request(exc):
+    if trace and 'arrived_at' in g:
+        response_bytes, status = g.get('traced_response', (0, 500))
+        trace.record(
+            g.arrived_at,
+            request.method,
+            request.url_rule.rule if request.url_rule else None,
+            request.path,
+            requesting_vehicle(),
+            request.content_length or 0,
+            response_bytes,
+            status,
+            time.monotonic() - g.arrived_at)
+
+
+
+# served some other way than `python server.py`, such as `flask run --no-reload` or a wsgi server, the
+# background work starts with the first request
+@app.before_request
+def ensure_background_work():
+    if not background_work['started']:
+        start_background_work()
+
+
+
+@app.before_request
+def admit_request():
+    if request.endpoint in ADMISSION_EXEMPT:
+        return None
+
+    rejected = admission.admit(requesting_vehicle())
+    if rejected:
+        status, wait = rejected
+        error = 'too many requests from this vehicle' if status == 429 else 'server is busy'
+        return { 'error': error }, status, { 'Retry-After': retry_after_header(wait) }
+
+    g.admitted_at = time.monotonic()
+
+
+
+@app.teardown_request
+def release_request(exc):
+    if 'admitted_at' in g:
+        admission.release(time.monotonic() - g.admitted_at)
+
+
+
+
 # timeserver
 @app.route('/timeserver/attestation', methods=['POST'])
 def timeserver():
     nonces = request.get_json()['nonces']
+    # a replayed request would get the attestation it got before, only with a newer time
+    if not isinstance(nonces, list) or not all(storable(nonce) for nonce in nonces):
+        return { 'error': 'nonces must be a list of 64 bit integers' }, 400
+    # nonces are remembered per vehicle, those of requests that don't say which they come from all together
+    vin = requesting_vehicle()
+    if nonces:
+        if vin:
+            replayed = attestation_nonces.claim([(vin, nonce) for nonce in nonces])
+        else:
+            replayed = global_attestation_nonces.claim([('', nonce) for nonce in nonces])
+        if replayed:
+            return { 'error': 'nonces were used before', 'nonces': [nonce for _, nonce in replayed] }, 400
     return get_time_attestation(nonces)
 
 
@@ -404,12 +943,55 @@ def director_vehicles_ecus(id):
 
 
 
-# accept manifest from primary
-@app.route('/director/vehicles/<id>/manifest', methods=['POST'])
+# accept manifest from primary, it is queued and processed in the background
+@app.route('/director/vehicles/<id>/manifest', methods=['GET', 'POST'])
 def director_vehicles_manifest(id):
     if request.method == 'POST':
+        if not find_vehicle(id):
+            return {}
         manifest = request.get_json()
-        return process_vehicle_manifest(id, manifest)
+        return { 'manifest_id': manifest_queue.enqueue(id, manifest) }, 202
+
+    # the result of processing the last manifests from this vehicle
+    elif request.method == 'GET':
+        return manifest_queue.result(id)
+
+
+
+# assign an image to many vehicles at once, their metadata is signed in the background, see assignments.py
+@app.route('/director/assignments', methods=['GET', 'POST'])
+def director_assignments():
+    if request.method == 'POST':
+        body = request.get_json()
+        image = body.get('image')
+        if not image or '/' in image or not os.path.isfile(os.path.join(DB_ROOT_PATH, 'targets', image)):
+            return { 'error': f'no target {image}' }, 400
+
+        # either a list of vins or every vehicle whose vin starts with a prefix
+        vins = body.get('vins')
+        if body.get('vin_prefix'):
+            vins = [vin for vin in list_vehicles() if vin.startswith(body['vin_prefix'])]
+        if not isinstance(vins, list) or not vins or not all(isinstance(vin, str) for vin in vins):
+            return { 'error': 'no vehicles to assign the image to' }, 400
+
+        assignment_id = assignment_runner.create(image, vins)
+        return assignment_runner.status(assignment_id), 202
+
+    elif request.method == 'GET':
+        return {
+            'assignments': [assignment_runner.status(assignment_id) for assignment_id in assignment_runner.ids()],
+            'workers': assignment_runner.get_metrics(),
+        }
+
+
+
+# progress of a bulk assignment
+@app.route('/director/assignments/<assignment_id>')
+def director_assignment_single(assignment_id):
+    try:
+        return assignment_runner.status(assignment_id)
+    except KeyError:
+        return { 'error': f'no assignment {assignment_id}' }, 404
 
 
 
@@ -435,6 +1017,48 @@ def image_targets_single(id):
 
 
 
+# upload a large image in chunks, see image_uploads.py and upload_image.py
+@app.route('/image/uploads', methods=['POST'])
+def image_uploads():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return { 'error': 'expected a json object with the name and length of the image' }, 400
+    upload_id, upload = upload_store.create(body.get('name'), body.get('length'), body.get('chunk_size'))
+    return {'upload_id': upload_id, **upload.status()}, 201
+
+
+
+# which chunks of an upload the server has, to resume it
+@app.route('/image/uploads/<upload_id>', methods=['GET', 'DELETE'])
+def image_upload_single(upload_id):
+    if request.method == 'DELETE':
+        upload_store.get(upload_id)
+        upload_store.remove(upload_id)
+        return {}
+    return upload_store.get(upload_id).status()
+
+
+
+@app.route('/image/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+def image_upload_chunk(upload_id, index):
+    upload = upload_store.get(upload_id)
+    upload.write_chunk(index, request.get_data(), request.headers.get(CHUNK_SHA256_HEADER))
+    return {'index': index}
+
+
+
+@app.route('/image/uploads/<upload_id>/complete', methods=['POST'])
+def image_upload_complete(upload_id):
+    return publish_upload(upload_id)
+
+
+
+@app.errorhandler(UploadError)
+def upload_error(e):
+    return {'error': e.reason}, e.status
+
+
+
 # download director repo metadata
 @app.route('/director/<metadata>.json')
 def director_metadata(metadata):
@@ -459,6 +1083,19 @@ def image_metadata(metadata):
 
 
 
+# targets metadata as a delta against the version the client holds
+@app.route('/director/deltas/targets/<int:from_version>')
+def director_targets_delta(from_version):
+    return get_targets_delta('director', from_version)
+
+
+
+@app.route('/image/deltas/targets/<int:from_version>')
+def image_targets_delta(from_version):
+    return get_targets_delta('image', from_version)
+
+
+
 @app.route('/resign-timestamp')
 def resign():
     print('resigning timestamp for director and image repos')
@@ -466,5 +1103,66 @@ def resign():
 
 
 
+@app.route('/blobs')
+def blobs():
+    return blob_stats()
+
+
+
+@app.route('/blobs/gc', methods=['POST'])
+def blobs_gc():
+    with metadata_lock:
+        return collect_garbage()
+
+
+
+@app.route('/metadata/commits')
+def metadata_commits():
+    return committer.metrics
+
+
+
+@app.route('/metadata/store')
+def metadata_store_metrics():
+    return committer.store.get_metrics() if committer.store else {}
+
+
+
+@app.route('/director/replays')
+def replay_metrics():
+    return {
+        'report_counters': report_counters.get_metrics(),
+        'attestation_nonces': attestation_nonces.get_metrics(),
+        'global_attestation_nonces': global_attestation_nonces.get_metrics(),
+    }
+
+
+
+@app.route('/director/manifests/queue')
+def manifest_queue_metrics():
+    return manifest_queue.get_metrics()
+
+
+
+@app.route('/admission/metrics')
+def admission_metrics():
+    return admission.get_metrics()
+
+
+
+@app.route('/resigner/metrics')
+def resigner_metrics():
+    return resigner.get_metrics()
+
+
+
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    if SERVER_WORKERS > 1:
+        MetadataStore.create(METADATA_STORE_PATH, METADATA_STORE_BYTES, SERVED_METADATA_DIRS)
+        serve_workers(app, SERVER_HOST, SERVER_PORT, SERVER_WORKERS, start_worker, stop_worker, worker_exited)
+    else:
+        # the debug reloader runs this file twice, only the child process serves requests. Without the
+        # reloader this process does, and the first request starts the background work
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            start_background_work()
+        app.run(debug=True)
\ No newline at end of file
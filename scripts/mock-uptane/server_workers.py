@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+import signal
+import socket
+import traceback
+from werkzeug.serving import make_server
+from styles import GREEN, RED, ENDCOLORS
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+MULTI WORKER SERVER
+
+Serves the flask app from `workers` processes instead of one, so serving is not held to one core by the GIL.
+The parent binds the listening socket and forks the workers, each of which accepts connections on it with a
+threaded werkzeug server. The parent does nothing else but start a new worker when one exits.
+
+    SERVER_WORKERS=8 python server.py
+
+Workers share what is on disk and, through metadata_store.py, the metadata they serve and write. Anything a
+worker keeps in memory is its own: admission control limits apply per worker, and the caches of each worker
+warm up separately. The replay windows of replay_window.py are the exception, they are mapped before the
+workers are forked and shared between them, so a time attestation request replayed to another worker than
+the one that saw it first is still turned away.
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+LISTEN_BACKLOG = 1024
+# how long to wait before replacing a worker that exited, so one that fails on start doesn't spin
+RESPAWN_DELAY_SECONDS = 1
+
+
+def _run_worker(app, listener, index, on_start, on_stop):
+    # ctrl-c reaches the whole process group, the parent stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    code = 0
+    try:
+        on_start(index)
+        host, port = listener.getsockname()[:2]
+        server = make_server(host, port, app, threaded=True, fd=listener.fileno())
+        server.socket.setblocking(False)
+        server.serve_forever()
+    except SystemExit:
+        pass
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        try:
+            on_stop(index)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            # never back into the parent's code
+            os._exit(code)
+
+
+
+def serve_workers(app, host, port, workers, on_start, on_stop, on_exit):
+    '''
+    on_start(index) and on_stop(index) run in a worker before it serves
+    requests and when it stops, on_exit(pid) in the parent after a worker
+    exited
+    '''
+    listener = socket.create_server((host, port), backlog=LISTEN_BACKLOG)
+    # every worker waits on it, the ones that lose the race for a connection go back to waiting
+    listener.setblocking(False)
+    children = {}
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(app, listener, index, on_start, on_stop)
+        children[pid] = index
+
+    for index in range(workers):
+        spawn(index)
+    print(f'{GREEN}serving on http://{host}:{port} with {workers} workers{ENDCOLORS}')
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        while True:
+            pid, status = os.wait()
+            index = children.pop(pid, None)
+            if index is None:
+                continue
+            print(f'{RED}worker {index} (pid {pid}) exited with status {status}, starting another{ENDCOLORS}')
+            on_exit(pid)
+            time.sleep(RESPAWN_DELAY_SECONDS)
+            spawn(index)
+    except (KeyboardInterrupt, SystemExit):
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        for pid in children:
+            os.waitpid(pid, 0)
@@ -0,0 +1,127 @@
+import json
+from securesystemslib.keys import create_signature, verify_signature
+from tuf.ngclient import Updater
+from canonical import encode_canonical
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+TARGETS DELTAS
+
+Instead of downloading a whole new targets.json a client can ask for a delta against the version it holds.
+The delta lists the targets that were removed, the targets that were added or changed, every other field of
+the new signed portion and the signatures of the new targets.json. It is signed with the repo's targets key.
+
+The client applies it to its copy, serializes the result the same way the server stored it and checks the
+length and hashes against what the (already verified) snapshot says targets.json should be. Only then is it
+handed to the normal tuf verification, which checks the targets signatures as if it had been downloaded whole.
+If anything does not line up, or the server has no delta from that version, the client downloads the whole file.
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+def serialize_targets(targets, compact):
+    # must match tuf's JSONSerializer, which the server stores metadata with
+    if compact:
+        return json.dumps(targets, separators=(',', ':'), sort_keys=True).encode('utf-8')
+    return json.dumps(targets, indent=1, separators=(',', ': '), sort_keys=True).encode('utf-8')
+
+
+
+def compute_targets_delta(base, current, compact, targets_key):
+    '''
+    Signed delta taking the base targets metadata (as a dict) to current
+    '''
+    base_targets = base['signed']['targets']
+    current_targets = current['signed']['targets']
+
+    signed = {
+        '_type': 'targets-delta',
+        'compact': compact,
+        'from_version': base['signed']['version'],
+        'removed': sorted(path for path in base_targets if path not in current_targets),
+        'upserted': {path: info for path, info in current_targets.items() if base_targets.get(path) != info},
+        'fields': {field: value for field, value in current['signed'].items() if field != 'targets'},
+        'signatures': current['signatures'],
+    }
+
+    return {
+        'signed': signed,
+        'signatures': [create_signature(targets_key, encode_canonical(signed).encode('utf-8'))],
+    }
+
+
+
+def apply_targets_delta(base, delta):
+    '''
+    The new targets metadata (as serialized bytes) from the base (as a dict)
+    '''
+    signed = delta['signed']
+    if signed['from_version'] != base['signed']['version']:
+        raise ValueError('delta is not against the version we hold')
+
+    targets = dict(base['signed']['targets'])
+    for path in signed['removed']:
+        targets.pop(path, None)
+    targets.update(signed['upserted'])
+
+    new_targets = {
+        'signatures': signed['signatures'],
+        'signed': {**signed['fields'], 'targets': targets},
+    }
+
+    return serialize_targets(new_targets, signed['compact'])
+
+
+
+class DeltaUpdater(Updater):
+    '''
+    tuf Updater that fetches targets.json as a delta when it can
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.delta_metrics = { 'applied': 0, 'fallbacks': 0 }
+
+
+    def _download_metadata(self, rolename, length, version=None):
+        if rolename == 'targets':
+            try:
+                data = self._download_targets_delta()
+                self.delta_metrics['applied'] += 1
+                return data
+            except Exception:
+                self.delta_metrics['fallbacks'] += 1
+
+        return super()._download_metadata(rolename, length, version)
+
+
+    def _verify_delta_signature(self, delta):
+        root = self._trusted_set.root.signed
+        for signature in delta['signatures']:
+            if signature['keyid'] in root.roles['targets'].keyids:
+                key = root.keys[signature['keyid']].to_securesystemslib_key()
+                if verify_signature(key, signature, encode_canonical(delta['signed']).encode('utf-8')):
+                    return
+        raise ValueError('delta is not signed by the targets key')
+
+
+    def _download_targets_delta(self):
+        base = json.loads(self._load_local_metadata('targets'))
+        url = f"{self._metadata_base_url}deltas/targets/{base['signed']['version']}"
+        delta = json.loads(self._fetcher.download_bytes(url, self.config.targets_max_length))
+
+        self._verify_delta_signature(delta)
+        data = apply_targets_delta(base, delta)
+
+        # the snapshot has been verified by now, the result must be exactly the file it lists
+        expected = self._trusted_set.snapshot.signed.meta['targets.json']
+        if not expected.hashes:
+            raise ValueError('snapshot has no hashes to check the delta result against')
+        expected.verify_length_and_hashes(data)
+
+        return data
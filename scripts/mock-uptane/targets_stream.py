@@ -0,0 +1,188 @@
+import json
+import codecs
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+STREAMING TARGETS PARSER
+
+Reads a targets metadata file a chunk at a time and yields its targets one by one as TargetRecords, without
+ever holding the whole file or its parsed dict in memory. Only the value of one target is decoded at a time,
+and targets that are filtered out are dropped as soon as they are read, so memory stays flat however many
+targets the file lists.
+
+The parser walks the envelope ({"signed": {..., "targets": {...}}, "signatures": [...]}) itself and hands
+every other value to json's raw_decode, which is given more of the file whenever a value runs past what has
+been read so far. The file must already have been verified, e.g. by the tuf Updater, nothing here checks
+signatures.
+
+The director can put an ecu serial on the targets metadata itself (signed.custom.ecu_serial) rather than on
+each target, in which case it applies to every target without one of its own. tuf writes keys sorted so
+"custom", if there is one, comes before "targets" and records can be yielded straight away. The keys are
+taken to be sorted as long as the ones read so far are. Once they are not, targets without an ecu serial of
+their own are held back until the end of signed in case "custom" comes later.
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class TargetRecord():
+    '''
+    What the primary needs to know about one target
+    '''
+
+    __slots__ = ('path', 'length', 'hashes', 'ecu_serial')
+
+    def __init__(self, path, length, hashes, ecu_serial):
+        self.path = path
+        self.length = length
+        self.hashes = hashes
+        self.ecu_serial = ecu_serial
+
+    def __repr__(self):
+        return f'TargetRecord({self.path!r}, {self.length}, ecu_serial={self.ecu_serial!r})'
+
+
+
+class _Reader():
+
+    def __init__(self, f):
+        self.f = f
+        self.decoder = json.JSONDecoder()
+        # a chunk can end part way through a multi byte character
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+
+    def _fill(self):
+        # drop what has been consumed before reading more so the buffer stays about one chunk long
+        chunk = self.f.read(CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        if isinstance(chunk, bytes):
+            chunk = self.utf8.decode(chunk)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+
+    def peek(self):
+        '''
+        The next character that is not whitespace, '' at the end of the file
+        '''
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f'expected {char!r} at offset {self.pos} of the buffer')
+        self.pos += 1
+
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # the value may just continue past what has been read, a number could too even if it decoded
+                if self._fill():
+                    continue
+                raise
+            if end == len(self.buffer) and not self.eof and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+    def members(self):
+        '''
+        The keys of the object that starts here, the caller consumes each
+        key's value before asking for the next key
+        '''
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect('}')
+                return
+
+
+
+def iter_targets(f, ecu_serials=None, paths=None):
+    '''
+    TargetRecords of the targets metadata in the open file f, in file order
+    when its keys are sorted. Only the targets meant for one of ecu_serials and/or with one of paths
+    are yielded if they are given
+    '''
+    reader = _Reader(f)
+    default_ecu_serial = None
+    custom_read = False
+    sorted_keys = True
+    previous_key = ''
+    # targets without an ecu serial of their own read before signed.custom
+    held = []
+
+    def keep(record):
+        return ((ecu_serials is None or record.ecu_serial in ecu_serials)
+            and (paths is None or record.path in paths))
+
+    for key in reader.members():
+        if key != 'signed':
+            reader.value()
+            continue
+
+        for signed_key in reader.members():
+            sorted_keys = sorted_keys and signed_key > previous_key
+            previous_key = signed_key
+
+            if signed_key == 'custom':
+                custom = reader.value()
+                default_ecu_serial = custom.get('ecu_serial') if isinstance(custom, dict) else None
+                custom_read = True
+            elif signed_key == 'targets':
+                # signed.custom has been read, or can't come any more because the keys up to here are sorted
+                # and "custom" sorts before "targets"
+                custom_known = custom_read or sorted_keys
+                for path in reader.members():
+                    # a target that is not wanted is decoded to get past it and dropped straight away
+                    fileinfo = reader.value()
+                    if paths is not None and path not in paths:
+                        continue
+                    ecu_serial = fileinfo.get('custom', {}).get('ecu_serial')
+                    record = TargetRecord(path, fileinfo['length'], fileinfo['hashes'], ecu_serial or default_ecu_serial)
+                    if ecu_serial is None and not custom_known:
+                        held.append(record)
+                    elif keep(record):
+                        yield record
+            else:
+                reader.value()
+
+        for record in held:
+            record.ecu_serial = default_ecu_serial
+            if keep(record):
+                yield record
+        held = []
+
+    if reader.peek():
+        raise ValueError('trailing data after the targets metadata')
@@ -0,0 +1,96 @@
+import random
+import string
+import pytest
+from securesystemslib.exceptions import FormatError
+from securesystemslib.formats import encode_canonical as reference_encode_canonical
+from canonical import encode_canonical
+
+
+'''
+Differential tests of canonical.encode_canonical against the securesystemslib encoder.
+Run with `python -m pytest` from scripts/mock-uptane.
+'''
+
+
+ALPHABET = string.ascii_letters + string.digits + '\\"\'/ \t\n\u00e9\u2603\U0001f916'
+
+
+def _random_string(rng):
+    return ''.join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 12)))
+
+
+def _random_value(rng, depth=0):
+    kinds = ['str', 'int', 'bool', 'none']
+    if depth < 4:
+        kinds += ['list', 'tuple', 'dict', 'dict']
+    kind = rng.choice(kinds)
+
+    if kind == 'str':
+        return _random_string(rng)
+    if kind == 'int':
+        return rng.randint(-2**70, 2**70)
+    if kind == 'bool':
+        return rng.random() < 0.5
+    if kind == 'none':
+        return None
+    if kind == 'list':
+        return [_random_value(rng, depth + 1) for _ in range(rng.randint(0, 5))]
+    if kind == 'tuple':
+        return tuple(_random_value(rng, depth + 1) for _ in range(rng.randint(0, 5)))
+    return {_random_string(rng): _random_value(rng, depth + 1) for _ in range(rng.randint(0, 6))}
+
+
+def _ecu_report(serial):
+    return {
+        'signatures': [{'keyid': 'abc', 'sig': 'def'}],
+        'signed': {
+            'ecu_serial': serial,
+            'attacks_detected': '',
+            'report_counter': 42,
+            'installed_image': {
+                'filepath': f'/images/{serial}.img',
+                'fileinfo': {'length': 7, 'hashes': {'sha256': 'aa', 'sha512': 'bb'}}
+            }
+        }
+    }
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_matches_reference_on_random_objects(seed):
+    obj = _random_value(random.Random(seed))
+    assert encode_canonical(obj) == reference_encode_canonical(obj)
+
+
+@pytest.mark.parametrize('obj', [
+    '', 'a"b\\c', '\u2603', 0, -1, 2**100, True, False, None, [], {}, (), [[]], {'': {}},
+    {'b': 1, 'a': 2, 'B': 3, '\u00e9': 4}, [True, 1, False, 0],
+])
+def test_matches_reference_on_edge_cases(obj):
+    assert encode_canonical(obj) == reference_encode_canonical(obj)
+
+
+@pytest.mark.parametrize('obj', [1.5, {'a': 1.0}, [object()], {'a': 1, 2: 'b'}])
+def test_rejects_what_reference_rejects(obj):
+    with pytest.raises(FormatError):
+        reference_encode_canonical(obj)
+    with pytest.raises(FormatError):
+        encode_canonical(obj)
+
+
+def test_cached_subobjects_are_reused():
+    reports = {serial: _ecu_report(serial) for serial in ('primary', 'secondary')}
+    manifest = {'primary_ecu_serial': 'primary', 'ecu_version_manifests': reports}
+
+    cache = {}
+    for report in reports.values():
+        assert encode_canonical(report['signed'], cache) == reference_encode_canonical(report['signed'])
+
+    assert encode_canonical(manifest, cache) == reference_encode_canonical(manifest)
+    assert len(cache) == 3
+
+
+def test_cache_ignores_reused_ids():
+    cache = {}
+    encode_canonical({'a': 1}, cache)
+    # the cache holds a reference, so a new object can never share the cached id
+    assert encode_canonical({'a': 2}, cache) == '{"a":2}'
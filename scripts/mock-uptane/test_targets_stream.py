@@ -0,0 +1,74 @@
+import io
+import json
+import pytest
+import targets_stream
+from targets_stream import iter_targets
+
+
+'''
+Tests of targets_stream.iter_targets against targets metadata written with its keys in different orders.
+Run with `python -m pytest` from scripts/mock-uptane.
+'''
+
+
+TARGETS = {
+    'primary.txt': {'length': 1, 'hashes': {'sha256': 'aa'}},
+    'secondary.txt': {'length': 2, 'hashes': {'sha256': 'bb'}, 'custom': {'ecu_serial': 'secondary-ecu'}},
+}
+
+SIGNED = {
+    '_type': 'targets',
+    'custom': {'ecu_serial': 'primary-ecu'},
+    'expires': '2030-01-01T00:00:00Z',
+    'spec_version': '1.0.0',
+    'targets': TARGETS,
+    'version': 1,
+}
+
+
+def _metadata(key_order):
+    signed = {key: SIGNED[key] for key in key_order}
+    return io.BytesIO(json.dumps({'signatures': [], 'signed': signed}).encode('utf-8'))
+
+
+def _records(f, **filters):
+    return sorted((record.path, record.length, record.ecu_serial) for record in iter_targets(f, **filters))
+
+
+@pytest.mark.parametrize('key_order', [
+    sorted(SIGNED),
+    ['_type', 'version', 'targets', 'expires', 'custom', 'spec_version'],
+    ['_type', 'version', 'custom', 'targets', 'expires', 'spec_version'],
+    ['version', 'spec_version', 'expires', 'custom', 'targets', '_type'],
+])
+def test_default_ecu_serial_in_any_key_order(key_order):
+    assert _records(_metadata(key_order)) == [
+        ('primary.txt', 1, 'primary-ecu'),
+        ('secondary.txt', 2, 'secondary-ecu'),
+    ]
+
+
+@pytest.mark.parametrize('key_order', [
+    sorted(SIGNED),
+    ['_type', 'version', 'targets', 'expires', 'custom', 'spec_version'],
+])
+def test_filters_by_ecu_serial(key_order):
+    assert _records(_metadata(key_order), ecu_serials={'primary-ecu'}) == [('primary.txt', 1, 'primary-ecu')]
+
+
+def test_filters_by_path():
+    assert _records(_metadata(sorted(SIGNED)), paths={'secondary.txt'}) == [('secondary.txt', 2, 'secondary-ecu')]
+
+
+def test_values_across_chunks(monkeypatch):
+    monkeypatch.setattr(targets_stream, 'CHUNK_SIZE', 7)
+    assert _records(_metadata(['_type', 'version', 'targets', 'expires', 'custom', 'spec_version'])) == [
+        ('primary.txt', 1, 'primary-ecu'),
+        ('secondary.txt', 2, 'secondary-ecu'),
+    ]
+
+
+def test_rejects_trailing_data():
+    f = io.BytesIO(_metadata(sorted(SIGNED)).getvalue() + b'{}')
+    with pytest.raises(ValueError):
+        list(iter_targets(f))
@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import cProfile
+from contextlib import contextmanager
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+TIMING SPANS
+
+The primary wraps each phase of an update cycle in a span. Finished spans are handed to every sink the tracer
+was created with, so where they end up (a json lines file, an in-process histogram, nowhere) is up to the
+caller. A cycle can optionally be captured with cProfile and dumped to `<profile_dir>/cycle-<n>.prof` which
+can be opened with `python -m pstats` or snakeviz.
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+SINKS
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+class JsonLinesSink():
+    '''
+    Appends one json object per span to a file
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def record(self, span):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(span) + '\n')
+
+
+
+class HistogramSink():
+    '''
+    Keeps every duration in memory grouped by span name (and repo if set)
+    '''
+
+    def __init__(self):
+        self.durations = {}
+
+    def record(self, span):
+        name = f"{span['name']}:{span['repo']}" if span.get('repo') else span['name']
+        self.durations.setdefault(name, []).append(span['duration_ms'])
+
+    def summary(self):
+        summary = {}
+        for name, durations in self.durations.items():
+            ordered = sorted(durations)
+            summary[name] = {
+                'count': len(ordered),
+                'min_ms': ordered[0],
+                'p50_ms': ordered[len(ordered) // 2],
+                'p95_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                'max_ms': ordered[-1],
+                'total_ms': round(sum(ordered), 3),
+            }
+        return summary
+
+
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+TRACER
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+class Tracer():
+
+    def __init__(self, sinks=None, profile_dir=None):
+        self.sinks = sinks or []
+        self.profile_dir = profile_dir
+        self.cycle_count = 0
+        self.cycle_id = None
+
+
+    def emit(self, span):
+        for sink in self.sinks:
+            sink.record(span)
+
+
+    @contextmanager
+    def span(self, name, **attrs):
+        '''
+        Time the wrapped block. Extra keyword arguments (e.g. repo='director')
+        are recorded on the span, as is the id of the cycle it ran in if any
+        '''
+        start = time.perf_counter()
+        error = None
+        try:
+            yield attrs
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.emit({
+                'cycle': self.cycle_id,
+                'name': name,
+                'start': time.time() - (time.perf_counter() - start),
+                'duration_ms': round((time.perf_counter() - start) * 1000, 3),
+                'error': error,
+                **attrs
+            })
+
+
+    @contextmanager
+    def cycle(self):
+        '''
+        Wrap a whole update cycle. Spans inside it share the cycle id and the
+        cycle is profiled if a profile_dir was given
+        '''
+        self.cycle_count += 1
+        self.cycle_id = self.cycle_count
+        profiler = None
+
+        if self.profile_dir:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        try:
+            with self.span('update_cycle') as attrs:
+                yield attrs
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(self.profile_dir, f'cycle-{self.cycle_id}.prof'))
+            self.cycle_id = None
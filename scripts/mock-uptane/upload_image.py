@@ -0,0 +1,183 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from styles import GREEN, RED, YELLOW, ENDCOLORS
+from common import (backoff_delay, parse_retry_after, BACKOFF_ATTEMPTS, UPLOAD_CHUNK_SIZE, UPLOAD_WORKERS,
+    CHUNK_SHA256_HEADER)
+
+
+'''
+
+---------------------------------------------------------------------------------------------------------------
+
+IMAGE UPLOADER
+
+Publishes a binary image as a target of the image and director repos of the mock server. Rather than posting
+the image inline to /image/targets it is split into UPLOAD_CHUNK_SIZE chunks that are sent by `workers`
+threads at once, each with the sha256 of the chunk so the server can turn away one that was damaged on the
+way. The server hashes the image as the chunks arrive and signs it once the last one is in, see
+image_uploads.py.
+
+    python upload_image.py <image> [target name] [base_url] [workers]
+
+Progress is kept in <image>.upload next to the image. If the upload is interrupted, run the same command
+again and only the chunks the server does not have yet are sent. A chunk that fails is retried with jittered
+backoff; the upload stops if one still fails after BACKOFF_ATTEMPTS tries, and can be resumed from there.
+
+---------------------------------------------------------------------------------------------------------------
+
+'''
+
+
+DEFAULT_BASE_URL = 'http://localhost:5000'
+REQUEST_TIMEOUT_SECONDS = 60
+
+
+class Uploader():
+
+    def __init__(self, image_path, name, base_url, workers):
+        self.image_path = image_path
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.workers = workers
+        self.state_path = f'{image_path}.upload'
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.sent_bytes = 0
+
+
+    def _session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+
+    def _request(self, method, path, **kwargs):
+        '''
+        Retries connection errors, server errors and the server being busy
+        '''
+        for attempt in range(BACKOFF_ATTEMPTS):
+            retry_after = None
+            try:
+                response = self._session().request(method, self.base_url + path, timeout=REQUEST_TIMEOUT_SECONDS, **kwargs)
+                if response.status_code < 500 and response.status_code != 429:
+                    return response
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                error = f'{response.status_code} {response.text[:200]}'
+            except requests.exceptions.RequestException as e:
+                error = str(e)
+
+            if attempt < BACKOFF_ATTEMPTS - 1:
+                time.sleep(backoff_delay(attempt, retry_after))
+
+        raise RuntimeError(f'{method} {path} failed after {BACKOFF_ATTEMPTS} attempts: {error}')
+
+
+    def _image_identity(self):
+        stat = os.stat(self.image_path)
+        return {'length': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'name': self.name, 'base_url': self.base_url}
+
+
+    def _resume(self):
+        '''
+        The upload to carry on with and the chunks the server already has, or
+        None if there is nothing to resume
+        '''
+        if not os.path.isfile(self.state_path):
+            return None
+        with open(self.state_path, 'r') as f:
+            state = json.loads(f.read())
+        # the image changed or goes somewhere else since, start over
+        if state['image'] != self._image_identity():
+            return None
+
+        response = self._request('GET', f"/image/uploads/{state['upload_id']}")
+        if response.status_code != 200:
+            return None
+        return state['upload_id'], response.json()
+
+
+    def _start(self):
+        identity = self._image_identity()
+        response = self._request('POST', '/image/uploads',
+            json={'name': self.name, 'length': identity['length'], 'chunk_size': UPLOAD_CHUNK_SIZE})
+        if response.status_code != 201:
+            raise RuntimeError(f"unable to start the upload: {response.json().get('error')}")
+
+        upload_id = response.json()['upload_id']
+        with open(self.state_path, 'w') as f:
+            f.write(json.dumps({'upload_id': upload_id, 'image': identity}))
+        return upload_id, response.json()
+
+
+    def _send_chunk(self, fd, upload_id, index, chunk_size, length):
+        offset = index * chunk_size
+        data = os.pread(fd, min(chunk_size, length - offset), offset)
+        response = self._request('PUT', f'/image/uploads/{upload_id}/chunks/{index}',
+            data=data, headers={CHUNK_SHA256_HEADER: hashlib.sha256(data).hexdigest()})
+        if response.status_code != 200:
+            raise RuntimeError(f"chunk {index} was refused: {response.json().get('error')}")
+
+        with self.lock:
+            self.sent_bytes += len(data)
+
+
+    def upload(self):
+        resumed = self._resume()
+        if resumed:
+            upload_id, status = resumed
+            print(f"{YELLOW}resuming upload {upload_id}, the server has {len(status['received'])} of "
+                f"{status['chunks']} chunks{ENDCOLORS}")
+        else:
+            upload_id, status = self._start()
+
+        received = set(status['received'])
+        todo = [index for index in range(status['chunks']) if index not in received]
+        start = time.monotonic()
+
+        fd = os.open(self.image_path, os.O_RDONLY)
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                futures = [pool.submit(self._send_chunk, fd, upload_id, index, status['chunk_size'], status['length'])
+                    for index in todo]
+                for done, future in enumerate(as_completed(futures), 1):
+                    future.result()
+                    if done % 16 == 0 or done == len(futures):
+                        elapsed = time.monotonic() - start
+                        print(f'{done}/{len(futures)} chunks, {self.sent_bytes / elapsed / 1024 ** 2:.1f} MB/s', end='\r')
+        finally:
+            os.close(fd)
+
+        print()
+        response = self._request('POST', f'/image/uploads/{upload_id}/complete')
+        if response.status_code != 200:
+            raise RuntimeError(f"unable to complete the upload: {response.json().get('error')}")
+
+        os.remove(self.state_path)
+        return response.json()
+
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python upload_image.py <image> [target name] [base_url] [workers]')
+        sys.exit(2)
+
+    image_path = sys.argv[1]
+    name = sys.argv[2] if len(sys.argv) > 2 else os.path.basename(image_path)
+    base_url = sys.argv[3] if len(sys.argv) > 3 else DEFAULT_BASE_URL
+    workers = int(sys.argv[4]) if len(sys.argv) > 4 else UPLOAD_WORKERS
+
+    try:
+        target = Uploader(image_path, name, base_url, workers).upload()
+    except (RuntimeError, OSError) as e:
+        print(f'{RED}{e}{ENDCOLORS}')
+        print(f'{RED}run the same command again to resume{ENDCOLORS}')
+        sys.exit(1)
+
+    print(f"{GREEN}published {target['name']} ({target['length']} bytes, sha256 {target['hashes']['sha256']}){ENDCOLORS}")